@@ -0,0 +1,169 @@
+"""
+Take bursts from a simulated camera, with 1 to ``--workers`` scoring threads,
+and report how long a burst takes against its budget and how often the best
+frame is kept.
+
+Each burst is one sharp frame, in a random position, among blurred frames and
+frames with something in front of the camera, all made from
+tests/testdata/test_image.jpg blown up by ``--scale``. Run from the repository
+root with:
+
+    python -m benchmarks.bench_burst --frames 5 --frame-time 0.1 --scale 4
+"""
+import argparse
+import asyncio
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from benchmarks.harness import Measurement, Result, write_results
+from waterbowl.burst import BurstCapture
+from waterbowl.camera_service import TEST_FILE, AbstractCameraService
+from waterbowl.enums import BURST_OCCLUSION_TOLERANCE
+
+
+class BurstCameraService(AbstractCameraService):
+    """
+    Takes ``frame_time`` to take each of the next burst's pictures, in order.
+    """
+
+    def __init__(self, frame_time: float):
+        self.frame_time = frame_time
+        self.pictures: list[Path] = []
+
+    async def take_picture(self, filepath: Path) -> Path:
+        await asyncio.sleep(self.frame_time)
+        shutil.copy(self.pictures.pop(0), filepath)
+        return filepath
+
+
+def make_pictures(scale: float, directory: Path) -> dict[str, Path]:
+    pictures = {}
+    with Image.open(TEST_FILE) as image:
+        size = (round(image.size[0] * scale), round(image.size[1] * scale))
+        image = image.resize(size, Image.Resampling.BICUBIC)
+    for name, picture in (
+        ("sharp", image),
+        ("blurred", image.filter(ImageFilter.GaussianBlur(3 * scale))),
+    ):
+        pictures[name] = directory.joinpath(f"{name}.jpg")
+        picture.save(pictures[name], quality=90)
+    blocked = image.copy()
+    ImageDraw.Draw(blocked).ellipse(
+        (size[0] // 4, size[1] // 3, size[0] * 3 // 4, size[1]), fill=(90, 80, 70)
+    )
+    pictures["blocked"] = directory.joinpath("blocked.jpg")
+    blocked.save(pictures["blocked"], quality=90)
+    return pictures
+
+
+async def run_bursts(
+    pictures: dict[str, Path],
+    output_dir: Path,
+    frames: int,
+    frame_time: float,
+    budget: float,
+    workers: int,
+    bursts: int,
+    rng: random.Random,
+) -> Result:
+    camera = BurstCameraService(frame_time)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    burst_capture = BurstCapture(
+        frames=frames,
+        budget=budget,
+        reference_picture=pictures["sharp"],
+        occlusion_tolerance=BURST_OCCLUSION_TOLERANCE,
+        executor=executor,
+    )
+    correct = 0
+    frames_taken = 0
+    over_budget = 0
+    cpu_start = time.process_time()
+    try:
+        with Measurement("burst", workers=workers, frames=frames) as measurement:
+            for burst in range(bursts):
+                sharp_frame = rng.randrange(frames)
+                camera.pictures = [
+                    pictures["sharp"]
+                    if frame == sharp_frame
+                    else pictures[rng.choice(("blurred", "blocked"))]
+                    for frame in range(frames)
+                ]
+                output = output_dir.joinpath(f"{workers}_{burst}.jpg")
+                metadata = await measurement.time(
+                    lambda: burst_capture.take_picture(camera, output)
+                )
+                output.unlink()
+                correct += metadata["burst"]["chosen"] == sharp_frame
+                frames_taken += metadata["burst"]["frames"]
+                over_budget += measurement.result.latencies[-1] > budget
+    finally:
+        burst_capture.close()
+        executor.shutdown()
+    result = measurement.result
+    result.details.update(
+        {
+            "selection_accuracy": correct / bursts,
+            "frames_per_burst": frames_taken / bursts,
+            "over_budget": over_budget,
+            "cpu_ms_per_burst": (time.process_time() - cpu_start) / bursts * 1000,
+        }
+    )
+    return result
+
+
+async def run(args: argparse.Namespace) -> list[Result]:
+    results = []
+    with TemporaryDirectory() as tmp_dir:
+        pictures = make_pictures(args.scale, Path(tmp_dir))
+        for workers in range(1, args.workers + 1):
+            # Same bursts for every worker count
+            rng = random.Random(args.seed)
+            results.append(
+                await run_bursts(
+                    pictures,
+                    Path(tmp_dir),
+                    args.frames,
+                    args.frame_time,
+                    args.budget,
+                    workers,
+                    args.bursts,
+                    rng,
+                )
+            )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--frames", type=int, default=5)
+    parser.add_argument("--frame-time", type=float, default=0.1)
+    parser.add_argument("--budget", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    for result in results:
+        print(result.report())
+        print(f"  selection accuracy: {result.details['selection_accuracy']:.0%}")
+        print(f"  frames per burst:   {result.details['frames_per_burst']:.1f}")
+        print(f"  over budget:        {result.details['over_budget']}")
+        print(f"  CPU per burst:      {result.details['cpu_ms_per_burst']:.1f}ms")
+    if args.output:
+        write_results(args.output, "bench_burst", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
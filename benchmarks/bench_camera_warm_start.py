@@ -0,0 +1,61 @@
+"""
+Compare the time per picture of a camera that starts up for every picture against
+one that stays warm, using the mock camera services' cost model.
+
+The default costs are roughly what ``libcamera-still`` takes on a Raspberry Pi
+Zero: a couple of seconds to start the camera and converge exposure and white
+balance, then one frame at 30fps. Run from the repository root with:
+
+    python -m benchmarks.bench_camera_warm_start --pictures 5
+"""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from waterbowl.camera_service import (
+    AbstractCameraService,
+    MockCameraService,
+    MockPersistentCameraService,
+)
+
+
+async def time_pictures(
+    camera_service: AbstractCameraService, pictures: int, directory: Path
+) -> list[float]:
+    durations = []
+    async with camera_service:
+        for index in range(pictures):
+            start = time.perf_counter()
+            await camera_service.take_picture(directory.joinpath(f"{index}.jpg"))
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def run(pictures: int, startup_time: float, frame_time: float) -> None:
+    print(f"{'camera':>12} {'first (s)':>10} {'mean (s)':>10} {'total (s)':>10}")
+    for name, camera_class in (
+        ("oneshot", MockCameraService),
+        ("persistent", MockPersistentCameraService),
+    ):
+        camera_service = camera_class(startup_time=startup_time, frame_time=frame_time)
+        with TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            durations = await time_pictures(camera_service, pictures, Path(tmp_dir))
+            total = time.perf_counter() - start
+        mean = sum(durations) / len(durations)
+        print(f"{name:>12} {durations[0]:>10.3f} {mean:>10.3f} {total:>10.3f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pictures", type=int, default=5)
+    parser.add_argument("--startup-time", type=float, default=2.0)
+    parser.add_argument("--frame-time", type=float, default=1 / 30)
+    args = parser.parse_args()
+    asyncio.run(run(args.pictures, args.startup_time, args.frame_time))
+
+
+if __name__ == "__main__":
+    main()
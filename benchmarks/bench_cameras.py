@@ -0,0 +1,250 @@
+"""
+Run 1 to 50 virtual cameras at once, each with its own capture pipeline, on one
+event loop, uploading to an in-process stand in for the api through shared,
+fair upload slots. For each number of cameras, report:
+
+- how far behind schedule captures started (p50/p99),
+- how late the event loop ran timers, a sign of work blocking it,
+- uploads per camera, and how evenly they were shared (Jain's fairness index,
+  1 when every camera got the same),
+- how long uploads waited for a slot, and how many frames were spilled to local
+  storage because the upload queue was full.
+
+Run from the repository root with:
+
+    python -m benchmarks.bench_cameras --cameras 1,10,50 --interval 0.5 \\
+        --duration 5 --latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import time
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional, Sequence
+from unittest import mock
+
+from benchmarks.bench_suite import api_service, local_storage, start_stand_in
+from benchmarks.harness import Measurement, Result, percentile, write_results
+from tests.stand_in_api import StandInApi
+from waterbowl.backlog_service import BacklogDrainer
+from waterbowl.camera_service import MockPersistentCameraService
+from waterbowl.enums import PIPELINE_UPLOADERS, UPLOAD_BURST, UPLOAD_RATE
+from waterbowl.pipeline import CapturePipeline, Frame
+from waterbowl.run_waterbowl_watcher import cache_frame, capture_frame, upload_frame
+from waterbowl.scheduler import Scheduler
+from waterbowl.upload_slots import UploadSlots
+
+# How often the loop lag monitor wakes up
+LAG_INTERVAL = 0.01
+
+
+class VirtualCamera:
+    """
+    Captures from a mock camera, recording how late each capture started
+    against the grid of deadlines it should be on.
+    """
+
+    def __init__(self, camera_id: str, interval: float, frame_time: float):
+        self.camera_id = camera_id
+        self.interval = interval
+        self.camera = MockPersistentCameraService(frame_time=frame_time)
+        self.scheduler = Scheduler(interval)
+        self.started: Optional[float] = None
+        self.lateness: list[float] = []
+        self.uploaded = 0
+        self.spilled = 0
+
+    async def capture(self, directory: Path) -> Optional[Frame]:
+        now = asyncio.get_running_loop().time()
+        if self.started is None:
+            self.started = now
+        slot = round((now - self.started) / self.interval)
+        self.lateness.append(now - (self.started + slot * self.interval))
+        return await capture_frame(self.camera, directory, camera_id=self.camera_id)
+
+    async def spill(self, frame: Frame) -> None:
+        self.spilled += 1
+        await cache_frame(frame)
+
+
+async def monitor_loop_lag(lags: list[float], stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        before = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - before - LAG_INTERVAL)
+
+
+def fairness(counts: Sequence[int]) -> float:
+    total = sum(counts)
+    if not total:
+        return 1.0
+    return total**2 / (len(counts) * sum(count**2 for count in counts))
+
+
+async def bench_cameras(
+    base_url: str,
+    storage_dir: Path,
+    cameras: int,
+    interval: float,
+    frame_time: float,
+    duration: float,
+    slots: int,
+    rate: float,
+    burst: int,
+) -> Result:
+    virtual_cameras = [
+        VirtualCamera(f"camera{index}", interval, frame_time)
+        for index in range(cameras)
+    ]
+    upload_slots = UploadSlots(
+        [camera.camera_id for camera in virtual_cameras],
+        slots=slots,
+        rate=rate,
+        burst=burst,
+    )
+    waits: list[float] = []
+    lags: list[float] = []
+    with local_storage(storage_dir) as cache_dir, mock.patch(
+        "waterbowl.run_waterbowl_watcher.LOCAL_STORAGE_DIR", cache_dir
+    ):
+        async with api_service(base_url) as service:
+            backlog_drainer = BacklogDrainer(service)
+            upload = partial(
+                upload_frame, api_service=service, backlog_drainer=backlog_drainer
+            )
+
+            def timed_upload(camera: VirtualCamera):
+                async def upload_when_ready(frame: Frame) -> None:
+                    queued = time.perf_counter()
+                    async with upload_slots.slot(camera.camera_id):
+                        waits.append(time.perf_counter() - queued)
+                        if await upload(frame):
+                            camera.uploaded += 1
+
+                return upload_when_ready
+
+            pipelines = [
+                CapturePipeline(
+                    camera.capture,
+                    timed_upload(camera),
+                    camera.spill,
+                    scheduler=camera.scheduler,
+                )
+                for camera in virtual_cameras
+            ]
+            stop_monitor = asyncio.Event()
+            monitor = asyncio.create_task(monitor_loop_lag(lags, stop_monitor))
+            with Measurement(
+                "cameras", cameras=cameras, interval=interval
+            ) as measurement:
+                runs = [asyncio.create_task(pipeline.run()) for pipeline in pipelines]
+                await asyncio.sleep(duration)
+                for pipeline in pipelines:
+                    pipeline.stop()
+                await asyncio.gather(*runs)
+            stop_monitor.set()
+            await monitor
+            await backlog_drainer.close()
+    result = measurement.result
+    lateness = [late for camera in virtual_cameras for late in camera.lateness]
+    uploads = [camera.uploaded for camera in virtual_cameras]
+    result.operations = sum(uploads)
+    result.latencies = waits
+    result.details.update(
+        {
+            "captures": len(lateness),
+            "capture_lateness_p50": percentile(lateness, 0.5),
+            "capture_lateness_p99": percentile(lateness, 0.99),
+            "loop_lag_p99": percentile(lags, 0.99),
+            "loop_lag_max": max(lags, default=0.0),
+            "uploads_min": min(uploads),
+            "uploads_max": max(uploads),
+            "fairness": fairness(uploads),
+            "spilled": sum(camera.spilled for camera in virtual_cameras),
+        }
+    )
+    return result
+
+
+async def run(args: argparse.Namespace) -> list[Result]:
+    stand_in_api = StandInApi(latency=args.latency)
+    runner, base_url = await start_stand_in(stand_in_api)
+    results = []
+    try:
+        with TemporaryDirectory() as tmp_dir:
+            for cameras in args.cameras:
+                results.append(
+                    await bench_cameras(
+                        base_url,
+                        Path(tmp_dir).joinpath(f"cameras-{cameras}"),
+                        cameras,
+                        args.interval,
+                        args.frame_time,
+                        args.duration,
+                        args.slots,
+                        args.rate,
+                        args.burst,
+                    )
+                )
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def ms(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--cameras",
+        type=lambda value: [int(cameras) for cameras in value.split(",")],
+        default=[1, 5, 10, 25, 50],
+    )
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds")
+    parser.add_argument("--frame-time", type=float, default=0.01, help="seconds")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--slots", type=int, default=PIPELINE_UPLOADERS)
+    parser.add_argument("--rate", type=float, default=UPLOAD_RATE)
+    parser.add_argument("--burst", type=int, default=UPLOAD_BURST)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    # Spilled frames log a warning each, keep them out of the report
+    logging.basicConfig(level=logging.ERROR)
+
+    results = asyncio.run(run(args))
+    for result in results:
+        details = result.details
+        print(f"{result.settings['cameras']} cameras")
+        print(f"  captures:          {details['captures']}")
+        print(
+            f"  capture lateness:  p50 {ms(details['capture_lateness_p50'])}"
+            f" p99 {ms(details['capture_lateness_p99'])}"
+        )
+        print(
+            f"  loop lag:          p99 {ms(details['loop_lag_p99'])}"
+            f" max {ms(details['loop_lag_max'])}"
+        )
+        print(
+            f"  uploads:           {result.operations}, per camera"
+            f" {details['uploads_min']}-{details['uploads_max']},"
+            f" fairness {details['fairness']:.3f}"
+        )
+        print(
+            f"  upload slot wait:  p50 {ms(percentile(result.latencies, 0.5))}"
+            f" p99 {ms(percentile(result.latencies, 0.99))}"
+        )
+        print(f"  spilled:           {details['spilled']}")
+    if args.output:
+        write_results(args.output, "bench_cameras", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
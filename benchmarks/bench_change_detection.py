@@ -0,0 +1,64 @@
+"""
+Replay a directory of sample frames, in name order, through the change detection
+gate and report how many frames, and bytes, would have been uploaded.
+
+Run from the repository root with:
+
+    python -m benchmarks.bench_change_detection path/to/frames --threshold 2
+"""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+from waterbowl.change_detection import ChangeDetector
+from waterbowl.enums import CHANGE_MAX_SKIPPED, CHANGE_THRESHOLD, ROOT_DIR
+
+# A heartbeat is a small JSON PATCH instead of a picture upload
+HEARTBEAT_BYTES = 256
+
+
+async def run(frames: list[Path], threshold: float, max_skipped: int) -> None:
+    change_detector = ChangeDetector(threshold=threshold, max_skipped=max_skipped)
+    total_bytes = uploaded_bytes = uploaded = 0
+    check_time = 0.0
+    for index, frame in enumerate(frames):
+        frame_bytes = frame.stat().st_size
+        total_bytes += frame_bytes
+        start = time.perf_counter()
+        thumbnail = await change_detector.thumbnail(frame)
+        check_time += time.perf_counter() - start
+        if change_detector.unchanged(thumbnail):
+            change_detector.skip()
+            uploaded_bytes += HEARTBEAT_BYTES
+        else:
+            change_detector.remember(thumbnail, str(index))
+            uploaded_bytes += frame_bytes
+            uploaded += 1
+
+    saved = 1 - uploaded_bytes / total_bytes if total_bytes else 0
+    print(f"frames:             {len(frames)}")
+    print(f"uploaded:           {uploaded}")
+    print(f"skipped:            {len(frames) - uploaded}")
+    print(f"bytes without gate: {total_bytes}")
+    print(f"bytes with gate:    {uploaded_bytes}")
+    print(f"bandwidth saved:    {saved:.1%}")
+    print(f"mean check time:    {check_time / len(frames) * 1000:.1f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "frames", nargs="?", type=Path, default=ROOT_DIR.joinpath("tests", "testdata")
+    )
+    parser.add_argument("--threshold", type=float, default=CHANGE_THRESHOLD)
+    parser.add_argument("--max-skipped", type=int, default=CHANGE_MAX_SKIPPED)
+    args = parser.parse_args()
+    frames = sorted(args.frames.glob("*.jpg"))
+    if not frames:
+        parser.error(f"No .jpg frames found in {args.frames}")
+    asyncio.run(run(frames, args.threshold, args.max_skipped))
+
+
+if __name__ == "__main__":
+    main()
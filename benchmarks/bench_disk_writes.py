@@ -0,0 +1,145 @@
+"""
+Count the bytes written to disk per capture/upload cycle, with pictures taken
+into a directory on disk and into memory (see ``CAPTURE_DIR``), while the api is
+up and while every upload fails and pictures are stored locally.
+
+Bytes written are the process's ``write_bytes`` from /proc/self/io, which only
+counts writes to block devices, not to tmpfs. The mock camera copies the test
+picture into place from this process, standing in for libcamera-still. Files
+deleted before they're flushed show up in ``cancelled_write_bytes`` too, so
+both are reported. On an SD card those are usually still written, unless they're
+deleted within the filesystem's commit interval. Run from the repository root with:
+
+    python -m benchmarks.bench_disk_writes --cycles 20
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional
+from unittest import mock
+
+from benchmarks.bench_suite import api_service, local_storage, start_stand_in
+from benchmarks.harness import Measurement, Result, write_results
+from tests.stand_in_api import StandInApi
+from waterbowl.backlog_service import BacklogDrainer
+from waterbowl.camera_service import TEST_FILE, MockPersistentCameraService
+from waterbowl.enums import CAPTURE_DIR
+from waterbowl.run_waterbowl_watcher import image_water_bowl
+
+
+def io_counters() -> dict[str, int]:
+    with open("/proc/self/io") as io_file:
+        return {
+            name: int(value)
+            for name, value in (
+                line.split(": ") for line in io_file.read().split("\n") if line
+            )
+        }
+
+
+async def bench_cycles(
+    capture_dir: Path, storage_dir: Path, failure_rate: float, cycles: int
+) -> Result:
+    stand_in_api = StandInApi(failure_rate=failure_rate, seed=0)
+    runner, base_url = await start_stand_in(stand_in_api)
+    camera = MockPersistentCameraService()
+    label = "offline" if failure_rate else "online"
+    try:
+        with local_storage(storage_dir), mock.patch(
+            "waterbowl.run_waterbowl_watcher.CAPTURE_DIR", capture_dir
+        ):
+            async with api_service(base_url) as service:
+                backlog_drainer = BacklogDrainer(service)
+                # Warm up, opening the storage queue and the connection
+                await image_water_bowl(camera, service, backlog_drainer)
+                before = io_counters()
+                with Measurement(
+                    f"cycle, {label}", capture_dir=str(capture_dir)
+                ) as measurement:
+                    for _ in range(cycles):
+                        await measurement.time(
+                            lambda: image_water_bowl(camera, service, backlog_drainer)
+                        )
+                    await backlog_drainer.close()
+                after = io_counters()
+    finally:
+        await runner.cleanup()
+    result = measurement.result
+    result.details.update(
+        {
+            "write_bytes_per_cycle": (after["write_bytes"] - before["write_bytes"])
+            / cycles,
+            "cancelled_bytes_per_cycle": (
+                after["cancelled_write_bytes"] - before["cancelled_write_bytes"]
+            )
+            / cycles,
+        }
+    )
+    return result
+
+
+async def run(disk_dir: Path, memory_dir: Optional[Path], cycles: int) -> list[Result]:
+    results = []
+    # aiohttp spools the pictures the stand in api receives into temporary
+    # files, keep those in memory so only the watcher's writes are counted
+    with TemporaryDirectory(dir=disk_dir) as tmp_dir, mock.patch.object(
+        tempfile, "tempdir", str(memory_dir) if memory_dir else None
+    ):
+        capture_dirs = [Path(tmp_dir).joinpath("capture")]
+        capture_dirs[0].mkdir()
+        if memory_dir is not None:
+            capture_dirs.append(memory_dir)
+        for capture_dir in capture_dirs:
+            for failure_rate in (0.0, 1.0):
+                storage_dir = Path(tmp_dir).joinpath(f"storage-{len(results)}")
+                results.append(
+                    await bench_cycles(capture_dir, storage_dir, failure_rate, cycles)
+                )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument(
+        "--disk-dir",
+        type=Path,
+        default=Path.cwd(),
+        help="a directory on disk, for local storage and the on disk captures",
+    )
+    parser.add_argument(
+        "--memory-dir",
+        type=Path,
+        default=CAPTURE_DIR,
+        help="a directory in memory, for the in memory captures",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    # Failed uploads log an error each, keep them out of the report
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = asyncio.run(run(args.disk_dir, args.memory_dir, args.cycles))
+    picture_bytes = TEST_FILE.stat().st_size
+    print(f"picture size: {picture_bytes} bytes")
+    for result in results:
+        print(result.report())
+        details = result.details
+        print(f"  capture dir:         {result.settings['capture_dir']}")
+        print(f"  written per cycle:   {details['write_bytes_per_cycle']:.0f}")
+        print(f"  cancelled per cycle: {details['cancelled_bytes_per_cycle']:.0f}")
+    if args.output:
+        settings = {
+            "cycles": args.cycles,
+            "disk_dir": str(args.disk_dir),
+            "memory_dir": str(args.memory_dir),
+        }
+        write_results(args.output, "bench_disk_writes", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Measure how long the picture transform takes, and how many bytes it saves, for a
+range of settings. The transform runs on one core, like it would on a Raspberry
+Pi Zero, so compare the times against the capture interval.
+
+Run from the repository root with:
+
+    python -m benchmarks.bench_image_transform [picture.jpg]
+"""
+import argparse
+import shutil
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from waterbowl.enums import ROOT_DIR
+from waterbowl.image_transform import TransformSettings, transform_picture
+
+SETTINGS = {
+    "re-encode q85": TransformSettings(crop=None, max_size=None, quality=85),
+    "1296x972 q85": TransformSettings(crop=None, max_size=(1296, 972), quality=85),
+    "640x480 q85": TransformSettings(crop=None, max_size=(640, 480), quality=85),
+    "640x480 q70": TransformSettings(crop=None, max_size=(640, 480), quality=70),
+    "crop half 640x480 q85": TransformSettings(
+        crop=(648, 486, 1944, 1458), max_size=(640, 480), quality=85
+    ),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "picture",
+        nargs="?",
+        type=Path,
+        default=ROOT_DIR.joinpath("tests", "testdata", "test_image.jpg"),
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'settings':>22} {'time (ms)':>10} {'bytes':>10} {'saved':>7}")
+    with TemporaryDirectory() as tmp_dir:
+        picture = Path(tmp_dir).joinpath(args.picture.name)
+        for name, settings in SETTINGS.items():
+            durations = []
+            for _ in range(args.repeat):
+                shutil.copy(args.picture, picture)
+                start = time.process_time()
+                metadata = transform_picture(picture, settings)
+                durations.append(time.process_time() - start)
+            transform = metadata["transform"]
+            saved = 1 - transform["bytes"] / transform["original_bytes"]
+            mean = sum(durations) / len(durations) * 1000
+            print(f"{name:>22} {mean:>10.1f} {transform['bytes']:>10} {saved:>7.1%}")
+
+
+if __name__ == "__main__":
+    main()
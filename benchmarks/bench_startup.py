@@ -0,0 +1,182 @@
+"""
+Profile how long the watcher takes to start: which imports are slowest, and how
+long after the interpreter starts the first picture is taken, with the network
+stack imported in the background (as ``python -m waterbowl`` does) or up front
+(as it used to be).
+
+Every run is a fresh interpreter, so nothing is already imported. The mock
+camera is used, waiting ``--camera-startup`` seconds like a real camera does to
+converge its exposure. Run from the repository root with:
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from benchmarks.harness import Result, write_results
+
+# Runs the watcher, reporting on stdout when the network stack has been imported
+# and when the first picture has been taken
+STARTUP_SCRIPT = """
+import asyncio, time
+
+from waterbowl import run_waterbowl_watcher
+from waterbowl.__main__ import main
+from waterbowl.camera_service import MockCameraService
+
+
+def report(event):
+    print(event, time.monotonic(), flush=True)
+
+
+import_network_modules = run_waterbowl_watcher.import_network_modules
+
+
+def reporting_import_network_modules():
+    import_network_modules()
+    report("network_ready")
+
+
+take_picture = MockCameraService.take_picture
+
+
+async def reporting_take_picture(self, filepath):
+    await asyncio.sleep({camera_startup})
+    picture = await take_picture(self, filepath)
+    report("first_picture")
+    return picture
+
+
+run_waterbowl_watcher.import_network_modules = reporting_import_network_modules
+MockCameraService.take_picture = reporting_take_picture
+if {eager}:
+    import_network_modules()
+main()
+"""
+
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def import_profile(module: str) -> tuple[float, list[tuple[str, float]]]:
+    """
+    Import a module in a fresh interpreter, returning the seconds it took and the
+    seconds each module took to import itself, slowest first.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    total = 0.0
+    modules = []
+    for line in output.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, _, name = match.groups()
+        modules.append((name, int(self_us) / 1_000_000))
+        if name == module:
+            total = int(cumulative_us) / 1_000_000
+    return total, sorted(modules, key=lambda module: module[1], reverse=True)
+
+
+def time_startup(eager: bool, camera_startup: float) -> dict[str, float]:
+    """
+    Start the watcher in a fresh interpreter and stop it once the first picture
+    has been taken and the network stack imported. Returns when each happened,
+    in seconds after starting the interpreter.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        env = {
+            **os.environ,
+            "ENVIRONMENT": "dev",
+            "CAMERA_BACKEND": "oneshot",
+            "LOCAL_STORAGE_DIR": tmp_dir,
+            # Nothing listens here, uploads fail straight away
+            "API_BASE_URL": "http://127.0.0.1:9",
+            "WAIT_TIME": "1h",
+        }
+        script = STARTUP_SCRIPT.format(eager=eager, camera_startup=camera_startup)
+        started = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, "-c", script],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        events = {}
+        try:
+            for line in process.stdout:
+                event, at = line.split()
+                events[event] = float(at) - started
+                if len(events) == 2:
+                    break
+        finally:
+            process.kill()
+            process.wait()
+    return events
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--camera-startup", type=float, default=0.0, help="seconds")
+    parser.add_argument("--slowest", type=int, default=10)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    settings = {
+        "runs": args.runs,
+        "camera_startup": args.camera_startup,
+        "slowest": args.slowest,
+    }
+
+    results = []
+    for module in ("waterbowl.__main__", "waterbowl.api_service"):
+        result = Result(f"import {module}", runs=args.runs)
+        for _ in range(args.runs):
+            total, modules = import_profile(module)
+            result.latencies.append(total)
+        result.details["slowest"] = modules[: args.slowest]
+        results.append(result)
+
+    for eager in (False, True):
+        mode = "eager" if eager else "lazy"
+        first_picture = Result(f"first picture, {mode} imports", runs=args.runs)
+        network_ready = Result(f"network ready, {mode} imports", runs=args.runs)
+        for _ in range(args.runs):
+            events = time_startup(eager, args.camera_startup)
+            first_picture.latencies.append(events["first_picture"])
+            network_ready.latencies.append(events["network_ready"])
+        results.extend([first_picture, network_ready])
+    # Every run is timed once, from starting the interpreter
+    for result in results:
+        result.operations = len(result.latencies)
+        result.seconds = sum(result.latencies)
+
+    print(
+        f"{'benchmark':>32} {'runs':>8} {'time':>10} {'throughput':>12} "
+        f"{'latency':>27} {'peak memory':>12}"
+    )
+    for result in results:
+        print(result.report())
+    for result in results:
+        if "slowest" in result.details:
+            print(f"\nSlowest imports for {result.name}:")
+            for name, seconds in result.details["slowest"]:
+                print(f"{seconds * 1000:>10.1f}ms {name}")
+    if args.output:
+        write_results(args.output, "bench_startup", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Measure the storage queue with a large backlog: single enqueues (one fsync each),
+bulk loading, reading the whole queue in pages, reading the newest entries and an
+hour at the end of the backlog, counting entries by hour, and acknowledging it in
+batches. Reading the same backlog from the previous CSV storage log is included to
+compare, along with the memory the whole backlog takes as log entries.
+
+Run from the repository root with:
+
+    python -m benchmarks.bench_storage_queue --entries 100000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import aiofiles
+
+from waterbowl.local_storage_service import READ_PAGE_SIZE, LogEntry
+from waterbowl.storage_queue import StorageQueue
+
+
+def report(name: str, operations: int, seconds: float) -> None:
+    print(
+        f"{name:>28} {operations:>8} {seconds:>9.3f}s "
+        f"{operations / seconds:>12.0f}/s"
+    )
+
+
+async def read_csv_log(csv_log: Path) -> int:
+    count = 0
+    async with aiofiles.open(csv_log, "r") as log_file:
+        while line := await log_file.readline():
+            _, _ = line.strip("\n").split(",")
+            count += 1
+    return count
+
+
+async def run(entries: int, single_enqueues: int, ack_batch: int) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        queue = StorageQueue(Path(tmp_dir).joinpath("queue.sqlite3"))
+
+        start = time.perf_counter()
+        for index in range(single_enqueues):
+            await queue.enqueue(float(index), f"{index}.jpg")
+        report("single enqueue", single_enqueues, time.perf_counter() - start)
+
+        records = [(index * 60.0, f"{index}.jpg", 0) for index in range(entries)]
+        start = time.perf_counter()
+        await queue.enqueue_many(records)
+        report("bulk enqueue", entries, time.perf_counter() - start)
+
+        total = await queue.count()
+        start = time.perf_counter()
+        read = last_id = 0
+        while page := await queue.read(after_id=last_id, limit=READ_PAGE_SIZE):
+            read += len(page)
+            last_id = page[-1][0]
+        report("paged read", read, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        newest = await queue.read_newest(limit=READ_PAGE_SIZE)
+        report("newest page", len(newest), time.perf_counter() - start)
+
+        # Pictures are a minute apart, so the last hour holds 60 of them
+        last_hour = records[-1][0] - 3600
+        start = time.perf_counter()
+        in_range = 0
+        after = None
+        while page := await queue.read_between(
+            last_hour, float("inf"), after=after, limit=READ_PAGE_SIZE
+        ):
+            in_range += len(page)
+            after = (page[-1][1], page[-1][0])
+        report("last hour, paged", in_range, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hours = await queue.count_by_hour()
+        report("hourly counts", len(hours), time.perf_counter() - start)
+
+        tracemalloc.start()
+        held = []
+        last_id = 0
+        while page := await queue.read(after_id=last_id, limit=READ_PAGE_SIZE):
+            held.extend(LogEntry.from_records(page))
+            last_id = page[-1][0]
+        entry_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{'log entries held':>28} {len(held):>8} {entry_bytes / len(held):>9.0f} B/entry"
+        )
+        del held
+
+        csv_log = Path(tmp_dir).joinpath("log.csv")
+        csv_log.write_text(
+            "".join(f"{timestamp},{picture}\n" for timestamp, picture, _ in records)
+        )
+        start = time.perf_counter()
+        csv_read = await read_csv_log(csv_log)
+        report("CSV log read (previous)", csv_read, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        acknowledged = last_id = 0
+        while page := await queue.read(after_id=last_id, limit=ack_batch):
+            await queue.acknowledge(entry_id for entry_id, _, _ in page)
+            acknowledged += len(page)
+            last_id = page[-1][0]
+        report(
+            f"acknowledge ({ack_batch}/commit)",
+            acknowledged,
+            time.perf_counter() - start,
+        )
+        assert acknowledged == total
+        await queue.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--single-enqueues", type=int, default=1_000)
+    parser.add_argument("--ack-batch", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.entries, args.single_enqueues, args.ack_batch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Benchmark the watcher end to end against the mock camera and an in-process stand
+in for the api, which can be given latency and a failure rate:
+
+- capture/upload cycles through ``image_water_bowl``, with failed uploads cached
+  and replayed in the background,
+- replaying backlogs of cached pictures (10, 1k and 10k by default),
+- the local storage paths: caching pictures, reading the backlog, and
+  acknowledging it in batches.
+
+Each benchmark reports throughput, p50/p99 latency and peak memory. Results can
+be written to JSON to compare runs. Run from the repository root with:
+
+    python -m benchmarks.bench_suite --latency 0.02 --failure-rate 0.05 \\
+        --output results.json
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, Optional, Sequence
+from unittest import mock
+
+from aiohttp import web
+from PIL import Image
+
+from benchmarks.harness import Measurement, Result, write_results
+from tests.stand_in_api import StandInApi
+from waterbowl.api_service import ApiService, SentPicture
+from waterbowl.backlog_service import BacklogDrainer
+from waterbowl.camera_service import TEST_FILE, MockCameraService
+from waterbowl.circuit_breaker import CircuitBreaker
+from waterbowl.local_storage_service import (
+    acknowledge_log_entries,
+    read_storage_log,
+    save_to_storage_log,
+    storage_queue,
+)
+from waterbowl.run_waterbowl_watcher import image_water_bowl
+
+# Cached pictures are shrunk to this size, so large backlogs fit on disk and
+# replaying them measures the client rather than the loopback interface
+REPLAY_PICTURE_SIZE = (640, 480)
+ACKNOWLEDGE_BATCH = 50
+
+
+class TimedApiService(ApiService):
+    """
+    Records the latency of every upload request into the current measurement.
+    """
+
+    measurement: Optional[Measurement] = None
+
+    async def send_picture(self, *args, **kwargs) -> SentPicture:
+        start = time.perf_counter()
+        sent = await super().send_picture(*args, **kwargs)
+        if self.measurement is not None:
+            self.measurement.record(time.perf_counter() - start)
+        return sent
+
+    async def _send_batch(self, pictures):
+        start = time.perf_counter()
+        picture_ids = await super()._send_batch(pictures)
+        if self.measurement is not None:
+            self.measurement.record(time.perf_counter() - start, len(pictures))
+        return picture_ids
+
+
+@contextmanager
+def local_storage(directory: Path) -> Iterator[Path]:
+    storage_dir = directory.joinpath("local")
+    storage_dir.mkdir(parents=True)
+    with mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DIR", storage_dir
+    ), mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DB",
+        storage_dir.joinpath("queue.sqlite3"),
+    ), mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_LOG",
+        storage_dir.joinpath("log.csv"),
+    ):
+        # storage_queue() closes this queue once the next one is opened
+        yield storage_dir
+
+
+def small_picture(directory: Path) -> Path:
+    picture = directory.joinpath("small.jpg")
+    with Image.open(TEST_FILE) as image:
+        image.resize(REPLAY_PICTURE_SIZE).save(picture, quality=85)
+    return picture
+
+
+def api_service(base_url: str) -> TimedApiService:
+    # Failures are injected on purpose, don't let the breaker stop the run
+    return TimedApiService(
+        base_url=base_url, breaker=CircuitBreaker(failure_threshold=2**31)
+    )
+
+
+async def start_stand_in(stand_in_api: StandInApi) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(stand_in_api.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+async def bench_cycles(base_url: str, cycles: int) -> Result:
+    camera = MockCameraService()
+    async with api_service(base_url) as service:
+        backlog_drainer = BacklogDrainer(service)
+        with Measurement("capture/upload cycle", cycles=cycles) as measurement:
+            for _ in range(cycles):
+                await measurement.time(
+                    lambda: image_water_bowl(camera, service, backlog_drainer)
+                )
+            # Finish sending anything that was cached along the way
+            await backlog_drainer.start()
+        measurement.result.details["cached"] = await (await storage_queue()).count()
+    return measurement.result
+
+
+async def cache_pictures(storage_dir: Path, picture: Path, entries: int) -> None:
+    # Hard links keep large backlogs from filling the disk
+    for index in range(entries):
+        os.link(picture, storage_dir.joinpath(f"{index}.jpg"))
+    await (await storage_queue()).enqueue_many(
+        [
+            (float(index), f"{index}.jpg", picture.stat().st_size)
+            for index in range(entries)
+        ]
+    )
+
+
+async def bench_replay(
+    base_url: str, storage_dir: Path, picture: Path, entries: int, attempts: int = 100
+) -> Result:
+    await cache_pictures(storage_dir, picture, entries)
+    async with api_service(base_url) as service:
+        with Measurement(f"backlog replay {entries}", entries=entries) as measurement:
+            service.measurement = measurement
+            # A failed upload stops a drain, keep going until everything is sent
+            for _ in range(attempts):
+                await BacklogDrainer(service).drain()
+                if not await (await storage_queue()).count():
+                    break
+        measurement.result.details["remaining"] = await (await storage_queue()).count()
+    return measurement.result
+
+
+async def bench_storage(spool_dir: Path, picture: Path, entries: int) -> list[Result]:
+    spool_dir.mkdir()
+    for index in range(entries):
+        os.link(picture, spool_dir.joinpath(f"{index}.jpg"))
+
+    with Measurement("storage write", entries=entries) as write:
+        for index in range(entries):
+            await write.time(
+                lambda: save_to_storage_log(
+                    timestamp=float(index), picture=spool_dir.joinpath(f"{index}.jpg")
+                )
+            )
+
+    log_entries = []
+    with Measurement("storage read", entries=entries) as read:
+        log = read_storage_log()
+        while True:
+            start = time.perf_counter()
+            try:
+                log_entries.append(await log.__anext__())
+            except StopAsyncIteration:
+                break
+            read.record(time.perf_counter() - start)
+
+    with Measurement(
+        f"storage acknowledge ({ACKNOWLEDGE_BATCH}/commit)", entries=entries
+    ) as acknowledge:
+        for start in range(0, len(log_entries), ACKNOWLEDGE_BATCH):
+            batch = log_entries[start : start + ACKNOWLEDGE_BATCH]
+            batch_start = time.perf_counter()
+            await acknowledge_log_entries(batch)
+            acknowledge.record(time.perf_counter() - batch_start, len(batch))
+
+    return [write.result, read.result, acknowledge.result]
+
+
+async def run(
+    latency: float,
+    failure_rate: float,
+    batch_upload: bool,
+    cycles: int,
+    replay_sizes: Sequence[int],
+    storage_entries: int,
+    seed: int,
+) -> list[Result]:
+    stand_in_api = StandInApi(
+        batch_upload=batch_upload,
+        latency=latency,
+        failure_rate=failure_rate,
+        seed=seed,
+    )
+    runner, base_url = await start_stand_in(stand_in_api)
+    results = []
+    try:
+        with TemporaryDirectory() as tmp_dir:
+            picture = small_picture(Path(tmp_dir))
+            with local_storage(Path(tmp_dir).joinpath("cycles")):
+                results.append(await bench_cycles(base_url, cycles))
+            for entries in replay_sizes:
+                replay_dir = Path(tmp_dir).joinpath(f"replay-{entries}")
+                with local_storage(replay_dir) as storage_dir:
+                    results.append(
+                        await bench_replay(base_url, storage_dir, picture, entries)
+                    )
+            with local_storage(Path(tmp_dir).joinpath("storage")) as storage_dir:
+                results.extend(
+                    await bench_storage(
+                        storage_dir.parent.joinpath("spool"), picture, storage_entries
+                    )
+                )
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-upload", action="store_true")
+    parser.add_argument("--cycles", type=int, default=50)
+    parser.add_argument(
+        "--replay-sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10, 1_000, 10_000],
+    )
+    parser.add_argument("--storage-entries", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    # Injected failures log a warning each, keep them out of the report
+    logging.basicConfig(level=logging.ERROR)
+    settings = {
+        "latency": args.latency,
+        "failure_rate": args.failure_rate,
+        "batch_upload": args.batch_upload,
+        "cycles": args.cycles,
+        "replay_sizes": args.replay_sizes,
+        "storage_entries": args.storage_entries,
+        "seed": args.seed,
+    }
+
+    results = asyncio.run(run(**settings))
+    print(
+        f"{'benchmark':>32} {'ops':>8} {'time':>10} {'throughput':>12} "
+        f"{'latency':>27} {'peak memory':>12}"
+    )
+    for result in results:
+        print(result.report())
+    if args.output:
+        write_results(args.output, "bench_suite", settings, results)
+
+
+if __name__ == "__main__":
+    main()
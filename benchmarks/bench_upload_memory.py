@@ -0,0 +1,108 @@
+"""
+Compare the peak memory used to upload a picture when it's buffered in memory
+first (the previous behaviour of ``ApiService.send_picture``) against streaming it
+from disk.
+
+Every measurement runs in a fresh interpreter so the peak RSS of one run can't
+hide another. Run from the repository root with:
+
+    python -m benchmarks.bench_upload_memory
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import aiofiles
+from aiohttp import FormData, web
+
+from benchmarks.harness import peak_rss_kb, reset_peak_rss
+from waterbowl.api_service import ApiService
+
+MEGAPIXELS = (1, 5, 12)
+MODES = ("buffered", "streaming")
+# libcamera-still JPEGs come out at roughly this many bytes per pixel
+BYTES_PER_PIXEL = 0.4
+
+
+async def discard_upload(request: web.Request) -> web.Response:
+    async for _ in request.content.iter_chunked(2**16):
+        pass
+    return web.json_response({"id": "benchmark"})
+
+
+async def send_buffered(api_service: ApiService, picture: Path) -> None:
+    form_data = FormData()
+    form_data.add_field("timestamp", "1.0")
+    async with aiofiles.open(picture, "rb") as picture_file:
+        form_data.add_field(
+            "picture",
+            BytesIO(await picture_file.read()),
+            filename=picture.name,
+            content_type="image/jpeg",
+        )
+        async with api_service._get_session().post(
+            f"{api_service.base_url}/pictures/", data=form_data
+        ) as resp:
+            await resp.json()
+
+
+async def measure(mode: str, picture: Path) -> int:
+    app = web.Application(client_max_size=0)
+    app.router.add_post("/pictures/", discard_upload)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with ApiService(base_url=f"http://127.0.0.1:{port}") as api_service:
+            # Warm up the connection and imports so only the upload is measured
+            await api_service.send_picture(timestamp=0.0, picture=b"warm up")
+            baseline = reset_peak_rss()
+            if mode == "buffered":
+                await send_buffered(api_service, picture)
+            else:
+                await api_service.send_picture(timestamp=1.0, picture=picture)
+            return peak_rss_kb() - baseline
+    finally:
+        await runner.cleanup()
+
+
+def run_worker(mode: str, picture: Path) -> int:
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_upload_memory", mode, str(picture)],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return int(result.stdout.strip())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("mode", nargs="?", choices=MODES)
+    parser.add_argument("picture", nargs="?", type=Path)
+    args = parser.parse_args()
+    if args.mode:
+        print(asyncio.run(measure(args.mode, args.picture)))
+        return
+
+    print(
+        f"{'MP':>4} {'size (KiB)':>12} {'buffered (KiB)':>16} {'streaming (KiB)':>16}"
+    )
+    with TemporaryDirectory() as tmp_dir:
+        for megapixels in MEGAPIXELS:
+            picture = Path(tmp_dir).joinpath(f"{megapixels}mp.jpg")
+            picture.write_bytes(os.urandom(int(megapixels * 1e6 * BYTES_PER_PIXEL)))
+            buffered, streaming = (run_worker(mode, picture) for mode in MODES)
+            size = picture.stat().st_size // 1024
+            print(f"{megapixels:>4} {size:>12} {buffered:>16} {streaming:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Run the water level estimator over a labelled set of pictures, and report how
+close its estimates are to the labels, how often it tells clearly fine pictures
+apart from the rest, and the time and CPU it takes per picture.
+
+The directory needs a labels.csv with picture, level and roi columns, and
+empty.jpg and full.jpg reference pictures, like tests/testdata/water_level.
+The samples there are small, ``--scale`` blows them up to the camera's
+resolution first so decoding costs what it would on the device. Run from the
+repository root with:
+
+    python -m benchmarks.bench_water_level tests/testdata/water_level --scale 8
+"""
+import argparse
+import asyncio
+import csv
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterable
+
+from PIL import Image
+
+from benchmarks.harness import Measurement, write_results
+from waterbowl.enums import WATER_LEVEL_FINE
+from waterbowl.water_level import WaterLevelEstimator
+
+
+def scale_pictures(
+    directory: Path, pictures: Iterable[str], scale: float, output_dir: Path
+) -> Path:
+    for picture in pictures:
+        with Image.open(directory.joinpath(picture)) as image:
+            size = (round(image.size[0] * scale), round(image.size[1] * scale))
+            image.resize(size, Image.Resampling.BICUBIC).save(
+                output_dir.joinpath(picture), quality=90
+            )
+    return output_dir
+
+
+async def run(directory: Path, scale: float, fine: float, repeats: int):
+    with open(directory.joinpath("labels.csv"), newline="") as labels_file:
+        labels = list(csv.DictReader(labels_file))
+    roi = tuple(round(int(edge) * scale) for edge in labels[0]["roi"].split(","))
+    with TemporaryDirectory() as tmp_dir:
+        if scale != 1:
+            pictures = [label["picture"] for label in labels]
+            pictures.extend(["empty.jpg", "full.jpg"])
+            directory = scale_pictures(directory, set(pictures), scale, Path(tmp_dir))
+        estimator = WaterLevelEstimator(
+            roi=roi,
+            empty_picture=directory.joinpath("empty.jpg"),
+            full_picture=directory.joinpath("full.jpg"),
+            fine=fine,
+        )
+        # The reference pictures are read with the first estimate, and NumPy and
+        # Pillow imported, keep that out of the measurement
+        await estimator.estimate(directory.joinpath(labels[0]["picture"]))
+
+        errors = []
+        correct = 0
+        cpu_start = time.process_time()
+        with Measurement("water level estimate", scale=scale) as measurement:
+            for _ in range(repeats):
+                for label in labels:
+                    level = await measurement.time(
+                        lambda: estimator.estimate(directory.joinpath(label["picture"]))
+                    )
+                    expected = float(label["level"])
+                    errors.append(abs(level - expected))
+                    correct += (level >= fine) == (expected >= fine)
+        cpu_seconds = time.process_time() - cpu_start
+    result = measurement.result
+    result.details.update(
+        {
+            "mean_error": sum(errors) / len(errors),
+            "max_error": max(errors),
+            "fine_accuracy": correct / len(errors),
+            "cpu_ms_per_picture": cpu_seconds / len(errors) * 1000,
+        }
+    )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--fine", type=float, default=WATER_LEVEL_FINE)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    settings = {"scale": args.scale, "fine": args.fine, "repeats": args.repeats}
+
+    result = asyncio.run(run(args.directory, args.scale, args.fine, args.repeats))
+    print(result.report())
+    print(f"mean error:         {result.details['mean_error']:.3f}")
+    print(f"max error:          {result.details['max_error']:.3f}")
+    print(f"fine accuracy:      {result.details['fine_accuracy']:.1%}")
+    print(f"CPU per picture:    {result.details['cpu_ms_per_picture']:.1f}ms")
+    if args.output:
+        write_results(args.output, "bench_water_level", settings, [result])
+
+
+if __name__ == "__main__":
+    main()
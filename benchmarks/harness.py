@@ -0,0 +1,157 @@
+"""
+Shared helpers for benchmarks: timing operations, latency percentiles, peak
+memory, and writing results to JSON so runs can be compared.
+"""
+import json
+import platform
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, Sequence
+
+
+def _proc_status_kb(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> int:
+    """
+    Reset the peak RSS to the current RSS where the kernel allows it, so that
+    memory used while importing and starting up isn't counted. Returns the RSS
+    the next peak should be compared against.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return _proc_status_kb("VmRSS")
+    except OSError:
+        return peak_rss_kb()
+
+
+def peak_rss_kb() -> int:
+    try:
+        return _proc_status_kb("VmHWM")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values: Sequence[float], fraction: float) -> Optional[float]:
+    """
+    The value below which ``fraction`` of the values fall, interpolating between
+    the closest two.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Result:
+    """
+    The outcome of one benchmark: how many operations ran in how long, the
+    latency of each, and the most memory used above the starting point.
+    """
+
+    def __init__(self, name: str, **settings: Any):
+        self.name = name
+        self.settings = settings
+        self.operations = 0
+        self.seconds = 0.0
+        self.latencies: list[float] = []
+        self.peak_memory_kb = 0
+        # Anything else worth knowing about the run, like pictures left unsent
+        self.details: dict[str, Any] = {}
+
+    @property
+    def throughput(self) -> float:
+        return self.operations / self.seconds if self.seconds else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "settings": self.settings,
+            "operations": self.operations,
+            "seconds": self.seconds,
+            "throughput": self.throughput,
+            "p50": percentile(self.latencies, 0.5),
+            "p99": percentile(self.latencies, 0.99),
+            "peak_memory_kb": self.peak_memory_kb,
+            **self.details,
+        }
+
+    def report(self) -> str:
+        p50, p99 = percentile(self.latencies, 0.5), percentile(self.latencies, 0.99)
+        latency = (
+            f"p50 {p50 * 1000:>8.2f}ms p99 {p99 * 1000:>8.2f}ms"
+            if self.latencies
+            else " " * 27
+        )
+        return (
+            f"{self.name:>32} {self.operations:>8} {self.seconds:>9.3f}s "
+            f"{self.throughput:>10.1f}/s {latency} {self.peak_memory_kb:>8} KiB"
+        )
+
+
+class Measurement:
+    """
+    Context manager measuring a benchmark's wall time and peak memory into a
+    ``Result``. Latencies are added with ``time`` or ``record``.
+
+        with Measurement("storage write") as measurement:
+            for picture in pictures:
+                await measurement.time(lambda: save_to_storage_log(...))
+        print(measurement.result.report())
+    """
+
+    def __init__(self, name: str, **settings: Any):
+        self.result = Result(name, **settings)
+        self._baseline_kb = 0
+        self._start = 0.0
+
+    def __enter__(self) -> "Measurement":
+        self._baseline_kb = reset_peak_rss()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.result.seconds = time.perf_counter() - self._start
+        self.result.peak_memory_kb = max(0, peak_rss_kb() - self._baseline_kb)
+
+    def record(self, latency: float, operations: int = 1) -> None:
+        self.result.latencies.append(latency)
+        self.result.operations += operations
+
+    async def time(self, operation: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.perf_counter()
+        try:
+            return await operation()
+        finally:
+            self.record(time.perf_counter() - start)
+
+
+def write_results(
+    output: Path, benchmark: str, settings: dict[str, Any], results: list[Result]
+) -> None:
+    output.write_text(
+        json.dumps(
+            {
+                "benchmark": benchmark,
+                "started_at": datetime.now().isoformat(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "machine": platform.machine(),
+                "settings": settings,
+                "results": [result.as_dict() for result in results],
+            },
+            indent=2,
+        )
+    )
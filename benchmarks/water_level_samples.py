@@ -0,0 +1,83 @@
+"""
+Generate the labelled sample pictures used to test and benchmark the water level
+estimator: a front view of a translucent reservoir, like the one in
+tests/testdata/test_image.jpg, filled to a known level, under slightly different
+lighting and sensor noise. Alongside the pictures, labels.csv records each
+picture's level and the region of interest, from the empty mark to the full mark.
+
+The pictures in tests/testdata/water_level were made with:
+
+    python -m benchmarks.water_level_samples tests/testdata/water_level
+"""
+import argparse
+import csv
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+SIZE = (320, 240)
+BACKGROUND = (105, 68, 44)
+RESERVOIR = (230, 231, 235)
+RESERVOIR_BOX = (170, 50, 290, 200)
+# From the empty mark at the bottom up to the full mark at the top
+REGION_OF_INTEREST = (182, 70, 278, 186)
+WATER = (176, 190, 204)
+MENISCUS = (140, 152, 168)
+
+LEVELS = (0.0, 0.05, 0.1, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.9, 1.0)
+
+
+def sample_picture(level: float, brightness: float, rng: np.random.Generator):
+    image = Image.new("RGB", SIZE, BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    # Wood grain behind the reservoir
+    for x in range(0, SIZE[0], 6):
+        shade = int(rng.integers(-12, 12))
+        draw.line(
+            (x, 0, x, SIZE[1]), fill=tuple(c + shade for c in BACKGROUND), width=3
+        )
+    draw.rounded_rectangle(RESERVOIR_BOX, radius=24, fill=RESERVOIR)
+    left, upper, right, lower = REGION_OF_INTEREST
+    water_line = round(lower - level * (lower - upper))
+    if level > 0:
+        draw.rectangle((left, water_line, right, lower), fill=WATER)
+        draw.line((left, water_line, right, water_line), fill=MENISCUS, width=2)
+
+    pixels = np.asarray(image, dtype=np.float32) * brightness
+    pixels += rng.normal(0, 4, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+
+    rows = []
+    # The reference pictures are taken under the usual lighting
+    for name, level in (("empty.jpg", 0.0), ("full.jpg", 1.0)):
+        sample_picture(level, 1.0, rng).save(args.directory.joinpath(name), quality=85)
+        rows.append((name, level))
+    for index, level in enumerate(LEVELS):
+        name = f"sample_{index:02}.jpg"
+        brightness = float(rng.uniform(0.94, 1.06))
+        sample_picture(level, brightness, rng).save(
+            args.directory.joinpath(name), quality=85
+        )
+        rows.append((name, level))
+
+    with open(args.directory.joinpath("labels.csv"), "w", newline="") as labels:
+        writer = csv.writer(labels)
+        writer.writerow(["picture", "level", "roi"])
+        roi = ",".join(str(edge) for edge in REGION_OF_INTEREST)
+        writer.writerows((name, level, roi) for name, level in rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,5 +2,11 @@
 
 cd /camera || exit 1
 export ENVIRONMENT="prod"
-pip install -r requirements.txt
-python3 -m waterbowl
+# Only install the requirements when they, or python, have changed since the
+# last install, pip takes seconds to find out there's nothing to do
+requirements_stamp=".requirements.sha256"
+requirements_hash=$({ python3 --version; cat requirements.txt; } | sha256sum)
+if [ "$(cat "$requirements_stamp" 2>/dev/null)" != "$requirements_hash" ]; then
+  pip install -r requirements.txt && echo "$requirements_hash" > "$requirements_stamp"
+fi
+exec python3 -m waterbowl
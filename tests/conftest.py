@@ -1,3 +1,4 @@
+import gc
 import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -33,8 +34,24 @@ def mock_local_storage_log(mock_local_storage_dir: Path) -> Path:
     yield log_file
 
 
+@pytest.fixture
+def mock_local_storage_db(mock_local_storage_dir: Path) -> Path:
+    yield mock_local_storage_dir.joinpath("queue.sqlite3")
+
+
 @pytest.fixture
 def test_picture(test_data_dir: Path, mock_local_storage_dir: Path):
     tmp_file = mock_local_storage_dir.joinpath("test_image.jpg")
     shutil.copy(test_data_dir.joinpath("test_image.jpg"), tmp_file)
     yield tmp_file
+
+
+@pytest.fixture
+def short_gc_pauses():
+    # Once the rest of the suite has been imported, a full garbage collection can
+    # take longer than timing tests' tolerance. Leave what's already allocated out
+    # of collections while the test runs.
+    gc.collect()
+    gc.freeze()
+    yield
+    gc.unfreeze()
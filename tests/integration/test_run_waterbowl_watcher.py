@@ -4,6 +4,7 @@ from pathlib import Path
 from unittest import mock
 
 import pytest
+import pytest_asyncio
 
 from waterbowl.api_service import ApiService
 from waterbowl.camera_service import MockCameraService, AbstractCameraService
@@ -15,14 +16,17 @@ def test_camera_service() -> AbstractCameraService:
     yield MockCameraService()
 
 
-@pytest.fixture
-def test_api_service() -> ApiService:
-    yield ApiService()
+@pytest_asyncio.fixture
+async def test_api_service() -> ApiService:
+    async with ApiService() as api_service:
+        yield api_service
 
 
 @pytest.fixture
 def mock_local_storage(
-    mock_local_storage_dir: Path, mock_local_storage_log: Path
+    mock_local_storage_dir: Path,
+    mock_local_storage_log: Path,
+    mock_local_storage_db: Path,
 ) -> None:
     with mock.patch(
         "waterbowl.run_waterbowl_watcher.LOCAL_STORAGE_DIR", mock_local_storage_dir
@@ -34,7 +38,11 @@ def mock_local_storage(
                 "waterbowl.local_storage_service.LOCAL_STORAGE_LOG",
                 mock_local_storage_log,
             ):
-                yield
+                with mock.patch(
+                    "waterbowl.local_storage_service.LOCAL_STORAGE_DB",
+                    mock_local_storage_db,
+                ):
+                    yield
 
 
 @pytest.fixture
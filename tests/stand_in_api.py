@@ -0,0 +1,194 @@
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Any, Optional
+from uuid import uuid4
+
+from aiohttp import web
+
+
+class StandInApi:
+    """
+    A small in-process stand in for the water bowl api, used to check what the
+    client actually sends and how many round trips it takes.
+
+    Set ``fail_with`` to a status code to have every request fail with it, until
+    it's set back to None. Failed requests are counted by path in
+    ``failed_requests`` rather than in ``round_trips``. Set ``drop_responses``
+    to have that many uploads stored, but the connection closed instead of
+    answering, like a response lost to a timeout.
+
+    Uploads are deduplicated by client id like the real api, answering 409 with
+    the existing id.
+
+    For benchmarks, every request can be delayed by ``latency`` seconds, and a
+    ``failure_rate`` fraction of requests fail with a 503 (picked by ``seed``, so
+    runs can be repeated).
+    """
+
+    def __init__(
+        self,
+        batch_upload: bool = False,
+        max_batch_size: int = 50,
+        upload_metadata: bool = False,
+        batch_update: bool = False,
+        gzip_requests: bool = False,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.batch_upload = batch_upload
+        self.max_batch_size = max_batch_size
+        self.upload_metadata = upload_metadata
+        self.batch_update = batch_update
+        self.gzip_requests = gzip_requests
+        self.compressed_requests = 0
+        self.fail_with: Optional[int] = None
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.drop_responses = 0
+        self.round_trips: Counter = Counter()
+        self.failed_requests: Counter = Counter()
+        self.pictures: dict[str, dict[str, Any]] = {}
+        self.client_ids: dict[str, str] = {}
+        self.app = web.Application(
+            client_max_size=64 * 1024 * 1024, middlewares=[self.fail_on_command]
+        )
+        self.app.router.add_get("/health", self.health)
+        self.app.router.add_get("/capabilities", self.capabilities)
+        self.app.router.add_post("/pictures/", self.create_picture)
+        self.app.router.add_post("/pictures/batch/", self.create_pictures)
+        self.app.router.add_patch("/pictures/batch/", self.update_pictures)
+        self.app.router.add_patch("/pictures/{picture_id}/", self.update_picture)
+
+    @property
+    def total_round_trips(self) -> int:
+        return sum(self.round_trips.values())
+
+    @web.middleware
+    async def fail_on_command(self, request: web.Request, handler) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        status = self.fail_with
+        if status is None and self.failure_rate:
+            if self.random.random() < self.failure_rate:
+                status = 503
+        if status is None:
+            return await handler(request)
+        self.failed_requests[request.path] += 1
+        # Read the whole request, so the connection can be reused
+        await request.read()
+        return web.Response(status=status)
+
+    def _store_picture(
+        self,
+        timestamp: str,
+        filename: Optional[str],
+        picture: bytes,
+        client_id: Optional[str] = None,
+    ) -> tuple[str, bool]:
+        """
+        Store a picture, returning its id and whether it was new.
+        """
+        if client_id in self.client_ids:
+            return self.client_ids[client_id], False
+        picture_id = str(uuid4())
+        self.pictures[picture_id] = {
+            "timestamp": float(timestamp),
+            "filename": filename,
+            "size": len(picture),
+        }
+        if client_id is not None:
+            self.client_ids[client_id] = picture_id
+        return picture_id, True
+
+    def _drop_response(self, request: web.Request) -> bool:
+        if self.drop_responses <= 0:
+            return False
+        self.drop_responses -= 1
+        request.transport.close()
+        return True
+
+    async def health(self, _: web.Request) -> web.Response:
+        self.round_trips["health"] += 1
+        return web.Response(text="")
+
+    async def capabilities(self, _: web.Request) -> web.Response:
+        self.round_trips["capabilities"] += 1
+        capabilities = {
+            "batch_upload": self.batch_upload,
+            "upload_metadata": self.upload_metadata,
+            "batch_update": self.batch_update,
+            "gzip_requests": self.gzip_requests,
+        }
+        # Older versions of the api don't have the endpoint
+        if not any(capabilities.values()):
+            raise web.HTTPNotFound()
+        return web.json_response(
+            {**capabilities, "max_batch_size": self.max_batch_size}
+        )
+
+    async def create_picture(self, request: web.Request) -> web.Response:
+        self.round_trips["create_picture"] += 1
+        form = await request.post()
+        picture = form["picture"]
+        picture_id, created = self._store_picture(
+            form["timestamp"],
+            picture.filename,
+            picture.file.read(),
+            form.get("client_id"),
+        )
+        if self.upload_metadata and "metadata" in form:
+            self.pictures[picture_id].update(json.loads(form["metadata"]))
+        if self._drop_response(request):
+            return web.Response()
+        return web.json_response({"id": picture_id}, status=200 if created else 409)
+
+    async def create_pictures(self, request: web.Request) -> web.Response:
+        self.round_trips["create_pictures"] += 1
+        if not self.batch_upload:
+            raise web.HTTPNotFound()
+        form = await request.post()
+        client_ids = form.getall("client_id", [None] * len(form.getall("picture")))
+        results = [
+            {
+                "id": self._store_picture(
+                    timestamp, picture.filename, picture.file.read(), client_id
+                )[0]
+            }
+            for timestamp, picture, client_id in zip(
+                form.getall("timestamp"), form.getall("picture"), client_ids
+            )
+        ]
+        if self._drop_response(request):
+            return web.Response()
+        return web.json_response({"results": results})
+
+    async def _json_body(self, request: web.Request) -> Any:
+        if request.headers.get("Content-Encoding") == "gzip":
+            if not self.gzip_requests:
+                raise web.HTTPUnsupportedMediaType()
+            self.compressed_requests += 1
+        # aiohttp has already decompressed the body
+        return await request.json()
+
+    async def update_picture(self, request: web.Request) -> web.Response:
+        self.round_trips["update_picture"] += 1
+        picture_id = request.match_info["picture_id"]
+        if picture_id not in self.pictures:
+            raise web.HTTPNotFound()
+        self.pictures[picture_id].update(await self._json_body(request))
+        return web.json_response({"id": picture_id})
+
+    async def update_pictures(self, request: web.Request) -> web.Response:
+        self.round_trips["update_pictures"] += 1
+        if not self.batch_update:
+            raise web.HTTPNotFound()
+        updates = (await self._json_body(request))["updates"]
+        if any(update["id"] not in self.pictures for update in updates):
+            raise web.HTTPNotFound()
+        for update in updates:
+            self.pictures[update["id"]].update(update["data"])
+        return web.json_response({})
@@ -1,10 +1,16 @@
+import asyncio
 import json
 from pathlib import Path
+from unittest import mock
 
+import aiohttp
 import pytest
+import pytest_asyncio
+from aiohttp import web
 from aioresponses import aioresponses
 
-from waterbowl.api_service import ApiService, ApiException
+from tests.stand_in_api import StandInApi
+from waterbowl.api_service import ApiService, ApiException, picture_client_id
 
 
 @pytest.fixture
@@ -18,9 +24,10 @@ def test_server():
         yield mock_server
 
 
-@pytest.fixture
-def test_api_service(base_url: str) -> ApiService:
-    yield ApiService(base_url=base_url)
+@pytest_asyncio.fixture
+async def test_api_service(base_url: str) -> ApiService:
+    async with ApiService(base_url=base_url) as api_service:
+        yield api_service
 
 
 @pytest.mark.asyncio
@@ -48,8 +55,57 @@ async def test_send_picture(
     test_server.post(
         f"{base_url}/pictures/", status=200, body=json.dumps({"id": "some_id"})
     )
-    success = await test_api_service.send_picture(timestamp=1.1, picture=Path(__file__))
-    assert success == "some_id"
+    sent = await test_api_service.send_picture(timestamp=1.1, picture=Path(__file__))
+    assert sent == ("some_id", None)
+
+
+@pytest.mark.asyncio
+async def test_send_picture_from_buffer(
+    base_url: str, test_api_service: ApiService, test_server: aioresponses
+):
+    test_server.post(
+        f"{base_url}/pictures/", status=200, body=json.dumps({"id": "some_id"})
+    )
+    sent = await test_api_service.send_picture(
+        timestamp=1.1, picture=memoryview(b"not really a jpeg")
+    )
+    assert sent.picture_id == "some_id"
+
+
+@pytest.mark.asyncio
+async def test_send_picture_returns_water_level(
+    base_url: str, test_api_service: ApiService, test_server: aioresponses
+):
+    test_server.post(
+        f"{base_url}/pictures/",
+        status=200,
+        body=json.dumps({"id": "some_id", "water_level": 0.25}),
+    )
+    sent = await test_api_service.send_picture(timestamp=1.1, picture=b"a")
+    assert sent == ("some_id", 0.25)
+
+
+@pytest.mark.asyncio
+async def test_send_picture_streams_file(aiohttp_server, test_picture: Path):
+    received = {}
+
+    async def upload(request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        while part := await reader.next():
+            received[part.name] = (part.filename, await part.read())
+        return web.json_response({"id": "some_id"})
+
+    app = web.Application()
+    app.router.add_post("/pictures/", upload)
+    server = await aiohttp_server(app)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+
+    assert picture_id == "some_id"
+    assert received["timestamp"] == (None, b"1.1")
+    assert received["picture"] == (test_picture.name, test_picture.read_bytes())
 
 
 @pytest.mark.asyncio
@@ -71,3 +127,269 @@ async def test_update_picture(
         picture_id=picture_id, picture_data={}
     )
     assert success
+
+
+@pytest.mark.asyncio
+async def test_session_is_reused(
+    base_url: str, test_api_service: ApiService, test_server: aioresponses
+):
+    test_server.get(f"{base_url}/health", status=200, body="")
+    test_server.post(
+        f"{base_url}/pictures/", status=200, body=json.dumps({"id": "some_id"})
+    )
+    session = test_api_service._get_session()
+    await test_api_service.api_healthy()
+    await test_api_service.send_picture(timestamp=1.1, picture=Path(__file__))
+    assert test_api_service._get_session() is session
+
+
+@pytest.mark.asyncio
+async def test_context_manager_closes_session(base_url: str):
+    async with ApiService(base_url=base_url, connection_limit=2) as api_service:
+        session = api_service._get_session()
+        assert session.connector.limit == 2
+        assert not session.closed
+    assert session.closed
+
+
+@pytest.fixture
+def cached_pictures(test_picture: Path) -> list[tuple[float, Path]]:
+    yield [(float(timestamp), test_picture) for timestamp in range(7)]
+
+
+@pytest.mark.parametrize(
+    "batch_upload,expected_round_trips",
+    [
+        (True, {"capabilities": 1, "create_pictures": 3}),
+        (False, {"capabilities": 1, "create_picture": 7}),
+    ],
+)
+@pytest.mark.asyncio
+async def test_send_pictures(
+    aiohttp_server,
+    cached_pictures: list[tuple[float, Path]],
+    batch_upload: bool,
+    expected_round_trips: dict[str, int],
+):
+    stand_in_api = StandInApi(batch_upload=batch_upload, max_batch_size=3)
+    server = await aiohttp_server(stand_in_api.app)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        picture_ids = await api_service.send_pictures(cached_pictures)
+
+    assert len(picture_ids) == len(cached_pictures)
+    assert [stand_in_api.pictures[id_]["timestamp"] for id_ in picture_ids] == [
+        timestamp for timestamp, _ in cached_pictures
+    ]
+    assert stand_in_api.round_trips == expected_round_trips
+
+
+@pytest.mark.asyncio
+async def test_send_pictures_batches_are_size_capped(
+    aiohttp_server, cached_pictures: list[tuple[float, Path]], test_picture: Path
+):
+    stand_in_api = StandInApi(batch_upload=True)
+    server = await aiohttp_server(stand_in_api.app)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        with mock.patch(
+            "waterbowl.api_service.API_BATCH_MAX_BYTES",
+            test_picture.stat().st_size * 2,
+        ):
+            await api_service.send_pictures(cached_pictures)
+
+    assert stand_in_api.round_trips["create_pictures"] == 4
+
+
+@pytest.mark.asyncio
+async def test_send_pictures_with_rejected_picture(
+    base_url: str,
+    test_api_service: ApiService,
+    test_server: aioresponses,
+    cached_pictures: list[tuple[float, Path]],
+):
+    test_server.get(f"{base_url}/capabilities", payload={"batch_upload": True})
+    test_server.post(
+        f"{base_url}/pictures/batch/",
+        payload={"results": [{"id": "some_id"}, {"error": "bad picture"}]},
+    )
+    picture_ids = await test_api_service.send_pictures(cached_pictures[:2])
+    assert picture_ids == ["some_id", None]
+
+
+def test_picture_client_id_is_stable(test_picture: Path):
+    client_id = picture_client_id(1.1, test_picture)
+    assert picture_client_id(1.1, test_picture) == client_id
+    assert picture_client_id(1.1, memoryview(test_picture.read_bytes())) == client_id
+    assert picture_client_id(2.2, test_picture) != client_id
+    assert picture_client_id(1.1, b"not really a jpeg") != client_id
+
+
+@pytest.mark.asyncio
+async def test_send_picture_already_exists(
+    base_url: str, test_api_service: ApiService, test_server: aioresponses
+):
+    test_server.post(f"{base_url}/pictures/", status=409, payload={"id": "some_id"})
+    test_server.post(f"{base_url}/pictures/", status=409, body="")
+    picture_id, _ = await test_api_service.send_picture(timestamp=1.1, picture=b"a")
+    assert picture_id == "some_id"
+    picture_id, _ = await test_api_service.send_picture(
+        timestamp=1.1, picture=b"a", client_id="client_id"
+    )
+    assert picture_id == "client_id"
+
+
+@pytest.mark.parametrize("batch_upload", [True, False])
+@pytest.mark.asyncio
+async def test_retry_after_dropped_response_is_not_duplicated(
+    aiohttp_server, cached_pictures: list[tuple[float, Path]], batch_upload: bool
+):
+    stand_in_api = StandInApi(batch_upload=batch_upload)
+    stand_in_api.drop_responses = 1
+    server = await aiohttp_server(stand_in_api.app)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        # The api stores the pictures, but the response never arrives
+        with pytest.raises(aiohttp.ClientError):
+            await api_service.send_pictures(cached_pictures)
+        picture_ids = await api_service.send_pictures(cached_pictures)
+
+    assert len(stand_in_api.pictures) == len(cached_pictures)
+    assert set(picture_ids) == set(stand_in_api.pictures)
+
+
+@pytest_asyncio.fixture
+async def stand_in_server(aiohttp_server):
+    async def start(stand_in_api: StandInApi):
+        return await aiohttp_server(stand_in_api.app)
+
+    yield start
+
+
+@pytest.mark.parametrize(
+    "features,expected_round_trips",
+    [
+        ({}, {"capabilities": 1, "create_picture": 5, "update_picture": 5}),
+        ({"upload_metadata": True}, {"capabilities": 1, "create_picture": 5}),
+        (
+            {"batch_update": True},
+            {"capabilities": 1, "create_picture": 5, "update_pictures": 2},
+        ),
+    ],
+)
+@pytest.mark.asyncio
+async def test_metadata_round_trips(
+    stand_in_server,
+    test_picture: Path,
+    features: dict[str, bool],
+    expected_round_trips: dict[str, int],
+):
+    stand_in_api = StandInApi(**features)
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(
+        base_url=str(server.make_url("")), update_batch_size=3
+    ) as api_service:
+        for timestamp in range(5):
+            await api_service.send_picture(
+                timestamp=float(timestamp),
+                picture=test_picture,
+                metadata={"some": timestamp},
+            )
+
+    assert stand_in_api.round_trips == expected_round_trips
+    metadata = sorted(picture["some"] for picture in stand_in_api.pictures.values())
+    assert metadata == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_queued_updates_are_merged(stand_in_server, test_picture: Path):
+    stand_in_api = StandInApi()
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+        await api_service.queue_update(picture_id, {"unchanged_at": 2.2})
+        await api_service.queue_update(picture_id, {"unchanged_at": 3.3, "some": 1})
+        await api_service.flush_updates()
+
+    assert stand_in_api.round_trips["update_picture"] == 1
+    assert stand_in_api.pictures[picture_id]["unchanged_at"] == 3.3
+    assert stand_in_api.pictures[picture_id]["some"] == 1
+
+
+@pytest.mark.asyncio
+async def test_queued_updates_flushed_when_old(stand_in_server, test_picture: Path):
+    stand_in_api = StandInApi()
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(
+        base_url=str(server.make_url("")), update_max_delay=0.05
+    ) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+        await api_service.queue_update(picture_id, {"some": 1})
+        assert stand_in_api.round_trips["update_picture"] == 0
+        # Sent once it's waited long enough, without another update being queued
+        await asyncio.sleep(0.2)
+        assert stand_in_api.round_trips["update_picture"] == 1
+        assert stand_in_api.pictures[picture_id]["some"] == 1
+
+
+@pytest.mark.parametrize("batch_update", [True, False])
+@pytest.mark.asyncio
+async def test_large_updates_are_compressed(
+    stand_in_server, test_picture: Path, batch_update: bool
+):
+    stand_in_api = StandInApi(batch_update=batch_update, gzip_requests=True)
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(
+        base_url=str(server.make_url("")), gzip_min_bytes=512
+    ) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+        await api_service.update_picture(picture_id, {"small": 1})
+        await api_service.queue_update(picture_id, {"large": "x" * 1024})
+
+    assert stand_in_api.compressed_requests == 1
+    assert stand_in_api.pictures[picture_id]["small"] == 1
+    assert stand_in_api.pictures[picture_id]["large"] == "x" * 1024
+
+
+@pytest.mark.asyncio
+async def test_large_updates_not_compressed_unless_supported(
+    stand_in_server, test_picture: Path
+):
+    stand_in_api = StandInApi()
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(
+        base_url=str(server.make_url("")), gzip_min_bytes=512
+    ) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+        await api_service.update_picture(picture_id, {"large": "x" * 1024})
+
+    assert stand_in_api.compressed_requests == 0
+    assert stand_in_api.pictures[picture_id]["large"] == "x" * 1024
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_updates(stand_in_server, test_picture: Path):
+    stand_in_api = StandInApi()
+    server = await stand_in_server(stand_in_api)
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        picture_id, _ = await api_service.send_picture(
+            timestamp=1.1, picture=test_picture
+        )
+        await api_service.queue_update(picture_id, {"some": 1})
+        await api_service.queue_update("missing", {"some": 2})
+        stand_in_api.fail_with = 503
+        with pytest.raises(ApiException):
+            await api_service.flush_updates()
+        stand_in_api.fail_with = None
+        # The api rejects the update to a picture it doesn't have, which is
+        # dropped rather than retried forever
+        await api_service.flush_updates()
+        await api_service.flush_updates()
+
+    assert stand_in_api.pictures[picture_id]["some"] == 1
+    assert stand_in_api.round_trips["update_picture"] == 2
@@ -0,0 +1,204 @@
+import asyncio
+import shutil
+from pathlib import Path
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytest_asyncio
+
+from tests.stand_in_api import StandInApi
+from waterbowl.api_service import ApiException, ApiService
+from waterbowl.backlog_service import BacklogDrainer
+from waterbowl.local_storage_service import read_storage_log, storage_queue
+
+
+@pytest.fixture
+def mock_local_storage(
+    mock_local_storage_dir: Path,
+    mock_local_storage_log: Path,
+    mock_local_storage_db: Path,
+):
+    with mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DIR", mock_local_storage_dir
+    ):
+        with mock.patch(
+            "waterbowl.local_storage_service.LOCAL_STORAGE_LOG", mock_local_storage_log
+        ):
+            with mock.patch(
+                "waterbowl.local_storage_service.LOCAL_STORAGE_DB",
+                mock_local_storage_db,
+            ):
+                yield
+
+
+@pytest_asyncio.fixture
+async def stored_pictures(
+    mock_local_storage, mock_local_storage_dir: Path, test_picture: Path
+) -> list[Path]:
+    pictures = []
+    for index in range(10):
+        picture = mock_local_storage_dir.joinpath(f"{index}.jpg")
+        shutil.copy(test_picture, picture)
+        pictures.append(picture)
+    await (await storage_queue()).enqueue_many(
+        [
+            (float(index), picture.name, picture.stat().st_size)
+            for index, picture in enumerate(pictures)
+        ]
+    )
+    yield pictures
+
+
+def mock_api_service() -> MagicMock:
+    api_service = MagicMock()
+    api_service.supports_batch_upload = AsyncMock(return_value=False)
+    return api_service
+
+
+async def remaining_timestamps() -> list[float]:
+    return [log_entry.timestamp async for log_entry in read_storage_log()]
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+class TestBacklogDrainer:
+    async def test_drain_sends_and_acknowledges_everything(
+        self, stored_pictures: list[Path]
+    ):
+        api_service = mock_api_service()
+        api_service.send_picture = AsyncMock(return_value="picture_id")
+        sent = await BacklogDrainer(api_service, concurrency=3).drain()
+
+        assert sent == 10
+        assert api_service.send_picture.await_count == 10
+        assert await remaining_timestamps() == []
+        assert not any(picture.exists() for picture in stored_pictures)
+
+    @pytest.mark.usefixtures("stored_pictures")
+    async def test_drain_is_bounded(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def send_picture(**_):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return "picture_id"
+
+        api_service = mock_api_service()
+        api_service.send_picture = send_picture
+        await BacklogDrainer(api_service, concurrency=3).drain()
+
+        assert max_in_flight == 3
+
+    async def test_drain_resumes_after_failure(self, stored_pictures: list[Path]):
+        async def send_picture(timestamp: float, **_):
+            if timestamp == 5:
+                raise ConnectionError("womp womp")
+            return "picture_id"
+
+        api_service = mock_api_service()
+        api_service.send_picture = AsyncMock(side_effect=send_picture)
+        await BacklogDrainer(api_service, concurrency=1).drain()
+
+        assert await remaining_timestamps() == [5, 6, 7, 8, 9]
+        assert stored_pictures[5].exists()
+
+        api_service.send_picture = AsyncMock(return_value="picture_id")
+        sent = await BacklogDrainer(api_service, concurrency=1).drain()
+
+        assert sent == 5
+        assert [
+            call.kwargs["timestamp"]
+            for call in api_service.send_picture.await_args_list
+        ] == [5, 6, 7, 8, 9]
+        assert await remaining_timestamps() == []
+
+    @pytest.mark.usefixtures("stored_pictures")
+    async def test_start_runs_in_background(self):
+        api_service = mock_api_service()
+        api_service.send_picture = AsyncMock(return_value="picture_id")
+        backlog_drainer = BacklogDrainer(api_service)
+        task = backlog_drainer.start()
+
+        assert backlog_drainer.running
+        assert backlog_drainer.start() is task
+        assert await task == 10
+        assert not backlog_drainer.running
+
+    @pytest.mark.usefixtures("stored_pictures")
+    async def test_missing_picture_is_dropped(self):
+        api_service = mock_api_service()
+        api_service.send_picture = AsyncMock(side_effect=FileNotFoundError())
+        await BacklogDrainer(api_service).drain()
+
+        assert await remaining_timestamps() == []
+
+    @pytest.mark.usefixtures("stored_pictures")
+    async def test_drain_in_batches(self):
+        api_service = mock_api_service()
+        api_service.supports_batch_upload = AsyncMock(return_value=True)
+        api_service.batch_limits = AsyncMock(return_value=(4, 1024 * 1024))
+        api_service.send_pictures = AsyncMock(
+            side_effect=lambda pictures: [
+                None if timestamp == 9 else "picture_id" for timestamp, _ in pictures
+            ]
+        )
+        sent = await BacklogDrainer(api_service).drain()
+
+        # The picture the api rejected is dropped rather than sent again
+        assert sent == 10
+        assert api_service.send_pictures.await_count == 3
+        assert await remaining_timestamps() == []
+
+    async def test_rejected_picture_is_dropped(self, stored_pictures: list[Path]):
+        async def send_picture(timestamp: float, **_):
+            if timestamp == 0:
+                raise ApiException("Error from the api: status 400", 400)
+            return "picture_id"
+
+        api_service = mock_api_service()
+        api_service.send_picture = AsyncMock(side_effect=send_picture)
+        sent = await BacklogDrainer(api_service, concurrency=1).drain()
+
+        assert sent == 10
+        assert await remaining_timestamps() == []
+        assert not stored_pictures[0].exists()
+
+    @pytest.mark.usefixtures("stored_pictures")
+    async def test_rejected_batch_sent_one_at_a_time(self):
+        async def send_picture(timestamp: float, **_):
+            if timestamp == 2:
+                raise ApiException("Error from the api: status 422", 422)
+            if timestamp == 5:
+                raise ApiException("Error from the api: status 503", 503)
+            return "picture_id"
+
+        api_service = mock_api_service()
+        api_service.supports_batch_upload = AsyncMock(return_value=True)
+        api_service.batch_limits = AsyncMock(return_value=(4, 1024 * 1024))
+        api_service.send_pictures = AsyncMock(
+            side_effect=ApiException("Error from the api: status 400", 400)
+        )
+        api_service.send_picture = AsyncMock(side_effect=send_picture)
+        await BacklogDrainer(api_service, concurrency=1).drain()
+
+        # The rejected picture is dropped, the one that failed is kept to retry
+        assert await remaining_timestamps() == [5, 6, 7, 8, 9]
+
+    async def test_parallel_drains_do_not_duplicate(
+        self, aiohttp_server, stored_pictures: list[Path]
+    ):
+        stand_in_api = StandInApi()
+        server = await aiohttp_server(stand_in_api.app)
+        async with ApiService(base_url=str(server.make_url(""))) as api_service:
+            await asyncio.gather(
+                BacklogDrainer(api_service, concurrency=2).drain(),
+                BacklogDrainer(api_service, concurrency=2).drain(),
+            )
+
+        assert len(stand_in_api.pictures) == len(stored_pictures)
+        assert await remaining_timestamps() == []
@@ -0,0 +1,106 @@
+import shutil
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from waterbowl.burst import (
+    BurstCapture,
+    FrameScore,
+    best_frame,
+    greyscale,
+    occlusion,
+    sharpness,
+)
+from waterbowl.camera_service import AbstractCameraService, MockPersistentCameraService
+
+
+class PreparedCameraService(AbstractCameraService):
+    """
+    Takes the given pictures, in order.
+    """
+
+    def __init__(self, pictures: list[Path]):
+        self.pictures = iter(pictures)
+
+    async def take_picture(self, filepath: Path) -> Path:
+        shutil.copy(next(self.pictures), filepath)
+        return filepath
+
+
+@pytest.fixture
+def burst_pictures(test_picture: Path, mock_local_storage_dir: Path) -> dict[str, Path]:
+    pictures = {"sharp": test_picture}
+    with Image.open(test_picture) as image:
+        blurred = mock_local_storage_dir.joinpath("blurred.jpg")
+        image.filter(ImageFilter.GaussianBlur(4)).save(blurred)
+        pictures["blurred"] = blurred
+        occluded = mock_local_storage_dir.joinpath("occluded.jpg")
+        width, height = image.size
+        ImageDraw.Draw(image).rectangle((0, 0, width // 2, height), fill=(20, 20, 20))
+        image.save(occluded)
+        pictures["occluded"] = occluded
+    yield pictures
+
+
+def test_blur_lowers_sharpness(burst_pictures: dict[str, Path]):
+    sharp = sharpness(greyscale(burst_pictures["sharp"]))
+    assert sharpness(greyscale(burst_pictures["blurred"])) < sharp / 2
+
+
+def test_something_in_the_way_raises_occlusion(burst_pictures: dict[str, Path]):
+    reference = greyscale(burst_pictures["sharp"])
+    blurred = occlusion(greyscale(burst_pictures["blurred"]), reference)
+    assert occlusion(greyscale(burst_pictures["occluded"]), reference) > blurred * 4
+
+
+def test_best_frame_prefers_unblocked_then_sharp():
+    scores = [
+        FrameScore(sharpness=90, occlusion=30, pixels=None),
+        FrameScore(sharpness=10, occlusion=1, pixels=None),
+        FrameScore(sharpness=50, occlusion=2, pixels=None),
+    ]
+    assert best_frame(scores, occlusion_tolerance=2) == 2
+    assert best_frame(scores, occlusion_tolerance=0) == 1
+    assert best_frame(scores, occlusion_tolerance=50) == 0
+    # Without a reference, only sharpness counts
+    unreferenced = [FrameScore(sharpness, None, None) for sharpness in (5, 7, 6)]
+    assert best_frame(unreferenced, occlusion_tolerance=0) == 1
+
+
+@pytest.mark.asyncio
+async def test_burst_keeps_best_frame(
+    burst_pictures: dict[str, Path], mock_local_storage_dir: Path
+):
+    camera = PreparedCameraService(
+        [burst_pictures[name] for name in ("blurred", "occluded", "sharp", "blurred")]
+    )
+    burst_capture = BurstCapture(
+        frames=4, budget=5, reference_picture=burst_pictures["sharp"]
+    )
+    output = mock_local_storage_dir.joinpath("picture.jpg")
+    try:
+        metadata = await burst_capture.take_picture(camera, output)
+    finally:
+        burst_capture.close()
+
+    assert metadata["burst"]["frames"] == 4
+    assert metadata["burst"]["chosen"] == 2
+    assert output.read_bytes() == burst_pictures["sharp"].read_bytes()
+    # The burst's other frames are cleaned up
+    assert list(mock_local_storage_dir.glob("**/burst*.jpg")) == []
+
+
+@pytest.mark.asyncio
+async def test_burst_stays_within_budget(mock_local_storage_dir: Path):
+    camera = MockPersistentCameraService(frame_time=0.1)
+    burst_capture = BurstCapture(frames=10, budget=0.4, reference_picture=None)
+    output = mock_local_storage_dir.joinpath("picture.jpg")
+    try:
+        metadata = await burst_capture.take_picture(camera, output)
+    finally:
+        burst_capture.close()
+
+    # A fourth frame wouldn't be done in time
+    assert metadata["burst"]["frames"] == 3
+    assert output.exists()
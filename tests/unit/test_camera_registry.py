@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from waterbowl.camera_registry import (
+    CameraConfig,
+    CameraRegistry,
+    camera_registry,
+    default_camera,
+)
+from waterbowl.camera_service import MockCameraService, MockPersistentCameraService
+from waterbowl.enums import CameraBackends
+
+
+@pytest.fixture
+def cameras_file(mock_local_storage_dir: Path) -> Path:
+    cameras_file = mock_local_storage_dir.joinpath("cameras.json")
+    cameras_file.write_text(
+        json.dumps(
+            [
+                {"id": "water", "water_level": True},
+                {
+                    "id": "food",
+                    "backend": "oneshot",
+                    "options": ["--camera", "1"],
+                    "interval": "5m",
+                    "crop": [0, 0, 100, 100],
+                    "quality": 70,
+                },
+            ]
+        )
+    )
+    yield cameras_file
+
+
+def test_cameras_from_file(cameras_file: Path):
+    registry = camera_registry(cameras_file)
+    assert registry.camera_ids == ["water", "food"]
+    assert registry["water"].water_level
+    food = registry["food"]
+    assert food.backend == CameraBackends.ONESHOT
+    assert food.interval == 300
+    assert food.transform.crop == (0, 0, 100, 100)
+    assert food.transform.quality == 70
+    camera_service = food.camera_service()
+    assert isinstance(camera_service, MockCameraService)
+    assert not isinstance(camera_service, MockPersistentCameraService)
+    assert camera_service.options == ["--camera", "1"]
+
+
+def test_one_camera_without_file():
+    with mock.patch("waterbowl.camera_registry.CAMERA_ID", "bowl"):
+        registry = camera_registry(None)
+    assert registry.camera_ids == ["bowl"]
+    assert not registry["bowl"].water_level
+
+
+@pytest.mark.parametrize(
+    "cameras",
+    [
+        [],
+        [{"id": "water"}, {"id": "water"}],
+        [{"id": "../water"}],
+        [{"id": "water", "backend": "webcam"}],
+        [{"id": "water", "colour": "blue"}],
+        {"id": "water"},
+    ],
+)
+def test_invalid_cameras(mock_local_storage_dir: Path, cameras):
+    cameras_file = mock_local_storage_dir.joinpath("cameras.json")
+    cameras_file.write_text(json.dumps(cameras))
+    with pytest.raises(ValueError):
+        CameraRegistry.from_file(cameras_file)
+
+
+def test_default_camera_estimates_water_level_when_configured():
+    with mock.patch("waterbowl.camera_registry.WATER_LEVEL_ROI", (0, 0, 10, 10)):
+        assert default_camera().water_level
+    assert not CameraConfig("bowl").water_level
@@ -1,4 +1,6 @@
 import shutil
+import sys
+import time
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from unittest import mock
@@ -7,35 +9,65 @@ import pytest
 
 from waterbowl.camera_service import (
     camera_service_factory,
+    run_capture_command,
+    CameraCaptureError,
     MockCameraService,
+    MockPersistentCameraService,
     CameraService,
+    PersistentCameraService,
 )
-from waterbowl.enums import Environments
+from waterbowl.enums import CameraBackends, Environments
+
+# Stands in for libcamera-still --keypress: writes the test image to the numbered
+# output file every time enter is pressed and exits on x
+FAKE_LIBCAMERA_STILL = """
+import shutil, sys
+output, picture = sys.argv[sys.argv.index("-o") + 1], sys.argv[1]
+frame_number = 0
+for line in sys.stdin:
+    if line.strip() == "x":
+        break
+    shutil.copyfile(picture, output % frame_number)
+    frame_number += 1
+"""
 
 
 @pytest.fixture
-def mock_take_picture_sync(test_picture: Path):
+def mock_run_capture_command(test_picture: Path):
     picture = test_picture
 
-    def _mock(command: list[str]):
+    async def _mock(command: list[str]):
         shutil.copy(picture, command[2])
 
-    with mock.patch("waterbowl.camera_service.take_picture_sync", _mock):
+    with mock.patch("waterbowl.camera_service.run_capture_command", _mock):
         yield
 
 
-@pytest.mark.parametrize("environment", [Environments.PROD, Environments.DEV])
-def test_factory(environment):
+@pytest.fixture
+def fake_libcamera_still(test_picture: Path) -> list[str]:
+    with TemporaryDirectory() as tmp_dir:
+        script = Path(tmp_dir).joinpath("libcamera_still.py")
+        script.write_text(FAKE_LIBCAMERA_STILL)
+        yield [sys.executable, str(script), str(test_picture)]
+
+
+@pytest.mark.parametrize(
+    "environment,backend,expected",
+    [
+        (Environments.PROD, CameraBackends.ONESHOT, CameraService),
+        (Environments.PROD, CameraBackends.PERSISTENT, PersistentCameraService),
+        (Environments.DEV, CameraBackends.ONESHOT, MockCameraService),
+        (Environments.DEV, CameraBackends.PERSISTENT, MockPersistentCameraService),
+    ],
+)
+def test_factory(environment, backend, expected):
     with mock.patch("waterbowl.camera_service.ENVIRONMENT", environment):
-        camera_service = camera_service_factory()
-        if environment == Environments.PROD:
-            assert camera_service == CameraService
-        else:
-            assert camera_service == MockCameraService
+        with mock.patch("waterbowl.camera_service.CAMERA_BACKEND", backend):
+            assert camera_service_factory() == expected
 
 
 @pytest.mark.asyncio
-@pytest.mark.usefixtures("mock_take_picture_sync")
+@pytest.mark.usefixtures("mock_run_capture_command")
 async def test_take_picture_fails_on_existing_path(test_picture: Path):
     camera_service = CameraService()
     with pytest.raises(FileExistsError):
@@ -43,9 +75,90 @@ async def test_take_picture_fails_on_existing_path(test_picture: Path):
 
 
 @pytest.mark.asyncio
-@pytest.mark.usefixtures("mock_take_picture_sync")
+@pytest.mark.usefixtures("mock_run_capture_command")
 async def test_take_picture():
     with TemporaryDirectory() as tmp_dir:
         camera_service = CameraService()
         new_file = await camera_service.take_picture(Path(tmp_dir).joinpath("new_file"))
         assert new_file.exists()
+
+
+@pytest.mark.asyncio
+async def test_persistent_camera_takes_pictures(
+    fake_libcamera_still: list[str], test_picture: Path
+):
+    with mock.patch.object(
+        PersistentCameraService, "picture_command", fake_libcamera_still
+    ):
+        with TemporaryDirectory() as tmp_dir:
+            async with PersistentCameraService(
+                capture_timeout=5, capture_dir=Path(tmp_dir)
+            ) as camera_service:
+                # Frames are spooled in the capture directory, and renamed into
+                # place rather than copied
+                assert Path(camera_service._spool_dir.name).parent == Path(tmp_dir)
+                for index in range(3):
+                    new_file = await camera_service.take_picture(
+                        Path(tmp_dir).joinpath(f"{index}.jpg")
+                    )
+                    assert new_file.read_bytes() == test_picture.read_bytes()
+                process = camera_service._process
+            assert process.returncode == 0
+            assert not camera_service.running
+
+
+@pytest.mark.asyncio
+async def test_persistent_camera_restarts_after_timeout():
+    with mock.patch.object(PersistentCameraService, "picture_command", ["sleep", "10"]):
+        with TemporaryDirectory() as tmp_dir:
+            async with PersistentCameraService(capture_timeout=0.1) as camera_service:
+                with pytest.raises(CameraCaptureError):
+                    await camera_service.take_picture(Path(tmp_dir).joinpath("new"))
+                assert not camera_service.running
+
+
+@pytest.mark.asyncio
+async def test_mock_cameras_cost_model():
+    with TemporaryDirectory() as tmp_dir:
+        cold_camera = MockCameraService(startup_time=0.05, frame_time=0.01)
+        warm_camera = MockPersistentCameraService(startup_time=0.05, frame_time=0.01)
+        async with warm_camera:
+            for camera_service in (cold_camera, warm_camera):
+                start = time.monotonic()
+                for index in range(4):
+                    await camera_service.take_picture(
+                        Path(tmp_dir).joinpath(
+                            f"{type(camera_service).__name__}{index}"
+                        )
+                    )
+                camera_service.elapsed = time.monotonic() - start
+    assert cold_camera.elapsed >= 0.24
+    assert warm_camera.elapsed < 0.2
+
+
+@pytest.mark.asyncio
+async def test_run_capture_command_does_not_busy_wait():
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    await run_capture_command(["sleep", "2"])
+    assert time.monotonic() - wall_start >= 2
+    assert time.process_time() - cpu_start < 0.2
+
+
+@pytest.mark.asyncio
+async def test_run_capture_command_kills_on_timeout():
+    start = time.monotonic()
+    with pytest.raises(CameraCaptureError):
+        await run_capture_command(["sleep", "10"], timeout=0.1)
+    assert time.monotonic() - start < 5
+
+
+@pytest.mark.asyncio
+async def test_run_capture_command_logs_failure(caplog):
+    with pytest.raises(CameraCaptureError):
+        await run_capture_command(
+            [sys.executable, "-c", "import sys; sys.exit('no camera found')"]
+        )
+    failure = caplog.records[-1]
+    assert failure.return_code == 1
+    assert failure.stderr == ["no camera found"]
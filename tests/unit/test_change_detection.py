@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageDraw
+
+from waterbowl.change_detection import (
+    ChangeDetector,
+    picture_thumbnail,
+    thumbnail_difference,
+)
+
+
+@pytest.fixture
+def changed_picture(test_picture: Path, mock_local_storage_dir: Path) -> Path:
+    changed_file = mock_local_storage_dir.joinpath("changed.jpg")
+    with Image.open(test_picture) as image:
+        width, height = image.size
+        ImageDraw.Draw(image).rectangle(
+            (width // 3, height // 3, width * 2 // 3, height * 2 // 3), fill="white"
+        )
+        image.save(changed_file)
+    yield changed_file
+
+
+@pytest.fixture
+def recompressed_picture(test_picture: Path, mock_local_storage_dir: Path) -> Path:
+    recompressed_file = mock_local_storage_dir.joinpath("recompressed.jpg")
+    with Image.open(test_picture) as image:
+        image.save(recompressed_file, quality=60)
+    yield recompressed_file
+
+
+def test_thumbnail_difference(
+    test_picture: Path, recompressed_picture: Path, changed_picture: Path
+):
+    thumbnail = picture_thumbnail(test_picture)
+    assert thumbnail.size == (32, 24)
+    assert thumbnail_difference(thumbnail, picture_thumbnail(test_picture)) == 0
+    assert thumbnail_difference(thumbnail, picture_thumbnail(recompressed_picture)) < 1
+    assert thumbnail_difference(thumbnail, picture_thumbnail(changed_picture)) > 5
+
+
+@pytest.mark.asyncio
+async def test_change_detector(test_picture: Path, changed_picture: Path):
+    change_detector = ChangeDetector(threshold=2)
+    first_thumbnail = await change_detector.thumbnail(test_picture)
+    assert not change_detector.unchanged(first_thumbnail)
+    change_detector.remember(first_thumbnail, "first_id")
+
+    assert change_detector.unchanged(await change_detector.thumbnail(test_picture))
+    assert not change_detector.unchanged(
+        await change_detector.thumbnail(changed_picture)
+    )
+
+
+def test_change_detector_max_skipped():
+    thumbnail = Image.new("L", (32, 24))
+    change_detector = ChangeDetector(threshold=0, max_skipped=2)
+    change_detector.remember(thumbnail, "first_id")
+    for _ in range(2):
+        assert change_detector.unchanged(thumbnail)
+        change_detector.skip()
+    assert not change_detector.unchanged(thumbnail)
+    change_detector.remember(thumbnail, "second_id")
+    assert change_detector.unchanged(thumbnail)
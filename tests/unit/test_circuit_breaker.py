@@ -0,0 +1,200 @@
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+from tests.stand_in_api import StandInApi
+from waterbowl.api_service import ApiException, ApiService, ApiUnavailable
+from waterbowl.circuit_breaker import CircuitBreaker
+from waterbowl.enums import BreakerStates
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    yield FakeClock()
+
+
+@pytest.fixture
+def breaker(clock: FakeClock) -> CircuitBreaker:
+    # Always wait the full backoff, so the tests know when the breaker half opens
+    yield CircuitBreaker(
+        failure_threshold=3,
+        base_backoff=10,
+        max_backoff=25,
+        clock=clock,
+        uniform=lambda low, high: high,
+    )
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures_in_a_row(self, breaker: CircuitBreaker):
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.state == BreakerStates.CLOSED
+        breaker.record_failure()
+        assert breaker.state == BreakerStates.OPEN
+        assert breaker.retry_in == 10
+
+    def test_half_opens_after_backoff(self, breaker: CircuitBreaker, clock: FakeClock):
+        for _ in range(3):
+            breaker.record_failure()
+        clock.now += 9.9
+        assert breaker.state == BreakerStates.OPEN
+        clock.now += 0.1
+        assert breaker.state == BreakerStates.HALF_OPEN
+        assert breaker.retry_in == 0
+
+    def test_backoff_doubles_up_to_max(self, breaker: CircuitBreaker, clock: FakeClock):
+        for _ in range(3):
+            breaker.record_failure()
+        backoffs = []
+        for _ in range(3):
+            backoffs.append(breaker.retry_in)
+            clock.now += breaker.retry_in
+            assert breaker.state == BreakerStates.HALF_OPEN
+            # A single failure while half open reopens the breaker
+            breaker.record_failure()
+            assert breaker.state == BreakerStates.OPEN
+        assert backoffs == [10, 20, 25]
+
+    def test_closes_on_success(self, breaker: CircuitBreaker, clock: FakeClock):
+        for _ in range(3):
+            breaker.record_failure()
+        clock.now += 10
+        breaker.record_success()
+        assert breaker.state == BreakerStates.CLOSED
+        # And the backoff starts again from the beginning
+        for _ in range(3):
+            breaker.record_failure()
+        assert breaker.retry_in == 10
+
+    def test_failures_while_open_do_not_extend_backoff(self, breaker: CircuitBreaker):
+        for _ in range(5):
+            breaker.record_failure()
+        assert breaker.retry_in == 10
+
+    def test_backoff_is_jittered(self, clock: FakeClock):
+        breaker = CircuitBreaker(
+            failure_threshold=1,
+            base_backoff=10,
+            max_backoff=10,
+            clock=clock,
+            uniform=lambda low, high: low,
+        )
+        breaker.record_failure()
+        assert breaker.retry_in == 5
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            {"failure_threshold": 0},
+            {"base_backoff": 0},
+            {"base_backoff": 20, "max_backoff": 10},
+        ],
+    )
+    def test_invalid_settings(self, kwargs):
+        with pytest.raises(ValueError):
+            CircuitBreaker(**kwargs)
+
+
+@pytest.fixture
+def stand_in_api() -> StandInApi:
+    yield StandInApi()
+
+
+@pytest_asyncio.fixture
+async def api_service(
+    aiohttp_server, stand_in_api: StandInApi, breaker: CircuitBreaker
+) -> ApiService:
+    server = await aiohttp_server(stand_in_api.app)
+    async with ApiService(
+        base_url=str(server.make_url("")).rstrip("/"), breaker=breaker
+    ) as api_service:
+        yield api_service
+
+
+@pytest.mark.asyncio
+class TestApiServiceBreaker:
+    async def test_no_health_checks_while_healthy(
+        self, api_service: ApiService, stand_in_api: StandInApi, test_picture: Path
+    ):
+        for _ in range(3):
+            assert await api_service.available()
+            await api_service.send_picture(timestamp=1.1, picture=test_picture)
+
+        assert stand_in_api.round_trips == {"create_picture": 3}
+        assert api_service.breaker_state == BreakerStates.CLOSED
+
+    async def test_fails_fast_while_open(
+        self, api_service: ApiService, stand_in_api: StandInApi, test_picture: Path
+    ):
+        stand_in_api.fail_with = 503
+        for _ in range(3):
+            with pytest.raises(ApiException) as error:
+                await api_service.send_picture(timestamp=1.1, picture=test_picture)
+            assert error.value.status == 503
+        assert api_service.breaker_state == BreakerStates.OPEN
+
+        assert not await api_service.available()
+        with pytest.raises(ApiUnavailable):
+            await api_service.send_picture(timestamp=1.1, picture=test_picture)
+        with pytest.raises(ApiUnavailable):
+            await api_service.update_picture("picture_id", {"some": "data"})
+        assert stand_in_api.failed_requests == {"/pictures/": 3}
+
+    async def test_health_checked_when_half_open(
+        self,
+        api_service: ApiService,
+        stand_in_api: StandInApi,
+        clock: FakeClock,
+        test_picture: Path,
+    ):
+        stand_in_api.fail_with = 500
+        for _ in range(3):
+            with pytest.raises(ApiException):
+                await api_service.send_picture(timestamp=1.1, picture=test_picture)
+
+        # Still failing, only the health check is sent and the breaker reopens
+        clock.now += 10
+        assert api_service.breaker_state == BreakerStates.HALF_OPEN
+        with pytest.raises(ApiUnavailable):
+            await api_service.send_picture(timestamp=1.1, picture=test_picture)
+        assert stand_in_api.failed_requests == {"/pictures/": 3, "/health": 1}
+        assert api_service.breaker_state == BreakerStates.OPEN
+        assert api_service.breaker.retry_in == 20
+
+        # Back up, the health check passes and the upload goes ahead
+        stand_in_api.fail_with = None
+        clock.now += 20
+        await api_service.send_picture(timestamp=1.1, picture=test_picture)
+        assert stand_in_api.round_trips == {"health": 1, "create_picture": 1}
+        assert api_service.breaker_state == BreakerStates.CLOSED
+
+    async def test_rejected_requests_do_not_open(self, api_service: ApiService):
+        for _ in range(5):
+            with pytest.raises(ApiException) as error:
+                await api_service.update_picture("missing", {"some": "data"})
+            assert error.value.status == 404
+
+        assert api_service.breaker_state == BreakerStates.CLOSED
+
+    async def test_unreachable_api_opens(self, breaker: CircuitBreaker):
+        async with ApiService(
+            base_url="http://127.0.0.1:9", breaker=breaker
+        ) as api_service:
+            for _ in range(3):
+                with pytest.raises(Exception):
+                    await api_service.update_picture("picture_id", {"some": "data"})
+
+            assert api_service.breaker_state == BreakerStates.OPEN
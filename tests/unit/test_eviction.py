@@ -0,0 +1,73 @@
+import pytest
+
+from waterbowl.enums import EvictionPolicies
+from waterbowl.eviction import (
+    CacheRecord,
+    KeepEveryNth,
+    KeepLatestPerHour,
+    OldestFirst,
+    eviction_policy_factory,
+)
+from waterbowl.storage_queue import StorageQueue
+
+# One picture every 10 minutes for 4 hours
+RECORDS = [CacheRecord(index, index * 600.0, 100) for index in range(24)]
+
+
+def test_oldest_first():
+    assert OldestFirst().select(RECORDS, excess_entries=3, excess_bytes=0) == [0, 1, 2]
+    assert OldestFirst().select(RECORDS, excess_entries=0, excess_bytes=250) == [
+        0,
+        1,
+        2,
+    ]
+    assert OldestFirst().select(RECORDS, excess_entries=0, excess_bytes=0) == []
+
+
+@pytest.mark.asyncio
+async def test_keep_every_nth_thins_the_queue_evenly(tmp_path):
+    queue = StorageQueue(
+        tmp_path.joinpath("queue.sqlite3"),
+        max_entries=30,
+        eviction_policy=KeepEveryNth(n=3, recent_seconds=10 * 60),
+    )
+    # A picture a minute for an hour, evicting one picture at a time once full
+    for index in range(60):
+        await queue.enqueue(index * 60.0, f"{index}.jpg", 0)
+    minutes = [int(timestamp) // 60 for _, timestamp, _ in await queue.read()]
+    await queue.close()
+
+    assert len(minutes) == 30
+    # The last 10 minutes are all kept
+    assert minutes[-11:] == list(range(49, 60))
+    # Older pictures are kept every third minute, from the start of the hour
+    thinned = [minute for minute in minutes if minute % 3 == 2 and minute < 45]
+    assert thinned == minutes[: len(thinned)]
+    assert thinned == list(range(2, 45, 3))
+
+
+def test_keep_every_nth_thins_further():
+    policy = KeepEveryNth(n=3, recent_seconds=60 * 60)
+    # Pictures 0 to 16 are more than an hour older than the newest picture, once
+    # every third of them is all that's left, every ninth is kept
+    evicted = policy.select(RECORDS, excess_entries=14, excess_bytes=0)
+    assert evicted[-2:] == [3, 6]
+    assert not {9, 12, 15} & set(evicted)
+
+
+def test_keep_latest_per_hour():
+    evicted = KeepLatestPerHour().select(RECORDS, excess_entries=20, excess_bytes=0)
+    assert sorted(set(range(24)) - set(evicted)) == [5, 11, 17, 23]
+
+
+@pytest.mark.parametrize(
+    "policy,expected",
+    [
+        (EvictionPolicies.OLDEST_FIRST, OldestFirst),
+        (EvictionPolicies.EVERY_NTH, KeepEveryNth),
+        (EvictionPolicies.LATEST_PER_HOUR, KeepLatestPerHour),
+        ("unknown", OldestFirst),
+    ],
+)
+def test_eviction_policy_factory(policy, expected):
+    assert isinstance(eviction_policy_factory(policy), expected)
@@ -0,0 +1,82 @@
+import errno
+import os
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from waterbowl.file_io import delete_files, delete_matching, move_file, run_io
+
+
+@pytest.mark.asyncio
+async def test_move_file(test_picture, mock_local_storage_dir):
+    destination = mock_local_storage_dir.joinpath("moved.jpg")
+    size = test_picture.stat().st_size
+
+    assert await run_io(move_file, test_picture, destination) == size
+
+    assert not test_picture.exists()
+    assert destination.stat().st_size == size
+
+
+def test_move_file_across_filesystems(test_picture, mock_local_storage_dir):
+    storage_dir = mock_local_storage_dir.joinpath("storage")
+    storage_dir.mkdir()
+    destination = storage_dir.joinpath("moved.jpg")
+    contents = test_picture.read_bytes()
+    replace = os.replace
+
+    def replace_within_filesystem(source: Path, target: Path) -> None:
+        if Path(source).parent != Path(target).parent:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(source, target)
+
+    with mock.patch("os.replace", side_effect=replace_within_filesystem) as rename:
+        move_file(test_picture, destination)
+
+    # Copied under a temporary name, then renamed into place
+    assert rename.call_count == 2
+    assert not test_picture.exists()
+    assert destination.read_bytes() == contents
+    assert [file.name for file in storage_dir.iterdir()] == ["moved.jpg"]
+
+
+def test_delete_files(mock_local_storage_dir):
+    pictures = [mock_local_storage_dir.joinpath(f"{index}.jpg") for index in range(3)]
+    for picture in pictures[:2]:
+        picture.touch()
+    kept = mock_local_storage_dir.joinpath("queue.sqlite3")
+    kept.touch()
+
+    assert delete_files(pictures) == 2
+    pictures[0].touch()
+    assert delete_matching(mock_local_storage_dir, "*.jpg") == 1
+
+    assert list(mock_local_storage_dir.iterdir()) == [kept]
+
+
+def test_durable_move_syncs_before_renaming(test_picture, mock_local_storage_dir):
+    storage_dir = mock_local_storage_dir.joinpath("storage")
+    storage_dir.mkdir()
+    destination = storage_dir.joinpath("moved.jpg")
+    replace = os.replace
+    synced = []
+
+    def replace_within_filesystem(source: Path, target: Path) -> None:
+        if Path(source).parent != Path(target).parent:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(source, target)
+
+    def fsync(path: Path) -> None:
+        synced.append((path, destination.exists()))
+
+    with mock.patch("os.replace", side_effect=replace_within_filesystem), mock.patch(
+        "waterbowl.file_io._fsync", side_effect=fsync
+    ):
+        move_file(test_picture, destination, durable=True)
+
+    # The copy is on disk before it's renamed into place, then the rename is
+    assert synced == [
+        (storage_dir.joinpath(".moved.jpg.partial"), False),
+        (storage_dir, True),
+    ]
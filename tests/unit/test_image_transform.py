@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from waterbowl.image_transform import (
+    ImageTransformer,
+    TransformSettings,
+    transform_picture,
+)
+
+
+def test_settings_enabled():
+    assert not TransformSettings(crop=None, max_size=None, quality=None).enabled
+    assert TransformSettings(crop=None, max_size=None, quality=80).enabled
+
+
+def test_transform_picture(test_picture: Path):
+    original_bytes = test_picture.stat().st_size
+    settings = TransformSettings(crop=(648, 486, 1944, 1458), max_size=(640, 480))
+    metadata = transform_picture(test_picture, settings)
+
+    with Image.open(test_picture) as image:
+        assert image.size == (640, 480)
+    assert metadata["transform"]["original_size"] == [2592, 1944]
+    assert metadata["transform"]["size"] == [640, 480]
+    assert metadata["transform"]["crop"] == [648, 486, 1944, 1458]
+    assert metadata["transform"]["original_bytes"] == original_bytes
+    assert metadata["transform"]["bytes"] == test_picture.stat().st_size
+    assert test_picture.stat().st_size < original_bytes
+    assert list(test_picture.parent.glob("*.tmp")) == []
+
+
+def test_transform_picture_crop_only(test_picture: Path):
+    settings = TransformSettings(crop=(0, 0, 100, 50), max_size=None, quality=None)
+    transform_picture(test_picture, settings)
+    with Image.open(test_picture) as image:
+        assert image.size == (100, 50)
+
+
+def test_transform_picture_keeps_original_on_failure(
+    mock_local_storage_dir: Path,
+):
+    picture = mock_local_storage_dir.joinpath("broken.jpg")
+    picture.write_bytes(b"not really a jpeg")
+    with pytest.raises(Exception):
+        transform_picture(picture, TransformSettings(quality=50))
+    assert picture.read_bytes() == b"not really a jpeg"
+
+
+@pytest.mark.asyncio
+async def test_image_transformer(test_picture: Path):
+    image_transformer = ImageTransformer(
+        TransformSettings(crop=None, max_size=(320, 240), quality=70)
+    )
+    try:
+        metadata = await image_transformer.transform(test_picture)
+    finally:
+        image_transformer.close()
+    assert metadata["transform"]["size"] == [320, 240]
+    assert metadata["transform"]["quality"] == 70
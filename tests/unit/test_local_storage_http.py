@@ -0,0 +1,134 @@
+from pathlib import Path
+from typing import AsyncIterator
+from unittest import mock
+
+import aiohttp
+import pytest
+import pytest_asyncio
+
+from waterbowl.local_http_service import LocalHttpService
+from waterbowl.local_storage_http import add_local_storage_routes
+from waterbowl.local_storage_service import storage_queue
+
+# Pictures cached a minute apart, from the start of an hour
+START = 1_700_002_800.0
+
+
+@pytest.fixture
+def mock_local_storage(
+    mock_local_storage_dir: Path, mock_local_storage_db: Path, mock_local_storage_log
+) -> Path:
+    with mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DIR", mock_local_storage_dir
+    ), mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DB", mock_local_storage_db
+    ), mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_LOG", mock_local_storage_log
+    ):
+        yield mock_local_storage_dir
+
+
+@pytest_asyncio.fixture
+async def cached_pictures(mock_local_storage: Path, test_picture: Path) -> list[str]:
+    pictures = [f"camera_{START + index * 60}.jpg" for index in range(150)]
+    await (await storage_queue()).enqueue_many(
+        [(START + index * 60, picture, 0) for index, picture in enumerate(pictures)]
+    )
+    test_picture.rename(mock_local_storage.joinpath(pictures[0]))
+    yield pictures
+
+
+@pytest_asyncio.fixture
+async def local_storage_url() -> AsyncIterator[str]:
+    local_http_service = LocalHttpService(port=0)
+    add_local_storage_routes(local_http_service.app)
+    async with local_http_service:
+        yield f"http://{local_http_service.host}:{local_http_service.port}"
+
+
+@pytest.mark.asyncio
+async def test_pictures_in_time_range(local_storage_url, cached_pictures):
+    params = {"start": START + 600, "end": "2023-11-14T23:20:00+00:00", "limit": 3}
+    pictures = []
+    async with aiohttp.ClientSession() as session:
+        while True:
+            async with session.get(
+                f"{local_storage_url}/pictures", params=params
+            ) as resp:
+                assert resp.status == 200
+                page = await resp.json()
+            pictures.extend(picture["picture"] for picture in page["pictures"])
+            if page["next"] is None:
+                break
+            params["after"] = page["next"]
+
+    # 2023-11-14T23:20:00Z is START + 20 minutes
+    assert pictures == cached_pictures[10:20]
+    assert page["pictures"][-1]["url"] == f"/pictures/{cached_pictures[19]}"
+
+
+@pytest.mark.asyncio
+async def test_latest_pictures(local_storage_url, cached_pictures):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{local_storage_url}/pictures/latest", params={"count": 2}
+        ) as resp:
+            latest = (await resp.json())["pictures"]
+
+    assert [picture["picture"] for picture in latest] == cached_pictures[-2:]
+
+
+@pytest.mark.usefixtures("cached_pictures")
+@pytest.mark.asyncio
+async def test_pictures_by_hour(local_storage_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{local_storage_url}/pictures/hours") as resp:
+            hours = await resp.json()
+
+    assert hours == {
+        "hours": [
+            {"hour": START, "pictures": 60},
+            {"hour": START + 3600, "pictures": 60},
+            {"hour": START + 7200, "pictures": 30},
+        ]
+    }
+
+
+@pytest.mark.asyncio
+async def test_picture_served_in_ranges(
+    local_storage_url, cached_pictures, mock_local_storage_dir
+):
+    contents = mock_local_storage_dir.joinpath(cached_pictures[0]).read_bytes()
+    url = f"{local_storage_url}/pictures/{cached_pictures[0]}"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            assert resp.status == 200
+            assert resp.headers["Content-Type"] == "image/jpeg"
+            assert resp.headers["Accept-Ranges"] == "bytes"
+            assert await resp.read() == contents
+        async with session.get(url, headers={"Range": "bytes=100-199"}) as resp:
+            assert resp.status == 206
+            assert await resp.read() == contents[100:200]
+        async with session.get(url, headers={"Range": "bytes=-50"}) as resp:
+            assert resp.status == 206
+            assert await resp.read() == contents[-50:]
+
+
+@pytest.mark.parametrize(
+    "path, status",
+    [
+        ("/pictures/missing.jpg", 404),
+        ("/pictures/.partial.jpg", 404),
+        ("/pictures/queue.sqlite3", 404),
+        ("/pictures?start=yesterday", 400),
+        ("/pictures?limit=0", 400),
+        ("/pictures?after=1.0", 400),
+        ("/pictures/latest?count=many", 400),
+    ],
+)
+@pytest.mark.usefixtures("cached_pictures")
+@pytest.mark.asyncio
+async def test_bad_requests(local_storage_url, path, status):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{local_storage_url}{path}") as resp:
+            assert resp.status == status
@@ -1,9 +1,18 @@
+import asyncio
+import os
 import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Any, AsyncIterator, Awaitable, Callable
 from unittest import mock
 
-import aiofiles
 import pytest
 import pytest_asyncio
 
@@ -12,16 +21,82 @@ from waterbowl.local_storage_service import (
     read_storage_log,
     save_to_storage_log,
     clear_local_storage,
+    acknowledge_log_entry,
+    acknowledge_log_entries,
+    newest_log_entries,
+    oldest_log_entries,
+    read_storage_log_between,
+    storage_queue,
 )
+from waterbowl.storage_queue import StorageQueue
 
+# Enqueues entries as fast as it can until it's killed
+ENQUEUE_FOREVER = """
+import asyncio, sys
+from pathlib import Path
+from waterbowl.storage_queue import StorageQueue
 
-@pytest_asyncio.fixture
-def local_file_entries(test_picture) -> list[LogEntry]:
-    yield [
-        LogEntry(f"1.1,{test_picture}"),
-        LogEntry(f"1.2,{test_picture}"),
-        LogEntry(f"1.3,{test_picture}"),
-    ]
+async def main():
+    queue = StorageQueue(Path(sys.argv[1]))
+    index = 0
+    while True:
+        await queue.enqueue_many([(float(index + i), f"{index + i}.jpg", 0) for i in range(10)])
+        index += 10
+        if index == 10:
+            print("started", flush=True)
+
+asyncio.run(main())
+"""
+
+# A week and more offline, a picture a minute from the start of an hour
+LARGE_QUEUE = 100_000
+START = 1_700_002_800.0
+
+# How long renaming, deleting or syncing a file can take on a busy SD card
+SLOW_FILE_OPERATION = 0.01
+# How much later than asked for the event loop may wake while storage calls run,
+# leaving out the odd late wake up. Even idle, a busy machine now and then wakes
+# the loop later than a blocking file operation would, and on a single CPU the
+# kernel's work syncing files to disk holds it up too, so blocking operations are
+# caught on the loop themselves.
+MAX_LOOP_LAG = 0.005
+
+
+def slow(operation: Callable[..., Any], calls_on_loop: list[str]) -> Callable[..., Any]:
+    def slow_operation(*args: Any, **kwargs: Any) -> Any:
+        if threading.current_thread() is threading.main_thread():
+            calls_on_loop.append(operation.__name__)
+        time.sleep(SLOW_FILE_OPERATION)
+        return operation(*args, **kwargs)
+
+    return slow_operation
+
+
+@asynccontextmanager
+async def loop_lag_monitor(interval: float = 0.001) -> AsyncIterator[list[float]]:
+    """
+    Records how much later than asked for a task sleeping ``interval`` at a time
+    wakes up, which is how long the loop was blocked by something else.
+    """
+    loop = asyncio.get_running_loop()
+    lags: list[float] = []
+
+    async def monitor() -> None:
+        while True:
+            before = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - before - interval)
+
+    task = asyncio.create_task(monitor())
+    await asyncio.sleep(0)
+    try:
+        yield lags
+        # Let the monitor wake once more, to see if the last call blocked
+        await asyncio.sleep(2 * interval)
+    finally:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
 
 
 @pytest_asyncio.fixture
@@ -31,57 +106,428 @@ def test_local_storage_dir() -> Path:
 
 
 @pytest_asyncio.fixture
-async def test_log_file(test_local_storage_dir, local_file_entries) -> Path:
-    log_file_location = test_local_storage_dir.joinpath("log.csv")
-    async with aiofiles.open(log_file_location, "w+") as log_file:
-        for log_entry in local_file_entries:
-            await log_file.write(f"{log_entry.timestamp},{log_entry.picture}\n")
-    yield log_file_location
+def test_log_file(test_local_storage_dir: Path) -> Path:
+    yield test_local_storage_dir.joinpath("log.csv")
+
+
+@pytest_asyncio.fixture
+def test_database(test_local_storage_dir: Path) -> Path:
+    yield test_local_storage_dir.joinpath("queue.sqlite3")
 
 
 @pytest_asyncio.fixture
-def mock_local_storage(test_local_storage_dir, test_log_file):
+def mock_local_storage(test_local_storage_dir, test_log_file, test_database):
     with mock.patch("waterbowl.local_storage_service.LOCAL_STORAGE_LOG", test_log_file):
         with mock.patch(
             "waterbowl.local_storage_service.LOCAL_STORAGE_DIR", test_local_storage_dir
         ):
-            yield
+            with mock.patch(
+                "waterbowl.local_storage_service.LOCAL_STORAGE_DB", test_database
+            ):
+                yield
+
+
+@pytest_asyncio.fixture
+async def local_file_entries(mock_local_storage, test_picture) -> list[LogEntry]:
+    entries = [
+        LogEntry(1.1, test_picture.name),
+        LogEntry(1.2, test_picture.name),
+        LogEntry(1.3, test_picture.name),
+    ]
+    await (await storage_queue()).enqueue_many(
+        [(entry.timestamp, entry.picture_name, 0) for entry in entries]
+    )
+    yield entries
 
 
 @pytest.mark.usefixtures("mock_local_storage")
 @pytest.mark.asyncio
 async def test_read_local_storage(local_file_entries):
-    async for log in read_storage_log():
-        assert log in local_file_entries
+    assert [log async for log in read_storage_log()] == local_file_entries
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_read_local_storage_in_pages(local_file_entries):
+    with mock.patch("waterbowl.local_storage_service.READ_PAGE_SIZE", 2):
+        with mock.patch.object(
+            StorageQueue, "read", side_effect=StorageQueue.read, autospec=True
+        ) as read:
+            assert [log async for log in read_storage_log()] == local_file_entries
+    assert read.call_count == 3
+
+
+def test_log_entry_is_compact(test_local_storage_dir):
+    entry = LogEntry(1.1, "picture.jpg", entry_id=1)
+
+    assert not hasattr(entry, "__dict__")
+    with mock.patch(
+        "waterbowl.local_storage_service.LOCAL_STORAGE_DIR", test_local_storage_dir
+    ):
+        assert entry.picture == test_local_storage_dir.joinpath("picture.jpg")
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_oldest_and_newest_log_entries():
+    await (await storage_queue()).enqueue_many(
+        [(float(index), f"{index}.jpg", 0) for index in range(10)]
+    )
+
+    assert await oldest_log_entries(3) == [
+        LogEntry(float(index), f"{index}.jpg") for index in range(3)
+    ]
+    assert await newest_log_entries(3) == [
+        LogEntry(float(index), f"{index}.jpg") for index in range(7, 10)
+    ]
+    assert len(await newest_log_entries(20)) == 10
 
 
 @pytest.mark.usefixtures("mock_local_storage")
 @pytest.mark.asyncio
-async def test_save_to_local_storage(test_log_file, test_picture):
+async def test_read_storage_log_between():
+    # Three pictures a second, so pages end part way through a timestamp
+    await (await storage_queue()).enqueue_many(
+        [(float(index // 3), f"{index}.jpg", 0) for index in range(30)]
+    )
+
+    with mock.patch("waterbowl.local_storage_service.READ_PAGE_SIZE", 2):
+        with mock.patch.object(
+            StorageQueue,
+            "read_between",
+            side_effect=StorageQueue.read_between,
+            autospec=True,
+        ) as read_between:
+            entries = [log async for log in read_storage_log_between(2.0, 5.0)]
+
+    assert entries == [
+        LogEntry(float(index // 3), f"{index}.jpg") for index in range(6, 15)
+    ]
+    assert read_between.call_count == 6
+    assert [log async for log in read_storage_log_between(20.0, 30.0)] == []
+
+
+@pytest.mark.usefixtures("mock_local_storage", "local_file_entries")
+@pytest.mark.asyncio
+async def test_save_to_local_storage(test_picture, test_local_storage_dir):
     with TemporaryDirectory() as tmp_dir:
-        test_picture_src = Path(tmp_dir).joinpath("test_image.jpg")
+        test_picture_src = Path(tmp_dir).joinpath("new_image.jpg")
         shutil.copy(test_picture, test_picture_src)
-        await save_to_storage_log(timestamp=1.4, picture=test_picture_src)
-        async with aiofiles.open(test_log_file, "r") as log_file:
-            entries = await log_file.readlines()
-        assert len(entries) == 4
-        assert entries[3] == f"1.4,{test_picture.name}\n"
+        new_location = await save_to_storage_log(
+            timestamp=1.4, picture=test_picture_src
+        )
 
+    assert new_location == test_local_storage_dir.joinpath("new_image.jpg")
+    assert new_location.exists()
+    entries = [log async for log in read_storage_log()]
+    assert len(entries) == 4
+    assert entries[3] == LogEntry(1.4, "new_image.jpg")
 
-@pytest.mark.usefixtures("mock_local_storage")
+
+@pytest.mark.usefixtures("mock_local_storage", "local_file_entries")
 @pytest.mark.asyncio
-async def test_clear_local_storage(test_log_file, test_picture, test_local_storage_dir):
+async def test_clear_local_storage(test_picture, test_local_storage_dir):
     test_picture_src = Path(test_local_storage_dir).joinpath("test_image.jpg")
     shutil.copy(test_picture, test_picture_src)
 
     assert len(list(test_local_storage_dir.glob("*.jpg"))) == 1
-    async with aiofiles.open(test_log_file, "r") as log_file:
-        entries = await log_file.readlines()
-    assert len(entries) == 3
+    assert await (await storage_queue()).count() == 3
 
     await clear_local_storage()
 
     assert len(list(test_local_storage_dir.glob("*.jpg"))) == 0
-    async with aiofiles.open(test_log_file, "r") as log_file:
-        entries = await log_file.readlines()
-    assert len(entries) == 0
+    assert await (await storage_queue()).count() == 0
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_acknowledge_log_entry(local_file_entries, test_local_storage_dir):
+    sent_picture = test_local_storage_dir.joinpath("sent.jpg")
+    sent_picture.touch()
+    await (await storage_queue()).enqueue(1.2, sent_picture.name)
+
+    await acknowledge_log_entry(LogEntry(1.2, sent_picture.name))
+
+    assert [log async for log in read_storage_log()] == local_file_entries
+    assert not sent_picture.exists()
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_acknowledge_log_entries(local_file_entries):
+    entries = [log async for log in read_storage_log()]
+    await acknowledge_log_entries(entries[:2])
+    assert [log async for log in read_storage_log()] == local_file_entries[2:]
+
+
+@pytest.mark.usefixtures("mock_local_storage", "test_database")
+@pytest.mark.asyncio
+async def test_csv_log_imported(test_log_file):
+    test_log_file.write_text("1.1,first.jpg\n1.2,second.jpg\n")
+
+    entries = [log async for log in read_storage_log()]
+
+    assert entries == [LogEntry(1.1, "first.jpg"), LogEntry(1.2, "second.jpg")]
+    assert not test_log_file.exists()
+    assert test_log_file.with_name("log.csv.imported").exists()
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_csv_log_with_truncated_line_imported(test_log_file):
+    # The last line was cut short by a power cut
+    test_log_file.write_text("1.1,first.jpg\nnot a time,second.jpg\n1.3,third.jpg\n17")
+
+    entries = [log async for log in read_storage_log()]
+
+    assert entries == [LogEntry(1.1, "first.jpg"), LogEntry(1.3, "third.jpg")]
+    assert not test_log_file.exists()
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_failed_csv_log_import_tried_again(test_log_file, test_picture):
+    test_log_file.write_text("1.1,first.jpg\n")
+
+    with mock.patch.object(
+        StorageQueue, "import_csv_log", side_effect=OSError("card removed")
+    ):
+        # The picture is still saved, without the old log
+        await save_to_storage_log(timestamp=1.2, picture=test_picture)
+    entries = [log async for log in read_storage_log()]
+
+    # The old log is imported on the next call, after the picture
+    assert entries == [LogEntry(1.2, test_picture.name), LogEntry(1.1, "first.jpg")]
+
+
+def test_queue_survives_being_killed_mid_write(test_database, root_dir):
+    process = subprocess.Popen(
+        [sys.executable, "-c", ENQUEUE_FOREVER, str(test_database)],
+        cwd=root_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert process.stdout.readline().strip() == "started"
+    time.sleep(0.2)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+    with sqlite3.connect(test_database) as connection:
+        assert connection.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    # Entries are only ever written in whole transactions of 10
+    assert count >= 10
+    assert count % 10 == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_usage_is_tracked(test_database):
+    queue = StorageQueue(test_database)
+    await queue.enqueue_many([(1.0, "1.jpg", 100), (2.0, "2.jpg", 200)])
+    assert await queue.usage() == (2, 300)
+    first, _ = await queue.read()
+    await queue.acknowledge([first[0]])
+    assert await queue.usage() == (1, 200)
+    await queue.close()
+
+    reopened = StorageQueue(test_database)
+    assert await reopened.usage() == (1, 200)
+    await reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_stays_within_budget(test_database):
+    queue = StorageQueue(
+        test_database, max_entries=5, max_bytes=350, eviction_headroom=0
+    )
+    evicted = []
+    for index in range(10):
+        evicted.extend(await queue.enqueue(float(index), f"{index}.jpg", 50))
+    assert await queue.usage() == (5, 250)
+    assert [picture for _, _, picture in await queue.read()] == [
+        f"{index}.jpg" for index in range(5, 10)
+    ]
+    assert evicted == [f"{index}.jpg" for index in range(5)]
+
+    evicted = await queue.enqueue(10.0, "10.jpg", 200)
+    assert evicted == ["5.jpg", "6.jpg"]
+    assert await queue.usage() == (4, 350)
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_evicts_with_headroom(test_database):
+    queue = StorageQueue(test_database, max_entries=100, eviction_headroom=0.05)
+    await queue.enqueue_many(
+        [(float(index), f"{index}.jpg", 0) for index in range(100)]
+    )
+    # Going over budget frees 5 entries more than needed
+    evicted = await queue.enqueue(100.0, "100.jpg", 0)
+    assert evicted == [f"{index}.jpg" for index in range(6)]
+    assert await queue.usage() == (95, 0)
+    # So the next few enqueues don't need to evict
+    for index in range(101, 106):
+        assert await queue.enqueue(float(index), f"{index}.jpg", 0) == []
+    assert len(await queue.enqueue(106.0, "106.jpg", 0)) == 6
+    await queue.close()
+
+
+@pytest.mark.usefixtures("mock_local_storage")
+@pytest.mark.asyncio
+async def test_save_to_local_storage_evicts_pictures(
+    test_picture, test_local_storage_dir
+):
+    with mock.patch("waterbowl.local_storage_service.LOCAL_STORAGE_MAX_ENTRIES", 3):
+        with TemporaryDirectory() as tmp_dir:
+            for index in range(5):
+                new_picture = Path(tmp_dir).joinpath(f"{index}.jpg")
+                shutil.copy(test_picture, new_picture)
+                await save_to_storage_log(timestamp=float(index), picture=new_picture)
+
+    assert sorted(file.name for file in test_local_storage_dir.glob("*.jpg")) == [
+        "2.jpg",
+        "3.jpg",
+        "4.jpg",
+    ]
+    assert [log.timestamp async for log in read_storage_log()] == [2.0, 3.0, 4.0]
+
+
+@pytest.mark.usefixtures("mock_local_storage", "short_gc_pauses")
+@pytest.mark.asyncio
+async def test_storage_calls_dont_block_the_loop(
+    test_picture, test_local_storage_dir, test_log_file
+):
+    with TemporaryDirectory() as tmp_dir:
+        new_pictures = []
+        for index in range(50):
+            new_picture = Path(tmp_dir).joinpath(f"{index}.jpg")
+            shutil.copy(test_picture, new_picture)
+            new_pictures.append(new_picture)
+        # A backlog of pictures left behind, for clearing local storage
+        for index in range(200):
+            test_local_storage_dir.joinpath(f"left-{index}.jpg").touch()
+        # And a storage log from a previous version, imported on first use
+        test_log_file.write_text(
+            "".join(f"{index}.0,left-{index}.jpg\n" for index in range(200))
+        )
+
+        calls_on_loop: list[str] = []
+        with mock.patch("os.unlink", slow(os.unlink, calls_on_loop)), mock.patch(
+            "os.replace", slow(os.replace, calls_on_loop)
+        ), mock.patch("os.rename", slow(os.rename, calls_on_loop)), mock.patch(
+            "os.fsync", slow(os.fsync, calls_on_loop)
+        ):
+            async with loop_lag_monitor() as lags:
+                for index, new_picture in enumerate(new_pictures):
+                    await save_to_storage_log(
+                        timestamp=float(index), picture=new_picture
+                    )
+                entries = [log async for log in read_storage_log()]
+                await acknowledge_log_entries(entries[:50])
+                await clear_local_storage()
+
+    assert calls_on_loop == []
+    assert lags
+    assert sorted(lags)[int(len(lags) * 0.95)] < MAX_LOOP_LAG
+    assert not list(test_local_storage_dir.glob("*.jpg"))
+    assert await (await storage_queue()).count() == 0
+
+
+@pytest_asyncio.fixture
+async def large_queue(test_database) -> StorageQueue:
+    queue = StorageQueue(test_database)
+    await queue.enqueue_many(
+        [(START + index * 60, f"{index}.jpg", 0) for index in range(LARGE_QUEUE)]
+    )
+    yield queue
+    await queue.close()
+
+
+async def query_steps(queue: StorageQueue, query: Awaitable[Any]) -> int:
+    """
+    How much work SQLite did for a query, in hundreds of virtual machine steps,
+    which unlike timing doesn't depend on how busy the machine is.
+    """
+    steps = 0
+
+    def count_steps() -> int:
+        nonlocal steps
+        steps += 1
+        return 0
+
+    connection = queue._connect()
+    connection.set_progress_handler(count_steps, 100)
+    try:
+        await query
+    finally:
+        connection.set_progress_handler(None, 100)
+    return steps
+
+
+@pytest.mark.asyncio
+async def test_large_queue_queries(large_queue):
+    # Hour n holds pictures 60n to 60n + 59, the last 40 pictures in hour 1666
+    hours = await large_queue.count_by_hour()
+    assert len(hours) == 1667
+    assert sum(entries for _, entries in hours) == LARGE_QUEUE
+    assert await large_queue.count_by_hour(START + 1665 * 3600) == [
+        (START + 1665 * 3600, 60),
+        (START + 1666 * 3600, 40),
+    ]
+
+    page = await large_queue.read_between(START + 90_000 * 60, START + 90_010 * 60)
+    assert [picture for _, _, picture in page] == [
+        f"{index}.jpg" for index in range(90_000, 90_010)
+    ]
+    newest = await large_queue.read_newest(limit=3)
+    assert [picture for _, _, picture in newest] == [
+        f"{index}.jpg" for index in range(LARGE_QUEUE - 3, LARGE_QUEUE)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_large_queue_queries_seek(large_queue):
+    # Queries deep into the queue take about as much work as at its start
+    last = START + LARGE_QUEUE * 60
+    first_page = await query_steps(large_queue, large_queue.read_between(START, last))
+    deep_page = await query_steps(
+        large_queue, large_queue.read_between(START, last, after=(last - 600, 99_990))
+    )
+    assert deep_page <= 2 * first_page
+    oldest = await query_steps(large_queue, large_queue.read(limit=50))
+    newest = await query_steps(large_queue, large_queue.read_newest(limit=50))
+    assert newest <= 2 * oldest + 1
+    first_hours = await query_steps(
+        large_queue, large_queue.count_by_hour(START, START + 7200)
+    )
+    last_hours = await query_steps(
+        large_queue, large_queue.count_by_hour(last - 7200, last)
+    )
+    assert last_hours <= 2 * first_hours + 1
+
+
+@pytest.mark.asyncio
+async def test_hourly_counts_follow_the_queue(test_database):
+    with sqlite3.connect(test_database) as connection:
+        # A queue from before the hourly counts were kept
+        connection.execute(
+            "CREATE TABLE entries (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " timestamp REAL NOT NULL, picture TEXT NOT NULL)"
+        )
+        connection.executemany(
+            "INSERT INTO entries (timestamp, picture) VALUES (?, ?)",
+            [(START + index * 600, f"{index}.jpg") for index in range(9)],
+        )
+    connection.close()
+
+    queue = StorageQueue(test_database)
+    assert await queue.count_by_hour() == [(START, 6), (START + 3600, 3)]
+
+    await queue.enqueue(START + 7200, "9.jpg")
+    first_hour = [entry_id for entry_id, _, _ in await queue.read(limit=6)]
+    await queue.acknowledge(first_hour)
+    assert await queue.count_by_hour() == [(START + 3600, 3), (START + 7200, 1)]
+
+    await queue.clear()
+    assert await queue.count_by_hour() == []
+    await queue.close()
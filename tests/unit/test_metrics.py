@@ -0,0 +1,180 @@
+import asyncio
+from functools import partial
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+import aiohttp
+import pytest
+
+from tests.stand_in_api import StandInApi
+from waterbowl.api_service import ApiService
+from waterbowl.camera_service import MockPersistentCameraService
+from waterbowl.circuit_breaker import CircuitBreaker
+from waterbowl.local_http_service import LocalHttpService
+from waterbowl.metrics import (
+    API_REQUEST_SECONDS,
+    CONTENT_TYPE,
+    REGISTRY,
+    UPLOADED_BYTES,
+    Registry,
+    metrics_handler,
+)
+from waterbowl.pipeline import CapturePipeline
+from waterbowl.run_waterbowl_watcher import capture_frame
+from waterbowl.scheduler import Scheduler
+
+
+@pytest.fixture
+def registry() -> Registry:
+    yield Registry(enabled=True)
+
+
+@pytest.fixture
+def metrics_enabled():
+    enabled = REGISTRY.enabled
+    REGISTRY.enabled = True
+    REGISTRY.reset()
+    yield REGISTRY
+    REGISTRY.reset()
+    REGISTRY.enabled = enabled
+
+
+def test_render_counter_and_gauge(registry: Registry):
+    counter = registry.counter("pictures", "Pictures taken")
+    gauge = registry.gauge("queue_depth", "Queue depth", ["queue"])
+    counter.inc()
+    counter.inc(2)
+    gauge.labels("up\\loads").set(3)
+    gauge.labels('ca"che').set(1.5)
+
+    assert registry.render() == (
+        "# HELP pictures Pictures taken\n"
+        "# TYPE pictures counter\n"
+        "pictures_total 3\n"
+        "# HELP queue_depth Queue depth\n"
+        "# TYPE queue_depth gauge\n"
+        'queue_depth{queue="up\\\\loads"} 3\n'
+        'queue_depth{queue="ca\\"che"} 1.5\n'
+    )
+
+
+def test_render_histogram(registry: Registry):
+    histogram = registry.histogram("latency", "Latency", buckets=[0.1, 1])
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_bucket{le="0.1"} 2',
+        'latency_bucket{le="1"} 3',
+        'latency_bucket{le="+Inf"} 4',
+        "latency_sum 5.65",
+        "latency_count 4",
+    ]
+
+
+def test_timer(registry: Registry):
+    histogram = registry.histogram("latency", "Latency")
+    with histogram.time():
+        pass
+    value = histogram.labels()
+    assert value.count == 1
+    assert 0 <= value.sum < 0.01
+
+
+def test_disabled_metrics_are_not_recorded():
+    registry = Registry(enabled=False)
+    counter = registry.counter("pictures", "Pictures taken")
+    histogram = registry.histogram("latency", "Latency", ["operation"])
+    counter.inc()
+    histogram.labels("upload").observe(1)
+    with histogram.labels("upload").time():
+        pass
+
+    assert registry.render() == (
+        "# HELP pictures Pictures taken\n"
+        "# TYPE pictures counter\n"
+        "# HELP latency Latency\n"
+        "# TYPE latency histogram\n"
+    )
+
+
+def test_wrong_labels(registry: Registry):
+    gauge = registry.gauge("queue_depth", "Queue depth", ["queue"])
+    with pytest.raises(ValueError):
+        gauge.labels("uploads", "cache")
+    with pytest.raises(ValueError):
+        registry.counter("queue_depth", "Queue depth")
+
+
+@pytest.mark.asyncio
+async def test_api_service_is_instrumented(
+    aiohttp_server, metrics_enabled: Registry, test_picture: Path
+):
+    stand_in_api = StandInApi()
+    server = await aiohttp_server(stand_in_api.app)
+    stand_in_api.fail_with = 503
+    async with ApiService(
+        base_url=str(server.make_url("")),
+        breaker=CircuitBreaker(failure_threshold=1),
+    ) as api_service:
+        with pytest.raises(Exception):
+            await api_service.update_picture("picture_id", {})
+    stand_in_api.fail_with = None
+    async with ApiService(base_url=str(server.make_url(""))) as api_service:
+        await api_service.send_picture(timestamp=1.1, picture=test_picture)
+
+    assert API_REQUEST_SECONDS.labels("send_picture").count == 1
+    assert UPLOADED_BYTES.labels().value == test_picture.stat().st_size
+    rendered = metrics_enabled.render()
+    failures = 'waterbowl_api_request_failures_total{operation="update_picture"} 1'
+    assert failures in rendered
+    assert 'waterbowl_breaker_state{state="closed"} 1' in rendered
+
+
+@pytest.mark.usefixtures("metrics_enabled")
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    local_http_service = LocalHttpService(port=0)
+    local_http_service.app.router.add_get("/metrics", metrics_handler)
+    async with local_http_service:
+        url = f"http://{local_http_service.host}:{local_http_service.port}/metrics"
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                assert resp.status == 200
+                assert resp.headers["Content-Type"] == CONTENT_TYPE
+                rendered = await resp.text()
+        assert "# TYPE waterbowl_capture_seconds histogram" in rendered
+    assert not local_http_service.running
+
+
+@pytest.mark.asyncio
+async def test_local_http_service_not_started_without_routes():
+    async with LocalHttpService(port=0) as local_http_service:
+        assert not local_http_service.running
+
+
+@pytest.mark.asyncio
+async def test_capture_metrics_are_per_camera(metrics_enabled: Registry):
+    water_level_estimator = MagicMock()
+    water_level_estimator.estimate = AsyncMock(return_value=0.4)
+    pipeline = CapturePipeline(
+        partial(
+            capture_frame,
+            MockPersistentCameraService(),
+            water_level_estimator=water_level_estimator,
+            camera_id="water",
+        ),
+        AsyncMock(side_effect=lambda frame: frame.picture.unlink()),
+        AsyncMock(),
+        scheduler=Scheduler(0.05),
+        uploaders=1,
+        camera_id="water",
+    )
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0.12)
+    pipeline.stop()
+    await asyncio.wait_for(task, timeout=5)
+
+    rendered = metrics_enabled.render()
+    assert 'waterbowl_water_level{camera_id="water"} 0.4' in rendered
+    assert 'waterbowl_pipeline_queue_depth{camera_id="water"} 0' in rendered
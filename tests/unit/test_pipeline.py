@@ -0,0 +1,188 @@
+import asyncio
+from pathlib import Path
+from typing import Optional
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from waterbowl.camera_service import MockPersistentCameraService
+from waterbowl.pipeline import CapturePipeline, Frame
+from waterbowl.run_waterbowl_watcher import capture_frame, upload_frame
+from waterbowl.scheduler import Scheduler
+
+INTERVAL = 0.05
+
+pytestmark = pytest.mark.usefixtures("short_gc_pauses")
+
+
+class RecordingCapture:
+    """
+    Takes pictures with the mock camera and records when each capture started.
+    """
+
+    def __init__(self, frame_time: float = 0.0):
+        self.camera = MockPersistentCameraService(frame_time=frame_time)
+        self.started: list[float] = []
+
+    async def __call__(self, directory: Path) -> Optional[Frame]:
+        self.started.append(asyncio.get_running_loop().time())
+        return await capture_frame(self.camera, directory)
+
+
+async def slow_upload(frame: Frame):
+    await asyncio.sleep(INTERVAL * 4)
+    frame.picture.unlink()
+
+
+async def never_returns(*_, **__):
+    await asyncio.Event().wait()
+
+
+async def run_for(
+    pipeline: CapturePipeline, seconds: float, first_frame: Optional[Frame] = None
+) -> None:
+    task = asyncio.create_task(pipeline.run(first_frame))
+    await asyncio.sleep(seconds)
+    pipeline.stop()
+    await asyncio.wait_for(task, timeout=5)
+
+
+@pytest.mark.asyncio
+class TestCapturePipeline:
+    async def test_slow_api_does_not_delay_captures(self):
+        capture = RecordingCapture(frame_time=0.01)
+        upload = AsyncMock(side_effect=slow_upload)
+        spill = AsyncMock()
+        pipeline = CapturePipeline(
+            capture,
+            upload,
+            spill,
+            scheduler=Scheduler(INTERVAL),
+            queue_size=2,
+            uploaders=1,
+        )
+        await run_for(pipeline, INTERVAL * 12.5)
+
+        # Captures stay on the cadence they started on instead of drifting by the
+        # capture time, or waiting for uploads
+        start = capture.started[0]
+        for index, started in enumerate(capture.started):
+            assert started == pytest.approx(start + index * INTERVAL, abs=0.03)
+        assert len(capture.started) >= 12
+        # Frames that didn't fit in the queue, or weren't uploaded in time, were
+        # cached rather than lost
+        assert spill.await_count > 0
+        assert upload.await_count + spill.await_count >= len(capture.started)
+
+    async def test_overrunning_capture_skips_slots(self):
+        capture = RecordingCapture(frame_time=INTERVAL * 2.5)
+        pipeline = CapturePipeline(
+            capture,
+            AsyncMock(),
+            AsyncMock(),
+            scheduler=Scheduler(INTERVAL),
+            uploaders=1,
+        )
+        await run_for(pipeline, INTERVAL * 10)
+
+        gaps = [
+            later - earlier
+            for earlier, later in zip(capture.started, capture.started[1:])
+        ]
+        assert gaps
+        for gap in gaps:
+            assert gap == pytest.approx(INTERVAL * 3, abs=0.03)
+
+    async def test_first_frame_takes_first_slot(self, test_picture: Path):
+        capture = RecordingCapture()
+        uploaded = []
+
+        async def upload(frame: Frame):
+            uploaded.append(frame.timestamp)
+
+        scheduler = Scheduler(INTERVAL)
+        started = scheduler.start(asyncio.get_running_loop().time())
+        pipeline = CapturePipeline(capture, upload, AsyncMock(), scheduler=scheduler)
+        await run_for(pipeline, INTERVAL * 2.5, Frame(1.1, test_picture))
+
+        # The frame taken at start up is uploaded first, and the pipeline's own
+        # captures carry on from the schedule it was taken on
+        assert uploaded[0] == 1.1
+        assert capture.started[0] == pytest.approx(started + INTERVAL, abs=0.03)
+        assert len(uploaded) == len(capture.started) + 1
+
+    async def test_frames_taken_into_capture_dir(self, mock_local_storage_dir: Path):
+        capture = AsyncMock(return_value=None)
+        pipeline = CapturePipeline(
+            capture,
+            AsyncMock(),
+            AsyncMock(),
+            scheduler=Scheduler(INTERVAL),
+            capture_dir=mock_local_storage_dir,
+        )
+        await run_for(pipeline, INTERVAL / 2)
+
+        spool_dir = capture.await_args.args[0]
+        assert spool_dir.parent == mock_local_storage_dir
+        # The spool directory is cleaned up once the pipeline stops
+        assert not spool_dir.exists()
+
+    async def test_stop_finishes_queued_uploads(self):
+        capture = RecordingCapture()
+        uploaded = []
+
+        async def upload(frame: Frame):
+            await asyncio.sleep(INTERVAL / 2)
+            uploaded.append(frame.timestamp)
+
+        spill = AsyncMock()
+        pipeline = CapturePipeline(
+            capture, upload, spill, scheduler=Scheduler(INTERVAL), queue_size=5
+        )
+        await run_for(pipeline, INTERVAL * 3.5)
+
+        assert len(uploaded) == len(capture.started)
+        spill.assert_not_awaited()
+
+    async def test_stop_spills_frames_not_uploaded(self):
+        capture = RecordingCapture()
+        spilled = []
+
+        async def spill(frame: Frame):
+            spilled.append(frame)
+
+        pipeline = CapturePipeline(
+            capture,
+            AsyncMock(side_effect=never_returns),
+            spill,
+            scheduler=Scheduler(INTERVAL),
+            queue_size=10,
+            shutdown_grace=INTERVAL,
+        )
+        await run_for(pipeline, INTERVAL * 3.5)
+
+        assert len(spilled) == len(capture.started)
+
+    async def test_upload_errors_do_not_stop_uploader(self):
+        capture = RecordingCapture()
+        upload = AsyncMock(side_effect=RuntimeError("womp womp"))
+        pipeline = CapturePipeline(
+            capture, upload, AsyncMock(), scheduler=Scheduler(INTERVAL)
+        )
+        await run_for(pipeline, INTERVAL * 3.5)
+
+        assert upload.await_count == len(capture.started)
+
+    async def test_cancelled_upload_keeps_picture(self, test_picture: Path):
+        api_service = MagicMock()
+        api_service.available = AsyncMock(return_value=True)
+        api_service.send_picture = AsyncMock(side_effect=never_returns)
+        task = asyncio.create_task(
+            upload_frame(Frame(1.1, test_picture), api_service, MagicMock())
+        )
+        await asyncio.sleep(INTERVAL)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert test_picture.exists()
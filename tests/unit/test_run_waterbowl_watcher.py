@@ -1,30 +1,45 @@
 from datetime import datetime
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import AsyncGenerator
 from unittest import mock
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from waterbowl.api_service import ApiException
-from waterbowl.camera_service import AbstractCameraService, MockCameraService
-from waterbowl.enums import TEST_FILE_LOCATION
+from waterbowl.api_service import ApiException, SentPicture
+from waterbowl.burst import BurstCapture
+from waterbowl.camera_registry import CameraConfig, CameraRegistry
+from waterbowl.camera_service import (
+    AbstractCameraService,
+    CameraCaptureError,
+    MockCameraService,
+    MockPersistentCameraService,
+)
+from waterbowl.change_detection import ChangeDetector
+from waterbowl.enums import TEST_FILE_LOCATION, ScheduleModes
+from waterbowl.image_transform import ImageTransformer, TransformSettings
 from waterbowl.local_storage_service import LogEntry
-from waterbowl.run_waterbowl_watcher import image_water_bowl
+from waterbowl.run_waterbowl_watcher import (
+    WatchedCamera,
+    capture_frame,
+    image_water_bowl,
+)
+from waterbowl.scheduler import AdaptiveScheduler
+from waterbowl.water_level import WaterLevelEstimator
 
 
 @pytest.fixture
 def test_api_service() -> MagicMock:
-    with mock.patch(
-        "waterbowl.run_waterbowl_watcher.ApiService", MagicMock()
-    ) as mock_api_service:
-        yield mock_api_service
+    mock_api_service = MagicMock()
+    mock_api_service.supports_batch_upload = AsyncMock(return_value=False)
+    return mock_api_service
 
 
 async def mock_storage_log():
     for line in [
-        LogEntry(log_file_line=f"1.1,{TEST_FILE_LOCATION}"),
-        LogEntry(log_file_line=f"1.1,{TEST_FILE_LOCATION}"),
+        LogEntry.from_line(f"1.1,{TEST_FILE_LOCATION}"),
+        LogEntry.from_line(f"1.1,{TEST_FILE_LOCATION}"),
     ]:
         yield line
 
@@ -34,17 +49,17 @@ def mock_storage_functions(
     test_picture: Path,
 ) -> tuple[MagicMock, MagicMock, MagicMock]:
     with mock.patch(
-        "waterbowl.run_waterbowl_watcher.read_storage_log", mock_storage_log
+        "waterbowl.backlog_service.read_storage_log", mock_storage_log
     ) as read_storage_log:
         with mock.patch(
             "waterbowl.run_waterbowl_watcher.save_to_storage_log",
             AsyncMock(return_value=test_picture),
         ) as save_to_storage_log:
             with mock.patch(
-                "waterbowl.run_waterbowl_watcher.clear_local_storage",
-                AsyncMock(return_value=True),
-            ) as clear_local_storage:
-                yield read_storage_log, save_to_storage_log, clear_local_storage
+                "waterbowl.backlog_service.acknowledge_log_entry",
+                AsyncMock(return_value=None),
+            ) as acknowledge_log_entry:
+                yield read_storage_log, save_to_storage_log, acknowledge_log_entry
 
 
 @pytest.fixture
@@ -58,26 +73,28 @@ class TestImageWaterBowl:
     async def test_happy_path(
         self, test_api_service: MagicMock, test_camera_service: AbstractCameraService
     ):
-        test_api_service.api_healthy = AsyncMock(return_value=True)
-        test_api_service.send_picture = AsyncMock(return_value="picture_id")
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
         test_api_service.update_picture = AsyncMock(return_value=True)
         await image_water_bowl(cam=test_camera_service, api_service=test_api_service)
 
-        test_api_service.api_healthy.assert_called_once()
+        test_api_service.available.assert_called_once()
         assert test_api_service.send_picture.call_count == 3
 
     @pytest.mark.freeze_time("2022-12-31")
-    async def test_api_not_healthy(
+    async def test_api_not_available(
         self,
         test_api_service: MagicMock,
         test_camera_service: AbstractCameraService,
         mock_storage_functions: tuple[MagicMock, MagicMock, MagicMock],
     ):
         _, mock_save_to_storage, _ = mock_storage_functions
-        test_api_service.api_healthy = AsyncMock(return_value=False)
+        test_api_service.available = AsyncMock(return_value=False)
         await image_water_bowl(cam=test_camera_service, api_service=test_api_service)
 
-        test_api_service.api_healthy.assert_called_once()
+        test_api_service.available.assert_called_once()
         mock_save_to_storage.assert_called_once()
 
         assert (
@@ -93,10 +110,10 @@ class TestImageWaterBowl:
         mock_storage_functions: tuple[MagicMock, MagicMock, MagicMock],
     ):
         _, mock_save_to_storage, _ = mock_storage_functions
-        test_api_service.api_healthy = AsyncMock(side_effect=ApiException("womp womp"))
+        test_api_service.available = AsyncMock(side_effect=ApiException("womp womp"))
         await image_water_bowl(cam=test_camera_service, api_service=test_api_service)
 
-        test_api_service.api_healthy.assert_called_once()
+        test_api_service.available.assert_called_once()
         mock_save_to_storage.assert_called_once()
 
         assert (
@@ -113,57 +130,270 @@ class TestImageWaterBowl:
             AsyncGenerator[LogEntry, None], AsyncMock, AsyncMock
         ],
     ):
-        read_storage_log, _, clear_local_storage = mock_storage_functions
-        test_api_service.api_healthy = AsyncMock(return_value=True)
-        test_api_service.send_picture = AsyncMock(return_value="picture_id")
+        _, _, acknowledge_log_entry = mock_storage_functions
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
         await image_water_bowl(cam=test_camera_service, api_service=test_api_service)
 
-        test_api_service.api_healthy.assert_called_once()
-        clear_local_storage.assert_called_once()
+        test_api_service.available.assert_called_once()
+        assert acknowledge_log_entry.await_count == 2
         assert test_api_service.send_picture.await_count == 3
 
+    @pytest.mark.freeze_time("2022-12-31")
+    async def test_backlog_drained_in_background(
+        self,
+        test_api_service: MagicMock,
+        test_camera_service: AbstractCameraService,
+    ):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
+        backlog_drainer = MagicMock()
+        await image_water_bowl(
+            cam=test_camera_service,
+            api_service=test_api_service,
+            backlog_drainer=backlog_drainer,
+        )
+
+        backlog_drainer.start.assert_called_once()
+        test_api_service.send_picture.assert_awaited_once()
+
     @pytest.mark.freeze_time("2022-12-31")
     async def test_with_default_update(
         self,
         test_api_service: MagicMock,
         test_camera_service: AbstractCameraService,
-        mock_storage_functions: tuple[
-            AsyncGenerator[LogEntry, None], AsyncMock, AsyncMock
-        ],
     ):
         default = {"some": "data"}
         with patch("waterbowl.run_waterbowl_watcher.DEFAULT_PICTURE_METADATA", default):
             picture_id = "picture_id"
-            read_storage_log, _, clear_local_storage = mock_storage_functions
-            test_api_service.api_healthy = AsyncMock(return_value=True)
-            test_api_service.send_picture = AsyncMock(return_value=picture_id)
+            test_api_service.available = AsyncMock(return_value=True)
+            test_api_service.send_picture = AsyncMock(
+                return_value=SentPicture(picture_id)
+            )
             test_api_service.update_picture = AsyncMock(return_value=True)
             await image_water_bowl(
                 cam=test_camera_service, api_service=test_api_service
             )
 
-            test_api_service.update_picture.assert_called_once_with(
-                picture_id=picture_id, picture_data=default
-            )
+            assert test_api_service.send_picture.call_args.kwargs["metadata"] == default
 
     @pytest.mark.freeze_time("2022-12-31")
     async def test_with_no_default_update(
         self,
         test_api_service: MagicMock,
         test_camera_service: AbstractCameraService,
-        mock_storage_functions: tuple[
-            AsyncGenerator[LogEntry, None], AsyncMock, AsyncMock
-        ],
     ):
         default = {}
         with patch("waterbowl.run_waterbowl_watcher.DEFAULT_PICTURE_METADATA", default):
             picture_id = "picture_id"
-            read_storage_log, _, clear_local_storage = mock_storage_functions
-            test_api_service.api_healthy = AsyncMock(return_value=True)
-            test_api_service.send_picture = AsyncMock(return_value=picture_id)
+            test_api_service.available = AsyncMock(return_value=True)
+            test_api_service.send_picture = AsyncMock(
+                return_value=SentPicture(picture_id)
+            )
             test_api_service.update_picture = AsyncMock(return_value=True)
             await image_water_bowl(
                 cam=test_camera_service, api_service=test_api_service
             )
 
-            test_api_service.update_picture.assert_not_called()
+            assert test_api_service.send_picture.call_args.kwargs["metadata"] is None
+
+    @pytest.mark.freeze_time("2022-12-31")
+    async def test_unchanged_picture_not_uploaded(
+        self,
+        test_api_service: MagicMock,
+        test_camera_service: AbstractCameraService,
+    ):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
+        test_api_service.update_picture = AsyncMock(return_value=True)
+        test_api_service.queue_update = AsyncMock()
+        change_detector = ChangeDetector(threshold=0)
+        for _ in range(2):
+            result = await image_water_bowl(
+                cam=test_camera_service,
+                api_service=test_api_service,
+                backlog_drainer=MagicMock(),
+                change_detector=change_detector,
+            )
+            assert result is True
+
+        test_api_service.send_picture.assert_awaited_once()
+        test_api_service.queue_update.assert_awaited_once_with(
+            picture_id="picture_id",
+            picture_data={"unchanged_at": datetime.now().timestamp()},
+        )
+
+    @pytest.mark.freeze_time("2022-12-31")
+    async def test_transform_recorded_in_metadata(
+        self,
+        test_api_service: MagicMock,
+        test_camera_service: AbstractCameraService,
+    ):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
+        test_api_service.update_picture = AsyncMock(return_value=True)
+        image_transformer = ImageTransformer(
+            TransformSettings(crop=None, max_size=(320, 240), quality=70)
+        )
+        try:
+            await image_water_bowl(
+                cam=test_camera_service,
+                api_service=test_api_service,
+                backlog_drainer=MagicMock(),
+                image_transformer=image_transformer,
+            )
+        finally:
+            image_transformer.close()
+
+        metadata = test_api_service.send_picture.call_args.kwargs["metadata"]
+        assert metadata["transform"]["size"] == [320, 240]
+
+    async def test_camera_error_not_cached(
+        self,
+        test_api_service: MagicMock,
+        mock_storage_functions: tuple[MagicMock, MagicMock, MagicMock],
+    ):
+        _, mock_save_to_storage, _ = mock_storage_functions
+        camera = MagicMock()
+        camera.take_picture = AsyncMock(side_effect=CameraCaptureError())
+        result = await image_water_bowl(cam=camera, api_service=test_api_service)
+
+        assert result is False
+        mock_save_to_storage.assert_not_called()
+        test_api_service.send_picture.assert_not_called()
+
+    async def test_scheduler_told_about_changes(
+        self,
+        test_api_service: MagicMock,
+        test_camera_service: AbstractCameraService,
+    ):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id", water_level=0.5)
+        )
+        test_api_service.update_picture = AsyncMock(return_value=True)
+        test_api_service.queue_update = AsyncMock()
+        scheduler = MagicMock()
+        change_detector = ChangeDetector(threshold=0)
+        for _ in range(2):
+            await image_water_bowl(
+                cam=test_camera_service,
+                api_service=test_api_service,
+                backlog_drainer=MagicMock(),
+                change_detector=change_detector,
+                scheduler=scheduler,
+            )
+
+        assert scheduler.observe.call_args_list == [
+            mock.call(changed=True),
+            mock.call(water_level=0.5),
+            mock.call(changed=False),
+        ]
+
+    async def test_fine_water_level_skips_uploads(
+        self,
+        test_api_service: MagicMock,
+        test_camera_service: AbstractCameraService,
+    ):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
+        test_api_service.queue_update = AsyncMock()
+        scheduler = MagicMock()
+        water_level_estimator = WaterLevelEstimator(
+            roi=(0, 0, 10, 10),
+            empty_picture=Path("empty.jpg"),
+            full_picture=Path("full.jpg"),
+            fine=0.5,
+            max_skipped=1,
+        )
+        water_level_estimator.estimate = AsyncMock(return_value=0.8)
+        for _ in range(3):
+            result = await image_water_bowl(
+                cam=test_camera_service,
+                api_service=test_api_service,
+                backlog_drainer=MagicMock(),
+                scheduler=scheduler,
+                water_level_estimator=water_level_estimator,
+            )
+            assert result is True
+
+        # Every other picture is uploaded, the level is always recorded
+        assert test_api_service.send_picture.await_count == 2
+        metadata = test_api_service.send_picture.call_args.kwargs["metadata"]
+        assert metadata["water_level"] == 0.8
+        test_api_service.queue_update.assert_awaited_once()
+        update = test_api_service.queue_update.call_args.kwargs
+        assert update["picture_id"] == "picture_id"
+        assert update["picture_data"]["water_level"] == 0.8
+        scheduler.observe.assert_any_call(water_level=0.8)
+
+    async def test_burst_recorded_in_metadata(self, test_api_service: MagicMock):
+        test_api_service.available = AsyncMock(return_value=True)
+        test_api_service.send_picture = AsyncMock(
+            return_value=SentPicture("picture_id")
+        )
+        test_api_service.update_picture = AsyncMock(return_value=True)
+        burst_capture = BurstCapture(frames=3, budget=5, reference_picture=None)
+        try:
+            result = await image_water_bowl(
+                cam=MockPersistentCameraService(),
+                api_service=test_api_service,
+                backlog_drainer=MagicMock(),
+                burst_capture=burst_capture,
+            )
+        finally:
+            burst_capture.close()
+
+        assert result is True
+        metadata = test_api_service.send_picture.call_args.kwargs["metadata"]
+        assert metadata["burst"]["frames"] == 3
+
+    async def test_pictures_tagged_with_camera_id(
+        self, test_camera_service: AbstractCameraService
+    ):
+        with TemporaryDirectory() as tmp_dir:
+            frame = await capture_frame(
+                test_camera_service, Path(tmp_dir), camera_id="food"
+            )
+            assert frame.picture.name.startswith("food_")
+            assert frame.metadata == {"camera_id": "food"}
+
+    async def test_single_camera_pictures_not_tagged(
+        self, test_camera_service: AbstractCameraService
+    ):
+        with TemporaryDirectory() as tmp_dir:
+            frame = await capture_frame(
+                test_camera_service, Path(tmp_dir), camera_id="water", tag_camera=False
+            )
+            # Pictures are still named after the camera, but the metadata doesn't
+            # need to say which camera took them
+            assert frame.picture.name.startswith("water_")
+            assert frame.metadata == {}
+
+
+def test_adaptive_schedules_follow_each_cameras_interval():
+    registry = CameraRegistry(
+        [
+            CameraConfig.from_dict({"id": "water", "interval": "2m"}),
+            CameraConfig.from_dict({"id": "food", "interval": "1h"}),
+        ]
+    )
+    with mock.patch("waterbowl.scheduler.SCHEDULE_MODE", ScheduleModes.ADAPTIVE):
+        cameras = [WatchedCamera(config) for config in registry]
+
+    schedules = [
+        (camera.scheduler.min_interval, camera.scheduler.max_interval)
+        for camera in cameras
+    ]
+    assert all(isinstance(camera.scheduler, AdaptiveScheduler) for camera in cameras)
+    assert schedules == [(30, 480), (900, 14400)]
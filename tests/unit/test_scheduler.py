@@ -0,0 +1,154 @@
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from waterbowl.enums import _seconds
+from waterbowl.scheduler import AdaptiveScheduler, Scheduler, on_battery_power
+
+NOON = datetime(2022, 12, 31, 12)
+MIDNIGHT = datetime(2022, 12, 31, 0)
+
+
+def adaptive_scheduler(tmp_path: Path, clock=NOON, **kwargs) -> AdaptiveScheduler:
+    return AdaptiveScheduler(
+        interval=10,
+        jitter=0,
+        min_interval=5,
+        max_interval=40,
+        night_hours=(23, 6),
+        power_supply_dir=tmp_path,
+        clock=lambda: clock,
+        **kwargs,
+    )
+
+
+def add_power_supply(power_supply_dir: Path, name: str, supply_type: str, status: str):
+    supply = power_supply_dir.joinpath(name)
+    supply.mkdir()
+    supply.joinpath("type").write_text(f"{supply_type}\n")
+    supply.joinpath("status").write_text(f"{status}\n")
+
+
+@pytest.mark.parametrize(
+    "value,seconds",
+    [("90", 90), ("90s", 90), ("1.5m", 90), ("1h", 3600), (600, 600), (" 2M ", 120)],
+)
+def test_parse_duration(value, seconds):
+    assert _seconds(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "0", "-5", "soon", "m", "inf", "nan"])
+def test_parse_invalid_duration(value):
+    with pytest.raises(ValueError):
+        _seconds(value)
+
+
+class TestScheduler:
+    def test_deadlines_do_not_drift(self):
+        scheduler = Scheduler(interval=10, jitter=0)
+        assert scheduler.start(100) == 100
+        # However long each picture takes, the next is due on the same grid
+        assert scheduler.next_deadline(100.3) == 110
+        assert scheduler.next_deadline(117.9) == 120
+        assert scheduler.next_deadline(120.1) == 130
+
+    def test_overrun_skips_missed_deadlines(self):
+        scheduler = Scheduler(interval=10, jitter=0)
+        scheduler.start(100)
+        assert scheduler.next_deadline(135) == 140
+        assert scheduler.next_deadline(140.5) == 150
+
+    def test_jitter_does_not_move_grid(self):
+        offsets = iter([2, -3, 1])
+        scheduler = Scheduler(
+            interval=10, jitter=3, uniform=lambda low, high: next(offsets)
+        )
+        scheduler.start(100)
+        assert scheduler.next_deadline(101) == 112
+        assert scheduler.next_deadline(113) == 117
+        assert scheduler.next_deadline(118) == 131
+
+    def test_jitter_never_before_now(self):
+        scheduler = Scheduler(interval=10, jitter=3, uniform=lambda low, high: low)
+        scheduler.start(100)
+        assert scheduler.next_deadline(109) == 109
+
+    @pytest.mark.parametrize("interval,jitter", [(0, 0), (-1, 0), (10, 5), (10, -1)])
+    def test_invalid_settings(self, interval, jitter):
+        with pytest.raises(ValueError):
+            Scheduler(interval=interval, jitter=jitter)
+
+
+class TestAdaptiveScheduler:
+    def test_idle_day(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path)
+        scheduler.observe(changed=False, water_level=0.8)
+        assert scheduler.current_interval() == 10
+
+    def test_faster_while_changing(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path, recent_pictures=2)
+        scheduler.observe(changed=True)
+        assert scheduler.current_interval() == 5
+        scheduler.observe(changed=False)
+        assert scheduler.current_interval() == 5
+        scheduler.observe(changed=False)
+        assert scheduler.current_interval() == 10
+
+    def test_faster_when_water_low(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path, low_water=0.25)
+        scheduler.observe(water_level=0.1)
+        assert scheduler.current_interval() == 5
+        scheduler.observe(water_level=0.9)
+        assert scheduler.current_interval() == 10
+
+    def test_slower_at_night(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path, clock=MIDNIGHT)
+        assert scheduler.current_interval() == 40
+
+    def test_activity_beats_night(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path, clock=MIDNIGHT)
+        scheduler.observe(changed=True)
+        assert scheduler.current_interval() == 5
+
+    def test_battery_beats_activity(self, tmp_path: Path):
+        add_power_supply(tmp_path, "ups", "Battery", "Discharging")
+        scheduler = adaptive_scheduler(tmp_path)
+        scheduler.observe(changed=True)
+        assert scheduler.current_interval() == 40
+
+    def test_deadlines_follow_interval(self, tmp_path: Path):
+        scheduler = adaptive_scheduler(tmp_path)
+        scheduler.start(100)
+        assert scheduler.next_deadline(101) == 110
+        scheduler.observe(changed=True)
+        assert scheduler.next_deadline(111) == 115
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            {"min_interval": 20},
+            {"max_interval": 5},
+            {"min_interval": 0},
+            {"night_hours": (23, 24)},
+            {"night_hours": (1, 2, 3)},
+        ],
+    )
+    def test_invalid_settings(self, kwargs):
+        settings = {"interval": 10, "jitter": 0, "min_interval": 5, "max_interval": 40}
+        settings.update(kwargs)
+        with pytest.raises(ValueError):
+            AdaptiveScheduler(**settings)
+
+
+def test_on_battery_power(tmp_path: Path):
+    add_power_supply(tmp_path, "AC", "Mains", "Unknown")
+    assert not on_battery_power(tmp_path)
+    add_power_supply(tmp_path, "BAT0", "Battery", "Charging")
+    assert not on_battery_power(tmp_path)
+    tmp_path.joinpath("BAT0", "status").write_text("Discharging\n")
+    assert on_battery_power(tmp_path)
+
+
+def test_on_battery_power_without_power_supplies(tmp_path: Path):
+    assert not on_battery_power(tmp_path.joinpath("missing"))
@@ -0,0 +1,117 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from waterbowl.camera_service import MockPersistentCameraService
+from waterbowl.pipeline import CapturePipeline, Frame
+from waterbowl.run_waterbowl_watcher import capture_frame
+from waterbowl.scheduler import Scheduler
+from waterbowl.upload_slots import TokenBucket, UploadSlots
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_refills():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    # Never holds more than its capacity
+    clock.now += 60
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_needs_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0, capacity=1)
+
+
+@pytest.mark.asyncio
+async def test_busy_camera_does_not_crowd_out_others():
+    upload_slots = UploadSlots(["busy", "quiet"], slots=1, rate=40, burst=1)
+    uploaded = []
+
+    async def upload(camera_id: str):
+        uploaded.append(camera_id)
+        await asyncio.sleep(0.001)
+
+    busy = upload_slots.limit("busy", upload)
+    quiet = upload_slots.limit("quiet", upload)
+    # The busy camera queues up lots of uploads before the quiet one's
+    await asyncio.gather(
+        *(busy("busy") for _ in range(6)), *(quiet("quiet") for _ in range(2))
+    )
+
+    # Each camera gets 20 uploads a second, so the quiet camera's uploads go
+    # while the busy camera waits for its tokens
+    assert uploaded.index("quiet") <= 1
+    assert uploaded[:4].count("quiet") == 2
+
+
+@pytest.mark.asyncio
+async def test_slots_limit_concurrent_uploads():
+    upload_slots = UploadSlots(["one", "two"], slots=2, rate=1000, burst=10)
+    running = 0
+    most_running = 0
+
+    async def upload():
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    await asyncio.gather(
+        *(upload_slots.limit(camera_id, upload)() for camera_id in ["one", "two"] * 5)
+    )
+    assert most_running == 2
+
+
+@pytest.mark.asyncio
+async def test_many_cameras_share_uploads(mock_local_storage_dir: Path):
+    cameras = [f"camera{index}" for index in range(50)]
+    upload_slots = UploadSlots(cameras, slots=2, rate=1000, burst=2)
+    uploaded: dict[str, int] = {camera_id: 0 for camera_id in cameras}
+
+    async def upload(frame: Frame):
+        await asyncio.sleep(0.002)
+        uploaded[frame.metadata["camera_id"]] += 1
+        frame.picture.unlink()
+
+    async def spill(frame: Frame):
+        frame.picture.unlink()
+
+    pipelines = []
+    for camera_id in cameras:
+        camera = MockPersistentCameraService()
+
+        async def capture(directory: Path, camera=camera, camera_id=camera_id):
+            return await capture_frame(camera, directory, camera_id=camera_id)
+
+        pipelines.append(
+            CapturePipeline(
+                capture,
+                upload_slots.limit(camera_id, upload),
+                spill,
+                scheduler=Scheduler(0.5),
+                capture_dir=mock_local_storage_dir,
+            )
+        )
+    runs = [asyncio.create_task(pipeline.run()) for pipeline in pipelines]
+    await asyncio.sleep(0.75)
+    for pipeline in pipelines:
+        pipeline.stop()
+    await asyncio.wait_for(asyncio.gather(*runs), timeout=10)
+
+    # Every camera took its pictures, on one event loop, and had them uploaded
+    assert all(count >= 1 for count in uploaded.values()), uploaded
@@ -0,0 +1,77 @@
+import csv
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from waterbowl.water_level import WaterLevelEstimator, roi_profile, water_level
+
+
+@pytest.fixture
+def water_level_samples(test_data_dir: Path) -> tuple[Path, list[dict[str, str]]]:
+    sample_dir = test_data_dir.joinpath("water_level")
+    with open(sample_dir.joinpath("labels.csv"), newline="") as labels:
+        yield sample_dir, list(csv.DictReader(labels))
+
+
+@pytest.fixture
+def water_level_estimator(
+    water_level_samples: tuple[Path, list[dict[str, str]]]
+) -> WaterLevelEstimator:
+    sample_dir, labels = water_level_samples
+    yield WaterLevelEstimator(
+        roi=tuple(int(edge) for edge in labels[0]["roi"].split(",")),
+        empty_picture=sample_dir.joinpath("empty.jpg"),
+        full_picture=sample_dir.joinpath("full.jpg"),
+        fine=0.5,
+        max_skipped=2,
+    )
+
+
+def test_water_level_finds_water_line():
+    empty = np.zeros((10, 4))
+    full = np.ones((10, 4))
+    profile = np.concatenate((np.zeros((7, 4)), np.ones((3, 4))))
+    assert water_level(profile, empty, full) == pytest.approx(0.3)
+    assert water_level(empty, empty, full) == 0
+    assert water_level(full, empty, full) == 1
+
+
+def test_roi_profile_decodes_small(test_picture: Path):
+    with Image.open(test_picture) as image:
+        width, height = image.size
+    profile = roi_profile(test_picture, (0, 0, width // 2, height // 2), 8, 4)
+    assert profile.shape == (8, 4)
+    assert ((profile >= 0) & (profile <= 255)).all()
+
+
+@pytest.mark.asyncio
+async def test_estimates_labelled_samples(
+    water_level_samples: tuple[Path, list[dict[str, str]]],
+    water_level_estimator: WaterLevelEstimator,
+):
+    sample_dir, labels = water_level_samples
+    for label in labels:
+        level = await water_level_estimator.estimate(
+            sample_dir.joinpath(label["picture"])
+        )
+        assert level == pytest.approx(float(label["level"]), abs=0.05), label
+
+
+def test_estimator_skips_fine_pictures(water_level_estimator: WaterLevelEstimator):
+    # Nothing has been uploaded to record the level against yet
+    assert not water_level_estimator.skippable(0.9)
+    water_level_estimator.remember("picture_id")
+    assert not water_level_estimator.skippable(0.4)
+    for _ in range(2):
+        assert water_level_estimator.skippable(0.9)
+        water_level_estimator.skip()
+    assert not water_level_estimator.skippable(0.9)
+    water_level_estimator.remember("next_picture_id")
+    assert water_level_estimator.skippable(0.9)
+
+
+def test_estimator_needs_references():
+    with pytest.raises(ValueError):
+        WaterLevelEstimator(roi=(0, 0, 10, 10), empty_picture=None, full_picture=None)
@@ -1,13 +1,53 @@
+import asyncio
+import gzip
+import hashlib
 import json
-from io import BytesIO
+import logging
+from contextlib import ExitStack, asynccontextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, NamedTuple, Optional, Sequence, Union
 
-import aiofiles
 import aiohttp
 from aiohttp import FormData
 
-from waterbowl.enums import API_BASE_URL
+from waterbowl.enums import (
+    API_BASE_URL,
+    API_BATCH_MAX_BYTES,
+    API_BATCH_MAX_SIZE,
+    API_CONNECT_TIMEOUT,
+    API_CONNECTION_LIMIT,
+    API_DNS_CACHE_TTL,
+    API_GZIP_MIN_BYTES,
+    API_KEEPALIVE_TIMEOUT,
+    API_TOTAL_TIMEOUT,
+    API_UPDATE_BATCH_SIZE,
+    API_UPDATE_MAX_DELAY,
+    BreakerStates,
+)
+from waterbowl.circuit_breaker import CircuitBreaker
+from waterbowl.file_io import run_io
+from waterbowl.metrics import (
+    API_REQUEST_FAILURES,
+    API_REQUEST_SECONDS,
+    UPLOADED_BYTES,
+    UPLOADED_PICTURES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# A picture can be sent from a file on disk or from an in-memory capture buffer
+PictureSource = Union[Path, bytes, bytearray, memoryview]
+
+
+class SentPicture(NamedTuple):
+    picture_id: str
+    # The water level (0-1) the api measured in the picture, if it reports one
+    water_level: Optional[float] = None
+
+
+# Sent with every upload so the api can recognise a picture it already has
+IDEMPOTENCY_HEADER = "Idempotency-Key"
 
 
 class ApiException(Exception):
@@ -15,42 +55,517 @@ class ApiException(Exception):
     An exception occurred in the water bowl api
     """
 
+    def __init__(self, message: str = "", status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def rejected(self) -> bool:
+        """
+        Whether the api answered that the request itself was wrong, so sending it
+        again won't help. A conflict means the api already has what was sent, and
+        a timeout or too many requests are worth trying again later.
+        """
+        return (
+            self.status is not None
+            and 400 <= self.status < 500
+            and self.status not in (408, 409, 429)
+        )
+
+
+class ApiUnavailable(ApiException):
+    """
+    The api has been failing, so requests aren't being sent to it for now
+    """
+
 
 class ApiService:
-    def __init__(self, base_url: str = API_BASE_URL):
+    """
+    Client for the water bowl api.
+
+    The service owns a single, long-lived ``aiohttp.ClientSession`` so that the
+    TCP connection (and DNS lookup) is reused between capture cycles. Use it as an
+    async context manager to make sure the session is closed on shutdown:
+
+        async with ApiService() as api_service:
+            await api_service.send_picture(...)
+
+    If a method is called outside of the context manager the session is opened
+    lazily, and ``close`` must be called when finished.
+
+    Requests go through a circuit breaker. Successful requests show the api is
+    healthy, and after repeated failures (errors from the server, or no response)
+    requests raise ``ApiUnavailable`` straight away until the breaker's backoff
+    has passed. The next request then checks ``/health`` first, and only goes
+    ahead if the api is back.
+
+    Picture metadata goes along with the upload when the api supports it,
+    otherwise updates are queued and sent in batches (see ``queue_update``),
+    which ``close`` flushes.
+    """
+
+    def __init__(
+        self,
+        base_url: str = API_BASE_URL,
+        connection_limit: int = API_CONNECTION_LIMIT,
+        dns_cache_ttl: int = API_DNS_CACHE_TTL,
+        keepalive_timeout: float = API_KEEPALIVE_TIMEOUT,
+        total_timeout: float = API_TOTAL_TIMEOUT,
+        connect_timeout: float = API_CONNECT_TIMEOUT,
+        breaker: Optional[CircuitBreaker] = None,
+        update_batch_size: int = API_UPDATE_BATCH_SIZE,
+        update_max_delay: float = API_UPDATE_MAX_DELAY,
+        gzip_min_bytes: int = API_GZIP_MIN_BYTES,
+    ):
         self.base_url = base_url
+        self.connection_limit = connection_limit
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._capabilities: Optional[dict[str, Any]] = None
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._probing = False
+        self.update_batch_size = update_batch_size
+        self.update_max_delay = update_max_delay
+        self.gzip_min_bytes = gzip_min_bytes
+        # Metadata waiting to be sent, by picture id, and the task that sends it
+        # once the oldest of it has waited long enough
+        self._pending_updates: dict[str, dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "ApiService":
+        self._get_session()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+        return self._session
+
+    async def close(self) -> None:
+        self._cancel_flush()
+        if self._pending_updates and self._session is not None:
+            try:
+                await self.flush_updates()
+            except Exception as ex:
+                logger.error(
+                    "Unable to send queued picture updates, dropping them",
+                    extra={"updates": len(self._pending_updates), "error": ex},
+                )
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def api_healthy(self) -> bool:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.base_url}/health") as resp:
+        with API_REQUEST_SECONDS.labels("api_healthy").time():
+            async with self._get_session().get(f"{self.base_url}/health") as resp:
                 return resp.status == 200
 
-    async def send_picture(self, timestamp: float, picture: Path) -> str:
+    @property
+    def breaker_state(self) -> BreakerStates:
+        return self.breaker.state
+
+    async def available(self) -> bool:
+        """
+        Whether requests should be sent to the api. Only makes a request, to
+        ``/health``, when the breaker is half open.
+        """
+        state = self.breaker.state
+        if state == BreakerStates.CLOSED:
+            return True
+        if state == BreakerStates.OPEN or self._probing:
+            return False
+        self._probing = True
+        try:
+            healthy = await self.api_healthy()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            logger.warning("Api health check failed", extra={"error": ex})
+            healthy = False
+        finally:
+            self._probing = False
+        if healthy:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return healthy
+
+    @asynccontextmanager
+    async def _guard(self, operation: str) -> AsyncIterator[None]:
+        """
+        Wrap a request to the api, failing fast while the breaker is open and
+        recording how the request went, and how long it took, under
+        ``operation``.
+        """
+        if not await self.available():
+            API_REQUEST_FAILURES.labels(operation).inc()
+            raise ApiUnavailable(
+                f"Api unavailable, retrying in {self.breaker.retry_in:.0f}s"
+            )
+        try:
+            with API_REQUEST_SECONDS.labels(operation).time():
+                yield
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            API_REQUEST_FAILURES.labels(operation).inc()
+            self.breaker.record_failure()
+            raise
+        except ApiException as ex:
+            API_REQUEST_FAILURES.labels(operation).inc()
+            # The api answered, so errors about the request itself don't mean
+            # it's unhealthy
+            if ex.status is None or ex.status >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        else:
+            self.breaker.record_success()
+
+    async def capabilities(self) -> dict[str, Any]:
+        """
+        Optional features advertised by the api. Older versions of the api don't
+        have the endpoint, in which case no optional features are used. The result
+        is cached for the lifetime of the service.
+        """
+        if self._capabilities is None:
+            async with self._guard("capabilities"), self._get_session().get(
+                f"{self.base_url}/capabilities"
+            ) as resp:
+                if resp.status == 200:
+                    self._capabilities = await resp.json()
+                elif resp.status in (404, 405):
+                    self._capabilities = {}
+                else:
+                    raise _status_error(resp)
+        return self._capabilities
+
+    async def _supports(self, feature: str) -> bool:
+        return bool((await self.capabilities()).get(feature, False))
+
+    async def supports_batch_upload(self) -> bool:
+        return await self._supports("batch_upload")
+
+    async def batch_limits(self) -> tuple[int, int]:
+        """
+        The maximum number of pictures, and total picture bytes, to send in one
+        batch request. The api can lower the configured limits.
+        """
+        capabilities = await self.capabilities()
+        max_size = min(
+            API_BATCH_MAX_SIZE, capabilities.get("max_batch_size", API_BATCH_MAX_SIZE)
+        )
+        max_bytes = min(
+            API_BATCH_MAX_BYTES,
+            capabilities.get("max_batch_bytes", API_BATCH_MAX_BYTES),
+        )
+        return max_size, max_bytes
+
+    async def send_pictures(
+        self, pictures: Sequence[tuple[float, Path]]
+    ) -> list[Optional[str]]:
+        """
+        Upload many cached pictures, returning the id of each picture in order, or
+        None for pictures the api rejected.
+
+        When the api supports batch uploads the pictures are packed into as few
+        size-capped multipart requests as possible, otherwise they are sent one at
+        a time. An ``ApiException`` is raised if a whole request fails.
+        """
+        if not await self.supports_batch_upload():
+            return [
+                (
+                    await self.send_picture(timestamp=timestamp, picture=picture)
+                ).picture_id
+                for timestamp, picture in pictures
+            ]
+        max_size, max_bytes = await self.batch_limits()
+        picture_ids: list[Optional[str]] = []
+        for batch in await run_io(_split_batches, pictures, max_size, max_bytes):
+            picture_ids.extend(await self._send_batch(batch))
+        return picture_ids
+
+    async def _send_batch(
+        self, pictures: Sequence[tuple[float, Path]]
+    ) -> list[Optional[str]]:
+        client_ids = [
+            await _client_id(timestamp, picture) for timestamp, picture in pictures
+        ]
+        form_data = FormData()
+        with ExitStack() as stack:
+            for (timestamp, picture), client_id in zip(pictures, client_ids):
+                form_data.add_field("timestamp", str(timestamp))
+                form_data.add_field("client_id", client_id)
+                form_data.add_field(
+                    "picture",
+                    stack.enter_context(await run_io(open, picture, "rb")),
+                    filename=picture.name,
+                    content_type="image/jpeg",
+                )
+            async with self._guard("send_pictures"), self._get_session().post(
+                f"{self.base_url}/pictures/batch/", data=form_data
+            ) as resp:
+                if resp.status != 200:
+                    raise _status_error(resp)
+                results = (await resp.json())["results"]
+        if len(results) != len(pictures):
+            raise ApiException(
+                f"Expected {len(pictures)} batch results from the api, got {len(results)}"
+            )
+        UPLOADED_PICTURES.inc(len(pictures))
+        UPLOADED_BYTES.inc(await run_io(_total_size, pictures))
+        return [result.get("id") for result in results]
+
+    async def send_picture(
+        self,
+        timestamp: float,
+        picture: PictureSource,
+        client_id: Optional[str] = None,
+        metadata: Optional[dict[str, Any]] = None,
+    ) -> SentPicture:
+        """
+        Upload a picture, returning its id and the water level the api measured
+        in it, if it reports one. Files are streamed from disk in chunks
+        by aiohttp rather than read into memory, and buffers are sent without
+        being copied, so memory use doesn't grow with the size of the picture.
+
+        The picture's client id (see ``picture_client_id``) is sent as an
+        idempotency key, so sending a picture again, after a response was lost,
+        doesn't create a duplicate. The api answers 409 for a picture it already
+        has, which is treated as success.
+
+        Any ``metadata`` is sent as part of the upload if the api supports it,
+        saving a request, otherwise it's queued as an update.
+        """
+        if client_id is None:
+            client_id = await _client_id(timestamp, picture)
         form_data = FormData()
         form_data.add_field("timestamp", str(timestamp))
-        async with aiofiles.open(picture, "rb") as picture_file:
+        form_data.add_field("client_id", client_id)
+        coalesce = bool(metadata) and await self._supports("upload_metadata")
+        if coalesce:
+            form_data.add_field(
+                "metadata", json.dumps(metadata), content_type="application/json"
+            )
+        with ExitStack() as stack:
+            if isinstance(picture, Path):
+                picture_body = stack.enter_context(await run_io(open, picture, "rb"))
+                filename = picture.name
+            else:
+                picture_body = picture
+                filename = f"{timestamp}.jpg"
             form_data.add_field(
                 "picture",
-                BytesIO(await picture_file.read()),
-                filename=picture.name,
+                picture_body,
+                filename=filename,
                 content_type="image/jpeg",
             )
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.base_url}/pictures/", data=form_data
-                ) as resp:
-                    if resp.status != 200:
-                        raise ApiException(f"Error from the api: status {resp.status}")
+            async with self._guard("send_picture"), self._get_session().post(
+                f"{self.base_url}/pictures/",
+                data=form_data,
+                headers={IDEMPOTENCY_HEADER: client_id},
+            ) as resp:
+                if resp.status == 409:
+                    logger.info(
+                        "Api already has picture",
+                        extra={"timestamp": timestamp, "client_id": client_id},
+                    )
+                    picture_data = await _json_or_empty(resp)
+                    picture_data.setdefault("id", client_id)
+                elif resp.status != 200:
+                    raise _status_error(resp)
+                else:
                     picture_data = await resp.json()
-                    return picture_data["id"]
+            UPLOADED_PICTURES.inc()
+            UPLOADED_BYTES.inc(await run_io(_picture_size, picture))
+        if metadata and not coalesce:
+            await self.queue_update(picture_data["id"], metadata)
+        water_level = picture_data.get("water_level")
+        return SentPicture(
+            picture_data["id"], float(water_level) if water_level is not None else None
+        )
 
     async def update_picture(
         self, picture_id: str, picture_data: dict[str, Any]
     ) -> bool:
-        async with aiohttp.ClientSession() as session:
-            async with session.patch(
-                f"{self.base_url}/pictures/{picture_id}/", json=picture_data
-            ) as resp:
-                if resp.status != 200:
-                    raise ApiException(f"Error from the api: status {resp.status}")
+        await self._patch(
+            "update_picture", f"{self.base_url}/pictures/{picture_id}/", picture_data
+        )
         return True
+
+    async def queue_update(self, picture_id: str, picture_data: dict[str, Any]) -> None:
+        """
+        Queue an update to a picture, to be sent along with others. Updates to the
+        same picture are merged. The queue is flushed once it's full, or in the
+        background once the oldest update has waited ``update_max_delay``, even if
+        nothing else is queued.
+        """
+        self._pending_updates.setdefault(picture_id, {}).update(picture_data)
+        if len(self._pending_updates) >= self.update_batch_size:
+            await self.flush_updates()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_delay())
+
+    def _cancel_flush(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def _flush_after_delay(self) -> None:
+        await asyncio.sleep(self.update_max_delay)
+        # Flushing from here mustn't cancel this task
+        self._flush_task = None
+        try:
+            await self.flush_updates()
+        except Exception as ex:
+            logger.warning(
+                "Unable to send queued picture updates, will try again",
+                extra={"updates": len(self._pending_updates), "error": ex},
+            )
+            if self._session is not None:
+                self._schedule_flush()
+
+    async def flush_updates(self) -> None:
+        """
+        Send every queued update, in one request if the api supports batch
+        updates. Updates the api rejects are dropped, if sending fails otherwise
+        the unsent updates stay queued, under any newer updates to the same
+        pictures.
+        """
+        self._cancel_flush()
+        updates, self._pending_updates = self._pending_updates, {}
+        if not updates:
+            return
+        try:
+            if await self._supports("batch_update"):
+                try:
+                    await self._patch(
+                        "update_pictures",
+                        f"{self.base_url}/pictures/batch/",
+                        {
+                            "updates": [
+                                {"id": picture_id, "data": picture_data}
+                                for picture_id, picture_data in updates.items()
+                            ]
+                        },
+                    )
+                except ApiException as ex:
+                    if not ex.rejected:
+                        raise
+                    logger.error(
+                        "Api rejected picture updates, dropping them",
+                        extra={"updates": len(updates), "error": ex},
+                    )
+                updates = {}
+            for picture_id in list(updates):
+                try:
+                    await self.update_picture(picture_id, updates[picture_id])
+                except ApiException as ex:
+                    if not ex.rejected:
+                        raise
+                    logger.error(
+                        "Api rejected picture update, dropping it",
+                        extra={"picture_id": picture_id, "error": ex},
+                    )
+                del updates[picture_id]
+        except BaseException:
+            for picture_id, picture_data in self._pending_updates.items():
+                updates.setdefault(picture_id, {}).update(picture_data)
+            self._pending_updates = updates
+            raise
+
+    async def _patch(self, operation: str, url: str, data: dict[str, Any]) -> None:
+        body = json.dumps(data).encode()
+        headers = {"Content-Type": "application/json"}
+        if len(body) >= self.gzip_min_bytes and await self._supports("gzip_requests"):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        async with self._guard(operation), self._get_session().patch(
+            url, data=body, headers=headers
+        ) as resp:
+            if resp.status != 200:
+                raise _status_error(resp)
+
+
+def _picture_size(picture: PictureSource) -> int:
+    if isinstance(picture, Path):
+        return picture.stat().st_size
+    return memoryview(picture).nbytes
+
+
+def _total_size(pictures: Sequence[tuple[float, Path]]) -> int:
+    return sum(picture.stat().st_size for _, picture in pictures)
+
+
+def picture_client_id(timestamp: float, picture: PictureSource) -> str:
+    """
+    A stable id for a picture, made from when it was taken and a hash of its
+    contents, so the same picture always gets the same id however many times it
+    is sent.
+    """
+    digest = hashlib.sha256()
+    if isinstance(picture, Path):
+        with open(picture, "rb") as picture_file:
+            for chunk in iter(lambda: picture_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(picture)
+    return f"{timestamp!r}-{digest.hexdigest()[:32]}"
+
+
+async def _client_id(timestamp: float, picture: PictureSource) -> str:
+    return await asyncio.get_running_loop().run_in_executor(
+        None, picture_client_id, timestamp, picture
+    )
+
+
+async def _json_or_empty(resp: aiohttp.ClientResponse) -> dict[str, Any]:
+    try:
+        return await resp.json(content_type=None) or {}
+    except ValueError:
+        return {}
+
+
+def _status_error(resp: aiohttp.ClientResponse) -> ApiException:
+    return ApiException(f"Error from the api: status {resp.status}", resp.status)
+
+
+def _split_batches(
+    pictures: Sequence[tuple[float, Path]], max_size: int, max_bytes: int
+) -> list[list[tuple[float, Path]]]:
+    """
+    Group pictures into batches of at most ``max_size`` pictures and ``max_bytes``
+    bytes. A picture larger than ``max_bytes`` is sent in a batch of its own.
+    This blocks, run it with ``run_io``.
+    """
+    batches: list[list[tuple[float, Path]]] = []
+    batch: list[tuple[float, Path]] = []
+    batch_bytes = 0
+    for timestamp, picture in pictures:
+        picture_bytes = picture.stat().st_size
+        if batch and (
+            len(batch) >= max_size or batch_bytes + picture_bytes > max_bytes
+        ):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append((timestamp, picture))
+        batch_bytes += picture_bytes
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+from typing import Optional
+
+from waterbowl.api_service import ApiException, ApiService
+from waterbowl.enums import BACKLOG_CONCURRENCY
+from waterbowl.file_io import run_io
+from waterbowl.local_storage_service import (
+    LogEntry,
+    acknowledge_log_entries,
+    acknowledge_log_entry,
+    read_storage_log,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BacklogDrainer:
+    """
+    Sends pictures cached in the local storage log while the api was unavailable.
+
+    Up to ``concurrency`` uploads run at once, and every entry is removed from the
+    log as soon as its upload succeeds, so an interrupted drain resumes where it
+    stopped instead of re-sending everything. When the api supports batch uploads
+    each upload packs many entries into one request. Use ``start`` to run the
+    drain as a background task so it never delays the next capture.
+
+    Pictures the api rejects are dropped from the log, like missing pictures, so
+    one bad picture can't hold up the rest of the backlog.
+    """
+
+    def __init__(self, api_service: ApiService, concurrency: int = BACKLOG_CONCURRENCY):
+        if concurrency < 1:
+            raise ValueError("Backlog concurrency must be at least 1")
+        self.api_service = api_service
+        self.concurrency = concurrency
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> asyncio.Task:
+        """
+        Start draining in the background, unless a drain is already running.
+        """
+        if not self.running:
+            self._task = asyncio.create_task(self.drain())
+        return self._task
+
+    async def close(self) -> None:
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def drain(self) -> int:
+        """
+        Send every entry in the storage log, returning how many were sent. The
+        drain stops handing out new entries after the first failure, the
+        remaining entries are picked up by the next drain.
+        """
+        try:
+            if await self.api_service.supports_batch_upload():
+                batch_size, _ = await self.api_service.batch_limits()
+            else:
+                batch_size = 1
+        except Exception as ex:
+            logger.error("Unable to start draining the backlog", extra={"error": ex})
+            return 0
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        failed = asyncio.Event()
+        workers = [
+            asyncio.create_task(self._worker(queue, failed))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            batch: list[LogEntry] = []
+            async for log_entry in read_storage_log():
+                if failed.is_set():
+                    break
+                batch.append(log_entry)
+                if len(batch) >= batch_size:
+                    await queue.put(batch)
+                    batch = []
+            if batch and not failed.is_set():
+                await queue.put(batch)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            sent = await asyncio.gather(*workers)
+        return sum(sent)
+
+    async def _worker(self, queue: asyncio.Queue, failed: asyncio.Event) -> int:
+        sent = 0
+        while (batch := await queue.get()) is not None:
+            if failed.is_set():
+                continue
+            if len(batch) == 1:
+                batch_sent = int(await self._send_entry(batch[0]))
+            else:
+                batch_sent = await self._send_batch(batch)
+            sent += batch_sent
+            if batch_sent < len(batch):
+                failed.set()
+        return sent
+
+    async def _send_batch(self, batch: list[LogEntry]) -> int:
+        sent = 0
+        for log_entry in await run_io(_missing_pictures, batch):
+            await self._drop_missing(log_entry)
+            batch.remove(log_entry)
+            sent += 1
+        try:
+            picture_ids = await self.api_service.send_pictures(
+                [(log_entry.timestamp, log_entry.picture) for log_entry in batch]
+            )
+        except Exception as ex:
+            if not _rejected(ex):
+                logger.error(
+                    "Unable to send batch of cached pictures, leaving them in the log",
+                    extra={"pictures": len(batch), "error": ex},
+                )
+                return sent
+            # Send them one at a time, to find out which the api won't take
+            for log_entry in batch:
+                if not await self._send_entry(log_entry):
+                    break
+                sent += 1
+            return sent
+        for log_entry, picture_id in zip(batch, picture_ids):
+            if picture_id is None:
+                self._log_rejected(log_entry)
+        # Rejected pictures are acknowledged along with the rest, dropping them
+        await acknowledge_log_entries(batch)
+        return sent + len(batch)
+
+    async def _send_entry(self, log_entry: LogEntry) -> bool:
+        logger.debug(
+            "Log entry found, attempting to send",
+            extra={"timestamp": log_entry.timestamp, "picture": log_entry.picture},
+        )
+        try:
+            await self.api_service.send_picture(
+                timestamp=log_entry.timestamp, picture=log_entry.picture
+            )
+        except FileNotFoundError:
+            await self._drop_missing(log_entry)
+            return True
+        except Exception as ex:
+            if not _rejected(ex):
+                logger.error(
+                    "Unable to send cached picture, leaving it in the log",
+                    extra={
+                        "timestamp": log_entry.timestamp,
+                        "picture": log_entry.picture,
+                        "error": ex,
+                    },
+                )
+                return False
+            self._log_rejected(log_entry, ex)
+        await acknowledge_log_entry(log_entry)
+        return True
+
+    @staticmethod
+    def _log_rejected(log_entry: LogEntry, ex: Optional[Exception] = None) -> None:
+        # Sending it again won't help, drop the entry so it doesn't block the log
+        logger.error(
+            "Cached picture rejected by the api, dropping log entry",
+            extra={
+                "timestamp": log_entry.timestamp,
+                "picture": log_entry.picture,
+                "error": ex,
+            },
+        )
+
+    @staticmethod
+    async def _drop_missing(log_entry: LogEntry) -> None:
+        # Nothing left to send, drop the entry so it doesn't block the log
+        logger.error(
+            "Cached picture missing, dropping log entry",
+            extra={"timestamp": log_entry.timestamp, "picture": log_entry.picture},
+        )
+        await acknowledge_log_entry(log_entry)
+
+
+def _rejected(ex: Exception) -> bool:
+    return isinstance(ex, ApiException) and ex.rejected
+
+
+def _missing_pictures(entries: list[LogEntry]) -> list[LogEntry]:
+    """
+    The entries whose cached picture is gone. This blocks, run it with ``run_io``.
+    """
+    return [entry for entry in entries if not entry.picture.exists()]
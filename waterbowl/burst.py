@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import shutil
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Any, Optional
+
+from waterbowl.camera_service import AbstractCameraService
+from waterbowl.enums import (
+    BURST_BUDGET,
+    BURST_FRAMES,
+    BURST_OCCLUSION_TOLERANCE,
+    BURST_REFERENCE_PICTURE,
+    BURST_WORKERS,
+)
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Frames are scored at this size, big enough for blur to show
+SCORE_SIZE = (320, 240)
+
+
+def greyscale(picture: Path, size: tuple[int, int] = SCORE_SIZE) -> "np.ndarray":
+    """
+    A small greyscale version of a picture, as floats from 0 to 255.
+    """
+    # Imported here, in the scoring workers, so NumPy and Pillow aren't loaded on
+    # the event loop before the first picture is taken, see
+    # waterbowl.run_waterbowl_watcher.NETWORK_MODULES
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(picture) as image:
+        # Let the JPEG decoder downscale while decoding, which is far cheaper
+        # than decoding the full picture and resizing it
+        image.draft("L", size)
+        return np.asarray(
+            image.convert("L").resize(size, Image.Resampling.BOX), dtype=np.float32
+        )
+
+
+def sharpness(pixels: "np.ndarray") -> float:
+    """
+    The variance of the picture's Laplacian, which is high when there are sharp
+    edges and drops as the picture blurs.
+    """
+    laplacian = (
+        pixels[:-2, 1:-1]
+        + pixels[2:, 1:-1]
+        + pixels[1:-1, :-2]
+        + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def occlusion(pixels: "np.ndarray", reference: "np.ndarray") -> float:
+    """
+    Mean absolute difference between the picture's pixels and the reference's,
+    from 0 for the same scene to 255. Something in front of the camera, like a
+    cat's head, makes it jump.
+    """
+    import numpy as np
+
+    return float(np.abs(pixels - reference).mean())
+
+
+class FrameScore:
+    def __init__(
+        self, sharpness: float, occlusion: Optional[float], pixels: "np.ndarray"
+    ):
+        self.sharpness = sharpness
+        self.occlusion = occlusion
+        self.pixels = pixels
+
+
+def best_frame(scores: list[FrameScore], occlusion_tolerance: float) -> int:
+    """
+    The index of the best frame: the sharpest of the frames within
+    ``occlusion_tolerance`` of the least blocked frame.
+    """
+    occlusions = [score.occlusion for score in scores if score.occlusion is not None]
+    least_occlusion = min(occlusions) if occlusions else None
+    candidates = [
+        index
+        for index, score in enumerate(scores)
+        if least_occlusion is None
+        or score.occlusion <= least_occlusion + occlusion_tolerance
+    ]
+    return max(candidates, key=lambda index: scores[index].sharpness)
+
+
+class BurstCapture:
+    """
+    Takes a burst of pictures and keeps the best one, so a blurry picture, or a
+    cat in the way, doesn't cost a whole interval.
+
+    Frames are scored in a worker pool while the rest of the burst is taken, for
+    sharpness and for how much they differ from a reference picture of the scene.
+    Without a reference picture, the last frame kept is the reference. The burst
+    stops early to stay within ``budget`` seconds.
+    """
+
+    def __init__(
+        self,
+        frames: int = BURST_FRAMES,
+        budget: float = BURST_BUDGET,
+        reference_picture: Optional[Path] = BURST_REFERENCE_PICTURE,
+        occlusion_tolerance: float = BURST_OCCLUSION_TOLERANCE,
+        executor: Optional[Executor] = None,
+    ):
+        if frames < 1:
+            raise ValueError(f"A burst needs at least one frame, got {frames}")
+        self.frames = frames
+        self.budget = budget
+        self.reference_picture = reference_picture
+        self.occlusion_tolerance = occlusion_tolerance
+        self._reference: Optional["np.ndarray"] = None
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=BURST_WORKERS, thread_name_prefix="burst-score"
+        )
+
+    def _score(self, picture: Path) -> FrameScore:
+        if self._reference is None and self.reference_picture is not None:
+            self._reference = greyscale(self.reference_picture)
+        pixels = greyscale(picture)
+        return FrameScore(
+            sharpness(pixels),
+            occlusion(pixels, self._reference) if self._reference is not None else None,
+            pixels,
+        )
+
+    async def take_picture(
+        self, cam: AbstractCameraService, filepath: Path
+    ) -> dict[str, Any]:
+        """
+        Take a burst and move the best frame to ``filepath``, returning metadata
+        describing the burst.
+        """
+        if filepath.exists():
+            raise FileExistsError()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        with TemporaryDirectory(dir=filepath.parent) as burst_dir:
+            frames = []
+            scoring = []
+            async for frame in cam.take_burst(Path(burst_dir), self.frames, deadline):
+                frames.append(frame)
+                scoring.append(loop.run_in_executor(self.executor, self._score, frame))
+            results = await asyncio.gather(*scoring, return_exceptions=True)
+            scored = []
+            for index, result in enumerate(results):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        "Unable to score burst picture",
+                        extra={"frame_number": index, "error": result},
+                    )
+                else:
+                    scored.append((index, result))
+            if not scored:
+                shutil.move(frames[0], filepath)
+                return {"burst": {"frames": len(frames), "chosen": 0}}
+            best, score = scored[
+                best_frame([score for _, score in scored], self.occlusion_tolerance)
+            ]
+            shutil.move(frames[best], filepath)
+        if self.reference_picture is None:
+            self._reference = score.pixels
+        return {
+            "burst": {
+                "frames": len(frames),
+                "chosen": best,
+                "sharpness": score.sharpness,
+                "occlusion": score.occlusion,
+            }
+        }
+
+    def close(self) -> None:
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,161 @@
+import json
+import re
+from pathlib import Path
+from typing import Any, Iterator, Optional, Sequence
+
+from waterbowl.camera_service import AbstractCameraService, camera_service_factory
+from waterbowl.enums import (
+    BURST_REFERENCE_PICTURE,
+    CAMERA_BACKEND,
+    CAMERA_ID,
+    CAMERAS_FILE,
+    WAIT_TIME,
+    WATER_LEVEL_ROI,
+    CameraBackends,
+    _seconds,
+)
+from waterbowl.image_transform import TransformSettings
+
+# Camera ids go into file names, keep them to characters that are safe there
+CAMERA_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+TRANSFORM_KEYS = ("crop", "max_size", "quality")
+
+
+class CameraConfig:
+    """
+    One camera: its id, which its pictures are tagged with, the camera backend,
+    any extra ``libcamera-still`` options (like ``--camera 1`` for the second
+    camera), how often it takes pictures, and how its pictures are transformed.
+    The water level, configured by the WATER_LEVEL_ settings, is only estimated
+    for a camera with ``water_level`` set. A burst reference picture is only used
+    for the camera it's given for, other cameras compare each burst with the
+    last picture they kept.
+    """
+
+    def __init__(
+        self,
+        camera_id: str,
+        backend: str = CAMERA_BACKEND,
+        options: Sequence[str] = (),
+        interval: float = WAIT_TIME,
+        transform: Optional[TransformSettings] = None,
+        water_level: bool = False,
+        burst_reference_picture: Optional[Path] = None,
+    ):
+        if not CAMERA_ID_PATTERN.fullmatch(camera_id):
+            raise ValueError(
+                f"Camera id must be letters, digits, _, . and -, got {camera_id!r}"
+            )
+        if backend not in {backend.value for backend in CameraBackends}:
+            raise ValueError(f"Unknown camera backend {backend!r} for {camera_id}")
+        if interval <= 0:
+            raise ValueError(f"Capture interval must be positive, got {interval}")
+        self.camera_id = camera_id
+        self.backend = backend
+        self.options = list(options)
+        self.interval = interval
+        self.transform = transform or TransformSettings()
+        self.water_level = water_level
+        self.burst_reference_picture = burst_reference_picture
+
+    @classmethod
+    def from_dict(cls, config: dict[str, Any]) -> "CameraConfig":
+        """
+        A camera from its entry in the cameras file, like:
+
+            {"id": "food", "options": ["--camera", "1"], "interval": "5m",
+             "max_size": [1280, 960], "quality": 80}
+
+        Only ``id`` is needed. Transform settings that aren't given come from
+        the TRANSFORM_ settings.
+        """
+        unknown = set(config) - {
+            "id",
+            "backend",
+            "options",
+            "interval",
+            "water_level",
+            "burst_reference_picture",
+            *TRANSFORM_KEYS,
+        }
+        if unknown:
+            raise ValueError(f"Unknown camera settings: {', '.join(sorted(unknown))}")
+        transform = {
+            key: tuple(config[key]) if isinstance(config[key], list) else config[key]
+            for key in TRANSFORM_KEYS
+            if key in config
+        }
+        interval = config.get("interval")
+        return cls(
+            camera_id=str(config.get("id", "")),
+            backend=config.get("backend", CAMERA_BACKEND),
+            options=[str(option) for option in config.get("options", [])],
+            interval=WAIT_TIME if interval is None else _seconds(interval),
+            transform=TransformSettings(**transform),
+            water_level=bool(config.get("water_level", False)),
+            burst_reference_picture=(
+                Path(config["burst_reference_picture"])
+                if config.get("burst_reference_picture")
+                else None
+            ),
+        )
+
+    def camera_service(self) -> AbstractCameraService:
+        return camera_service_factory(self.backend)(options=self.options)
+
+
+class CameraRegistry:
+    """
+    The cameras watched by this device, by id.
+    """
+
+    def __init__(self, cameras: Sequence[CameraConfig]):
+        if not cameras:
+            raise ValueError("At least one camera is needed")
+        self._cameras: dict[str, CameraConfig] = {}
+        for camera in cameras:
+            if camera.camera_id in self._cameras:
+                raise ValueError(f"Camera id {camera.camera_id} is used twice")
+            self._cameras[camera.camera_id] = camera
+
+    @classmethod
+    def from_file(cls, cameras_file: Path) -> "CameraRegistry":
+        """
+        The cameras listed in a JSON file, see ``CameraConfig.from_dict``.
+        """
+        with open(cameras_file) as config_file:
+            cameras = json.load(config_file)
+        if not isinstance(cameras, list):
+            raise ValueError(f"{cameras_file} must hold a list of cameras")
+        return cls([CameraConfig.from_dict(camera) for camera in cameras])
+
+    @property
+    def camera_ids(self) -> list[str]:
+        return list(self._cameras)
+
+    def __getitem__(self, camera_id: str) -> CameraConfig:
+        return self._cameras[camera_id]
+
+    def __iter__(self) -> Iterator[CameraConfig]:
+        return iter(self._cameras.values())
+
+    def __len__(self) -> int:
+        return len(self._cameras)
+
+
+def default_camera() -> CameraConfig:
+    """
+    The one camera watched without a cameras file, set up by the environment.
+    """
+    return CameraConfig(
+        CAMERA_ID,
+        water_level=WATER_LEVEL_ROI is not None,
+        burst_reference_picture=BURST_REFERENCE_PICTURE,
+    )
+
+
+def camera_registry(cameras_file: Optional[Path] = CAMERAS_FILE) -> CameraRegistry:
+    if cameras_file is None:
+        return CameraRegistry([default_camera()])
+    return CameraRegistry.from_file(cameras_file)
@@ -1,29 +1,69 @@
 import asyncio
 import logging
+import os
 import shutil
-import subprocess
 from abc import ABC, abstractmethod
+from asyncio.subprocess import Process
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import AsyncIterator, Optional, Sequence
 
-from waterbowl.enums import ENVIRONMENT, ROOT_DIR, Environments
+from waterbowl.enums import (
+    CAMERA_BACKEND,
+    CAMERA_CAPTURE_TIMEOUT,
+    CAPTURE_DIR,
+    ENVIRONMENT,
+    ROOT_DIR,
+    CameraBackends,
+    Environments,
+)
+from waterbowl.file_io import move_file, run_io
 
 TEST_FILE = ROOT_DIR.joinpath("tests", "testdata", "test_image.jpg")
 
 logger = logging.getLogger(__name__)
 
 
-def take_picture_sync(command: list[str]) -> None:
-    process = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+class CameraCaptureError(Exception):
+    """
+    Raised if there is an error when capturing an image.
+    """
+
+
+async def run_capture_command(
+    command: list[str], timeout: float = CAMERA_CAPTURE_TIMEOUT
+) -> None:
+    """
+    Run a capture command to completion without blocking the event loop, killing
+    it if it takes longer than ``timeout`` seconds. Its output is logged.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
     )
-    while True:
-        return_code = process.poll()
-        if return_code or return_code == 0:
-            print("RETURN CODE", return_code)
-            # Process has finished, read rest of the output
-            for output in process.stdout.readlines():
-                print(output.strip())
-            break
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error(
+            "Capture command timed out, killed it.",
+            extra={"command": command, "timeout": timeout},
+        )
+        raise CameraCaptureError(f"Capture command timed out after {timeout}s")
+    extra = {
+        "command": command,
+        "return_code": process.returncode,
+        "stdout": stdout.decode(errors="replace").splitlines(),
+        "stderr": stderr.decode(errors="replace").splitlines(),
+    }
+    if process.returncode != 0:
+        logger.error("Capture command failed.", extra=extra)
+        raise CameraCaptureError(
+            f"Capture command exited with status {process.returncode}"
+        )
+    logger.debug("Capture command finished.", extra=extra)
 
 
 class AbstractCameraService(ABC):
@@ -34,51 +74,279 @@ class AbstractCameraService(ABC):
     def __init__(self):
         raise NotImplementedError()
 
+    async def __aenter__(self) -> "AbstractCameraService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """
+        Prepare the camera for taking pictures. Services that keep the camera
+        running between pictures start it here.
+        """
+
+    async def close(self) -> None:
+        """
+        Release the camera.
+        """
+
     @abstractmethod
     async def take_picture(self, filepath: Path) -> Path:
         raise NotImplementedError()
 
+    async def take_burst(
+        self, directory: Path, frames: int, deadline: Optional[float] = None
+    ) -> AsyncIterator[Path]:
+        """
+        Take up to ``frames`` pictures back to back into ``directory``, yielding
+        each one as soon as it's taken. No more are started once the next one
+        wouldn't be done by ``deadline``, on the event loop's clock, judging by
+        how long the last one took. The first picture is always taken, and its
+        errors raised, a later picture failing ends the burst early.
+        """
+        loop = asyncio.get_running_loop()
+        for frame_number in range(frames):
+            started = loop.time()
+            picture = directory.joinpath(f"burst{frame_number:03d}.jpg")
+            try:
+                await self.take_picture(picture)
+            except Exception as ex:
+                if frame_number == 0:
+                    raise
+                logger.warning(
+                    "Burst picture failed, ending the burst early",
+                    extra={"frame_number": frame_number, "error": ex},
+                )
+                return
+            frame_time = loop.time() - started
+            yield picture
+            if deadline is not None and loop.time() + frame_time > deadline:
+                return
+
 
 class MockCameraService(AbstractCameraService):
+    """
+    Pretends to take a picture by copying ``picture``, the test image by default.
+    A real camera has to start up and converge its exposure and white balance
+    before it can take a picture, which ``startup_time`` simulates, and then
+    takes ``frame_time`` to capture a frame. This mock pays the startup cost for
+    every picture. Instances share nothing, so any number of virtual cameras can
+    run at once.
+    """
 
     picture_command: list[str] = ["echo", "squak"]
 
-    def __init__(self):
-        self.loop = asyncio.get_event_loop()
+    def __init__(
+        self,
+        startup_time: float = 0.0,
+        frame_time: float = 0.0,
+        options: Sequence[str] = (),
+        picture: Path = TEST_FILE,
+    ):
+        self.startup_time = startup_time
+        self.frame_time = frame_time
+        self.options = list(options)
+        self.picture = picture
 
-    async def take_picture(self, filepath: Path) -> Path:
+    async def _capture(self, filepath: Path) -> Path:
         if filepath.exists():
             raise FileExistsError()
-        await self.loop.run_in_executor(None, take_picture_sync, self.picture_command)
-        await self.loop.run_in_executor(None, shutil.copy, TEST_FILE, filepath)
+        await run_capture_command([*self.picture_command, *self.options])
+        await run_io(shutil.copy, self.picture, filepath)
         return filepath
 
+    async def take_picture(self, filepath: Path) -> Path:
+        await asyncio.sleep(self.startup_time + self.frame_time)
+        return await self._capture(filepath)
 
-class CameraCaptureError(Exception):
+
+class MockPersistentCameraService(MockCameraService):
     """
-    Raised if there is an error when capturing an image.
+    Mock of a camera that stays warm between pictures, so the startup cost is only
+    paid once and every picture takes ``frame_time``.
     """
 
+    def __init__(
+        self,
+        startup_time: float = 0.0,
+        frame_time: float = 0.0,
+        options: Sequence[str] = (),
+        picture: Path = TEST_FILE,
+    ):
+        super().__init__(startup_time, frame_time, options, picture)
+        self.warm = False
+
+    async def start(self) -> None:
+        if not self.warm:
+            await asyncio.sleep(self.startup_time)
+            self.warm = True
+
+    async def close(self) -> None:
+        self.warm = False
+
+    async def take_picture(self, filepath: Path) -> Path:
+        await self.start()
+        await asyncio.sleep(self.frame_time)
+        return await self._capture(filepath)
+
 
 class CameraService(AbstractCameraService):
 
     picture_command: list[str] = ["libcamera-still", "-o"]
 
-    def __init__(self):
-        self.loop = asyncio.get_event_loop()
+    def __init__(self, options: Sequence[str] = ()):
+        self.options = list(options)
 
     async def take_picture(self, filepath: Path) -> Path:
         logger.info("Taking picture.", extra={"picture_file": filepath})
         if filepath.exists():
             raise FileExistsError()
-        command = [*self.picture_command, str(filepath)]
-        await self.loop.run_in_executor(None, take_picture_sync, command)
+        command = [*self.picture_command, str(filepath), *self.options]
+        await run_capture_command(command)
         if not filepath.exists():
             raise CameraCaptureError()
         return filepath
 
 
-def camera_service_factory() -> type[AbstractCameraService]:
+class PersistentCameraService(AbstractCameraService):
+    """
+    Keeps a single ``libcamera-still`` process running with the camera pipeline
+    warm, and triggers a capture by pressing enter on its stdin (key presses are
+    buffered until the process is ready for them, unlike signals). This avoids
+    starting the camera stack and converging exposure and white balance for every
+    picture, so a picture only takes about one frame.
+
+    Pictures are written by the process into a spool directory under
+    ``capture_dir``, numbered from zero, and moved to the requested path once
+    complete. If the process dies, or
+    doesn't deliver a picture in time, it is restarted on the next picture.
+
+    Any ``options`` are passed on to ``libcamera-still``, like ``--camera 1`` to
+    use the second camera.
+    """
+
+    picture_command: list[str] = [
+        "libcamera-still",
+        "--nopreview",
+        "--timeout",
+        "0",
+        "--keypress",
+    ]
+    # How often to check whether the requested picture has been written
+    poll_interval: float = 0.02
+
+    def __init__(
+        self,
+        capture_timeout: float = CAMERA_CAPTURE_TIMEOUT,
+        capture_dir: Optional[Path] = CAPTURE_DIR,
+        options: Sequence[str] = (),
+    ):
+        self.capture_timeout = capture_timeout
+        self.capture_dir = capture_dir
+        self.options = list(options)
+        self._process: Optional[Process] = None
+        self._spool_dir: Optional[TemporaryDirectory] = None
+        self._frame_number = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    def _spool_file(self, frame_number: int) -> Path:
+        return Path(self._spool_dir.name).joinpath(f"frame{frame_number:05d}.jpg")
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        if self._spool_dir is None:
+            self._spool_dir = TemporaryDirectory(dir=self.capture_dir)
+        command = [
+            *self.picture_command,
+            *self.options,
+            "-o",
+            str(Path(self._spool_dir.name).joinpath("frame%05d.jpg")),
+        ]
+        logger.info("Starting camera.", extra={"command": command})
+        self._process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self._frame_number = 0
+
+    async def _stop_process(self) -> None:
+        if not self.running:
+            self._process = None
+            return
+        try:
+            # Typing x asks libcamera-still to exit cleanly
+            await self._send_keypress(b"x\n")
+            await asyncio.wait_for(self._process.wait(), timeout=self.capture_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self._process.kill()
+            await self._process.wait()
+        self._process = None
+
+    async def close(self) -> None:
+        await self._stop_process()
+        if self._spool_dir is not None:
+            self._spool_dir.cleanup()
+            self._spool_dir = None
+
+    async def _send_keypress(self, keys: bytes) -> None:
+        self._process.stdin.write(keys)
+        await self._process.stdin.drain()
+
+    async def _wait_for_frame(self, spool_file: Path) -> None:
+        # The picture is complete once the JPEG end of image marker is written
+        while not _is_complete_jpeg(spool_file):
+            if not self.running:
+                raise CameraCaptureError("Camera process exited")
+            await asyncio.sleep(self.poll_interval)
+
+    async def take_picture(self, filepath: Path) -> Path:
+        logger.info("Taking picture.", extra={"picture_file": filepath})
+        if filepath.exists():
+            raise FileExistsError()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await self.start()
+            spool_file = self._spool_file(self._frame_number)
+            self._frame_number += 1
+            try:
+                await self._send_keypress(b"\n")
+                await asyncio.wait_for(
+                    self._wait_for_frame(spool_file), timeout=self.capture_timeout
+                )
+            except (asyncio.TimeoutError, ConnectionError, CameraCaptureError) as ex:
+                await self._stop_process()
+                raise CameraCaptureError("Camera didn't deliver a picture") from ex
+        await run_io(move_file, spool_file, filepath)
+        return filepath
+
+
+def _is_complete_jpeg(picture: Path) -> bool:
+    try:
+        with open(picture, "rb") as picture_file:
+            picture_file.seek(-2, os.SEEK_END)
+            return picture_file.read(2) == b"\xff\xd9"
+    except OSError:
+        return False
+
+
+def camera_service_factory(
+    backend: Optional[str] = None,
+) -> type[AbstractCameraService]:
+    backend = backend or CAMERA_BACKEND
     if ENVIRONMENT == Environments.PROD:
+        if backend == CameraBackends.PERSISTENT:
+            return PersistentCameraService
         return CameraService
+    if backend == CameraBackends.PERSISTENT:
+        return MockPersistentCameraService
     return MockCameraService
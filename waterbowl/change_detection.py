@@ -0,0 +1,80 @@
+import asyncio
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageChops, ImageStat
+
+from waterbowl.enums import CHANGE_MAX_SKIPPED, CHANGE_THRESHOLD
+
+THUMBNAIL_SIZE = (32, 24)
+
+
+def picture_thumbnail(
+    picture: Path, size: tuple[int, int] = THUMBNAIL_SIZE
+) -> Image.Image:
+    """
+    A tiny greyscale version of a picture, cheap to compare with another one.
+    """
+    with Image.open(picture) as image:
+        # Let the JPEG decoder downscale while decoding, which is far cheaper
+        # than decoding the full picture and resizing it
+        image.draft("L", (size[0] * 4, size[1] * 4))
+        return image.convert("L").resize(size, Image.Resampling.BOX)
+
+
+def thumbnail_difference(first: Image.Image, second: Image.Image) -> float:
+    """
+    Mean absolute difference between two thumbnails' pixels, from 0 for identical
+    thumbnails to 255.
+    """
+    return ImageStat.Stat(ImageChops.difference(first, second)).mean[0]
+
+
+class ChangeDetector:
+    """
+    Decides whether a picture has changed since the last picture that was uploaded.
+
+    Pictures are shrunk to a small greyscale thumbnail, and a picture is unchanged
+    when its thumbnail's mean difference from the last uploaded picture's is at
+    most ``threshold``. Unchanged pictures don't need to be uploaded again, but
+    after ``max_skipped`` unchanged pictures in a row the next one is treated as
+    changed so the api still gets a fresh picture regularly.
+    """
+
+    def __init__(
+        self,
+        threshold: float = CHANGE_THRESHOLD,
+        max_skipped: int = CHANGE_MAX_SKIPPED,
+        thumbnail_size: tuple[int, int] = THUMBNAIL_SIZE,
+    ):
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.thumbnail_size = thumbnail_size
+        self.last_thumbnail: Optional[Image.Image] = None
+        self.last_picture_id: Optional[str] = None
+        self.skipped = 0
+
+    async def thumbnail(self, picture: Path) -> Image.Image:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, picture_thumbnail, picture, self.thumbnail_size
+        )
+
+    def unchanged(self, thumbnail: Image.Image) -> bool:
+        if self.last_thumbnail is None or self.skipped >= self.max_skipped:
+            return False
+        return thumbnail_difference(self.last_thumbnail, thumbnail) <= self.threshold
+
+    def skip(self) -> None:
+        """
+        Record that an unchanged picture wasn't uploaded.
+        """
+        self.skipped += 1
+
+    def remember(self, thumbnail: Image.Image, picture_id: str) -> None:
+        """
+        Record the picture that was uploaded, future pictures are compared to it.
+        """
+        self.last_thumbnail = thumbnail
+        self.last_picture_id = picture_id
+        self.skipped = 0
@@ -0,0 +1,103 @@
+import logging
+import random
+import time
+from typing import Callable, Optional
+
+from waterbowl.enums import (
+    API_BREAKER_BACKOFF,
+    API_BREAKER_FAILURES,
+    API_BREAKER_MAX_BACKOFF,
+    BreakerStates,
+)
+from waterbowl.metrics import record_breaker_state
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Tracks whether a remote service is worth calling.
+
+    The breaker starts closed. After ``failure_threshold`` failures in a row it
+    opens, and calls should fail fast without touching the service. Once the
+    backoff has passed it's half open, and a single trial call decides whether it
+    closes again or reopens. Each time it reopens the backoff doubles, up to
+    ``max_backoff``, and the actual wait is picked between half and all of the
+    backoff so that clients don't retry in lockstep.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = API_BREAKER_FAILURES,
+        base_backoff: float = API_BREAKER_BACKOFF,
+        max_backoff: float = API_BREAKER_MAX_BACKOFF,
+        clock: Callable[[], float] = time.monotonic,
+        uniform: Callable[[float, float], float] = random.uniform,
+    ):
+        if failure_threshold < 1:
+            raise ValueError(
+                f"Failure threshold must be at least 1, got {failure_threshold}"
+            )
+        if not 0 < base_backoff <= max_backoff:
+            raise ValueError(
+                f"Backoff must be positive and at most {max_backoff}, got {base_backoff}"
+            )
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.uniform = uniform
+        self.failures = 0
+        self.openings = 0
+        self._state = BreakerStates.CLOSED
+        self._retry_at: Optional[float] = None
+        record_breaker_state(self._state)
+
+    @property
+    def state(self) -> BreakerStates:
+        if self._state == BreakerStates.OPEN and self.clock() >= self._retry_at:
+            self._transition(BreakerStates.HALF_OPEN)
+        return self._state
+
+    @property
+    def retry_in(self) -> float:
+        """
+        Seconds until an open breaker lets a trial call through.
+        """
+        if self.state != BreakerStates.OPEN:
+            return 0.0
+        return self._retry_at - self.clock()
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.openings = 0
+        self._retry_at = None
+        if self._state != BreakerStates.CLOSED:
+            self._transition(BreakerStates.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        state = self.state
+        # Calls that were already under way when the breaker opened don't count
+        if state == BreakerStates.HALF_OPEN or (
+            state == BreakerStates.CLOSED and self.failures >= self.failure_threshold
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        backoff = min(self.max_backoff, self.base_backoff * 2**self.openings)
+        self.openings += 1
+        self._retry_at = self.clock() + self.uniform(backoff / 2, backoff)
+        self._transition(BreakerStates.OPEN)
+
+    def _transition(self, state: BreakerStates) -> None:
+        logger.warning(
+            "Api circuit breaker state changed",
+            extra={
+                "breaker_state": state.value,
+                "failures": self.failures,
+                "retry_at": self._retry_at,
+            },
+        )
+        self._state = state
+        record_breaker_state(state)
@@ -1,6 +1,9 @@
+import math
 import os
+import socket
 from enum import Enum
 from pathlib import Path
+from typing import Optional, Union
 
 
 class Environments(str, Enum):
@@ -8,9 +11,226 @@ class Environments(str, Enum):
     DEV = "dev"
 
 
+class CameraBackends(str, Enum):
+    # Start a new libcamera-still process for every picture
+    ONESHOT = "oneshot"
+    # Keep one libcamera-still process running and trigger captures with signals
+    PERSISTENT = "persistent"
+
+
+class ScheduleModes(str, Enum):
+    # Take a picture every WAIT_TIME
+    FIXED = "fixed"
+    # Take pictures more often while something is happening, less often at night
+    # or on battery power
+    ADAPTIVE = "adaptive"
+
+
+class BreakerStates(str, Enum):
+    # Requests go to the api
+    CLOSED = "closed"
+    # The api is failing, requests fail fast until the backoff has passed
+    OPEN = "open"
+    # The backoff has passed, the next request checks whether the api is back
+    HALF_OPEN = "half_open"
+
+
+class EvictionPolicies(str, Enum):
+    OLDEST_FIRST = "oldest_first"
+    EVERY_NTH = "every_nth"
+    LATEST_PER_HOUR = "latest_per_hour"
+
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60}
+
+
+def _seconds(value: Union[str, float]) -> float:
+    """
+    Parse a duration in seconds, either a bare number or one suffixed with s, m
+    or h, like ``90``, ``90s``, ``1.5m`` or ``1h``.
+    """
+    text = str(value).strip().lower()
+    multiplier = _DURATION_UNITS.get(text[-1:]) if text else None
+    try:
+        seconds = float(text[:-1] if multiplier else text) * (multiplier or 1)
+    except ValueError:
+        raise ValueError(f"Invalid duration: {value!r}") from None
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"Duration must be positive: {value!r}")
+    return seconds
+
+
+_SHARED_MEMORY_DIR = Path("/dev/shm")
+
+
+def _capture_dir(value: Optional[str]) -> Optional[Path]:
+    if value is None:
+        return _SHARED_MEMORY_DIR if _SHARED_MEMORY_DIR.is_dir() else None
+    return Path(value) if value else None
+
+
 API_BASE_URL = os.environ.get("API_BASE_URL", "http://levan.home/api/waterbowl/v1")
 ENVIRONMENT = os.environ.get("ENVIRONMENT", Environments.DEV)
-WAIT_TIME = os.environ.get("WAIT_TIME", 10 * 60)  # Wait for 10 minutes
+WAIT_TIME = _seconds(os.environ.get("WAIT_TIME", 10 * 60))  # Wait for 10 minutes
+CAMERA_BACKEND = os.environ.get("CAMERA_BACKEND", CameraBackends.PERSISTENT)
+# How long to wait for a warm camera to deliver a picture before restarting it
+CAMERA_CAPTURE_TIMEOUT = float(os.environ.get("CAMERA_CAPTURE_TIMEOUT", 30))
+# Pictures are taken into, and wait to be uploaded in, CAPTURE_DIR. It defaults to
+# /dev/shm, which is in memory, so a picture is only written to the SD card if it
+# has to be stored locally. An empty CAPTURE_DIR uses the system's temporary
+# directory instead.
+CAPTURE_DIR = _capture_dir(os.environ.get("CAPTURE_DIR"))
+# With several cameras, every picture is tagged with the id of the camera that
+# took it. Without a CAMERAS_FILE there's one camera, CAMERA_ID, set up by the
+# settings in this file.
+# CAMERAS_FILE is a JSON list of cameras, each with its own settings, see
+# waterbowl.camera_registry.
+CAMERA_ID = os.environ.get("CAMERA_ID", socket.gethostname())
+CAMERAS_FILE = (
+    Path(os.environ["CAMERAS_FILE"]) if "CAMERAS_FILE" in os.environ else None
+)
+
+# Connection pool settings for the shared api session. The keep-alive timeout is
+# longer than the wait time so the connection is still warm for the next cycle.
+API_CONNECTION_LIMIT = int(os.environ.get("API_CONNECTION_LIMIT", 4))
+API_DNS_CACHE_TTL = int(os.environ.get("API_DNS_CACHE_TTL", 60 * 60))
+API_KEEPALIVE_TIMEOUT = float(os.environ.get("API_KEEPALIVE_TIMEOUT", 15 * 60))
+API_TOTAL_TIMEOUT = float(os.environ.get("API_TOTAL_TIMEOUT", 60))
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", 10))
+
+# After API_BREAKER_FAILURES failed requests in a row the api is left alone for
+# API_BREAKER_BACKOFF seconds, doubling every time it's still failing afterwards
+# up to API_BREAKER_MAX_BACKOFF, with jitter
+API_BREAKER_FAILURES = int(os.environ.get("API_BREAKER_FAILURES", 3))
+API_BREAKER_BACKOFF = float(os.environ.get("API_BREAKER_BACKOFF", 30))
+API_BREAKER_MAX_BACKOFF = float(os.environ.get("API_BREAKER_MAX_BACKOFF", 30 * 60))
+
+# Upper limits for batch uploads of cached pictures, the api can lower them
+API_BATCH_MAX_SIZE = int(os.environ.get("API_BATCH_MAX_SIZE", 50))
+API_BATCH_MAX_BYTES = int(os.environ.get("API_BATCH_MAX_BYTES", 16 * 1024 * 1024))
+
+# Picture metadata the api can't take with the upload is sent in batches, once
+# API_UPDATE_BATCH_SIZE updates are waiting or the oldest has waited
+# API_UPDATE_MAX_DELAY seconds. Request bodies of at least API_GZIP_MIN_BYTES
+# are compressed if the api accepts it.
+API_UPDATE_BATCH_SIZE = int(os.environ.get("API_UPDATE_BATCH_SIZE", 20))
+API_UPDATE_MAX_DELAY = float(os.environ.get("API_UPDATE_MAX_DELAY", 60))
+API_GZIP_MIN_BYTES = int(os.environ.get("API_GZIP_MIN_BYTES", 1024))
+
+# Number of cached pictures uploaded at once when draining the backlog
+BACKLOG_CONCURRENCY = int(os.environ.get("BACKLOG_CONCURRENCY", 4))
+
+# Pictures whose thumbnail differs from the last uploaded picture's by at most
+# this much (mean pixel difference, 0-255) are not uploaded again, a negative
+# threshold turns the check off. At most CHANGE_MAX_SKIPPED pictures in a row
+# are skipped.
+CHANGE_THRESHOLD = float(os.environ.get("CHANGE_THRESHOLD", 2.0))
+CHANGE_MAX_SKIPPED = int(os.environ.get("CHANGE_MAX_SKIPPED", 5))
+
+
+def _int_tuple(value: Optional[str], separator: str) -> Optional[tuple[int, ...]]:
+    if not value:
+        return None
+    return tuple(int(part) for part in value.split(separator))
+
+
+# Optional transform applied to every picture before it's uploaded or cached.
+# TRANSFORM_CROP is a left,upper,right,lower box around the water bowl,
+# TRANSFORM_MAX_SIZE a WIDTHxHEIGHT the picture is shrunk to fit, and
+# TRANSFORM_QUALITY the JPEG quality it's re-encoded at. Unset settings are skipped.
+TRANSFORM_CROP = _int_tuple(os.environ.get("TRANSFORM_CROP"), ",")
+TRANSFORM_MAX_SIZE = _int_tuple(os.environ.get("TRANSFORM_MAX_SIZE"), "x")
+TRANSFORM_QUALITY = (
+    int(os.environ["TRANSFORM_QUALITY"]) if "TRANSFORM_QUALITY" in os.environ else None
+)
+
+# Take BURST_FRAMES pictures back to back, within BURST_BUDGET seconds, and only
+# keep the best: the least blocked, compared with BURST_REFERENCE_PICTURE (or
+# the last picture kept), and the sharpest of those within
+# BURST_OCCLUSION_TOLERANCE (mean pixel difference, 0-255) of it. Frames are
+# scored by BURST_WORKERS threads while the rest are taken. One frame turns
+# bursts off, bursts work best with the persistent camera backend.
+BURST_FRAMES = int(os.environ.get("BURST_FRAMES", 1))
+BURST_BUDGET = _seconds(os.environ.get("BURST_BUDGET", 5))
+BURST_REFERENCE_PICTURE = (
+    Path(os.environ["BURST_REFERENCE_PICTURE"])
+    if "BURST_REFERENCE_PICTURE" in os.environ
+    else None
+)
+BURST_OCCLUSION_TOLERANCE = float(os.environ.get("BURST_OCCLUSION_TOLERANCE", 2.0))
+BURST_WORKERS = int(os.environ.get("BURST_WORKERS", 2))
+
+# Optional estimate of the water level on the device, from 0 (empty) to 1 (full),
+# added to every picture's metadata. WATER_LEVEL_ROI is a left,upper,right,lower
+# box, in pixels of the picture as taken, from the reservoir's empty mark up to
+# its full mark. WATER_LEVEL_EMPTY_PICTURE and WATER_LEVEL_FULL_PICTURE are
+# pictures of the reservoir empty and full, taken by the same camera. Pictures
+# with the water at WATER_LEVEL_FINE or above are clearly fine, and at most
+# WATER_LEVEL_MAX_SKIPPED of them in a row aren't uploaded.
+WATER_LEVEL_ROI = _int_tuple(os.environ.get("WATER_LEVEL_ROI"), ",")
+WATER_LEVEL_EMPTY_PICTURE = (
+    Path(os.environ["WATER_LEVEL_EMPTY_PICTURE"])
+    if "WATER_LEVEL_EMPTY_PICTURE" in os.environ
+    else None
+)
+WATER_LEVEL_FULL_PICTURE = (
+    Path(os.environ["WATER_LEVEL_FULL_PICTURE"])
+    if "WATER_LEVEL_FULL_PICTURE" in os.environ
+    else None
+)
+WATER_LEVEL_FINE = float(os.environ.get("WATER_LEVEL_FINE", 0.5))
+WATER_LEVEL_MAX_SKIPPED = int(os.environ.get("WATER_LEVEL_MAX_SKIPPED", 0))
+
+# Captured frames wait in a queue of this size for one of the uploaders, when
+# it's full new frames go straight to local storage. On shutdown, queued frames
+# get PIPELINE_SHUTDOWN_GRACE seconds to upload before they're stored locally.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 3))
+PIPELINE_UPLOADERS = int(os.environ.get("PIPELINE_UPLOADERS", 1))
+PIPELINE_SHUTDOWN_GRACE = float(os.environ.get("PIPELINE_SHUTDOWN_GRACE", 10))
+# With several cameras, PIPELINE_UPLOADERS uploads run at once between all of
+# them. Each camera starts at most an equal share of UPLOAD_RATE uploads a
+# second, in bursts of up to UPLOAD_BURST, so a busy camera can't crowd out the
+# others.
+UPLOAD_RATE = float(os.environ.get("UPLOAD_RATE", 1))
+UPLOAD_BURST = int(os.environ.get("UPLOAD_BURST", 3))
+
+# Pictures are taken every WAIT_TIME, give or take up to WAIT_JITTER seconds so
+# several cameras don't hit the api in lockstep. In adaptive mode the interval
+# drops to SCHEDULE_MIN_INTERVAL while pictures are changing or the water is
+# below SCHEDULE_LOW_WATER (0-1), and grows to SCHEDULE_MAX_INTERVAL during
+# SCHEDULE_NIGHT_HOURS (START-END, local hours) or on battery power. Unless
+# they're set, the minimum and maximum are a quarter of and four times each
+# camera's own interval.
+SCHEDULE_MODE = os.environ.get("SCHEDULE_MODE", ScheduleModes.FIXED)
+WAIT_JITTER = float(os.environ.get("WAIT_JITTER", 0))
+SCHEDULE_MIN_INTERVAL = (
+    _seconds(os.environ["SCHEDULE_MIN_INTERVAL"])
+    if "SCHEDULE_MIN_INTERVAL" in os.environ
+    else None
+)
+SCHEDULE_MAX_INTERVAL = (
+    _seconds(os.environ["SCHEDULE_MAX_INTERVAL"])
+    if "SCHEDULE_MAX_INTERVAL" in os.environ
+    else None
+)
+SCHEDULE_LOW_WATER = float(os.environ.get("SCHEDULE_LOW_WATER", 0.25))
+SCHEDULE_NIGHT_HOURS = _int_tuple(os.environ.get("SCHEDULE_NIGHT_HOURS", "23-6"), "-")
+# Where the kernel reports power supplies, a discharging battery (like a UPS
+# hat's) means the mains power is out
+POWER_SUPPLY_DIR = Path(os.environ.get("POWER_SUPPLY_DIR", "/sys/class/power_supply"))
+
+# Metrics are collected, and served in the Prometheus text format at /metrics
+# on the local http server, when METRICS_ENABLED is set
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+# Pictures cached in local storage can be listed by time, summarised by hour and
+# fetched from /pictures on the local http server, when LOCAL_STORAGE_HTTP_ENABLED
+# is set
+LOCAL_STORAGE_HTTP_ENABLED = os.environ.get(
+    "LOCAL_STORAGE_HTTP_ENABLED", ""
+).lower() in ("1", "true", "yes")
+# The device's own http server, only reachable from the device by default
+LOCAL_HTTP_HOST = os.environ.get("LOCAL_HTTP_HOST", "127.0.0.1")
+LOCAL_HTTP_PORT = int(os.environ.get("LOCAL_HTTP_PORT", 9110))
 
 ROOT_DIR = Path(__file__).parent.parent
 TEST_FILE_NAME = "test_image.jpg"
@@ -19,6 +239,22 @@ TEST_FILE_LOCATION = WATERBOWL_DIR.joinpath(TEST_FILE_NAME)
 LOCAL_STORAGE_DIR = Path(
     os.environ.get("LOCAL_STORAGE_DIR", ROOT_DIR.joinpath("local"))
 )
+LOCAL_STORAGE_DB = Path(
+    os.environ.get("LOCAL_STORAGE_DB", LOCAL_STORAGE_DIR.joinpath("queue.sqlite3"))
+)
+# Budget for pictures cached while the api is unavailable, once it's exceeded
+# cached pictures are evicted following the eviction policy
+LOCAL_STORAGE_MAX_BYTES = int(
+    os.environ.get("LOCAL_STORAGE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+LOCAL_STORAGE_MAX_ENTRIES = int(os.environ.get("LOCAL_STORAGE_MAX_ENTRIES", 20_000))
+LOCAL_STORAGE_EVICTION = os.environ.get(
+    "LOCAL_STORAGE_EVICTION", EvictionPolicies.OLDEST_FIRST
+)
+# The CSV storage log used by previous versions, imported into the database
 LOCAL_STORAGE_LOG = Path(
     os.environ.get("LOCAL_STORAGE_LOG", LOCAL_STORAGE_DIR.joinpath("log.csv"))
 )
+# Moving, copying and deleting pictures runs on FILE_IO_WORKERS threads, off the
+# event loop
+FILE_IO_WORKERS = int(os.environ.get("FILE_IO_WORKERS", 2))
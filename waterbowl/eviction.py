@@ -0,0 +1,112 @@
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+from waterbowl.enums import EvictionPolicies
+
+
+class CacheRecord(NamedTuple):
+    id: int
+    timestamp: float
+    size: int
+
+
+class EvictionPolicy(ABC):
+    """
+    Chooses which cached pictures to delete when the cache is over budget.
+    """
+
+    @abstractmethod
+    def preferred(self, records: list[CacheRecord]) -> list[CacheRecord]:
+        """
+        The records this policy would rather lose, in the order to evict them.
+        ``records`` is every cached record, oldest first.
+        """
+        raise NotImplementedError()
+
+    def select(
+        self, records: list[CacheRecord], excess_entries: int, excess_bytes: int
+    ) -> list[int]:
+        """
+        Ids of records to evict to free at least ``excess_entries`` entries and
+        ``excess_bytes`` bytes. The policy's preferred records go first, then the
+        oldest remaining records, so the budget is always met.
+        """
+        preferred = self.preferred(records)
+        preferred_ids = {record.id for record in preferred}
+        candidates = preferred + [
+            record for record in records if record.id not in preferred_ids
+        ]
+        evicted = []
+        for record in candidates:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            evicted.append(record.id)
+            excess_entries -= 1
+            excess_bytes -= record.size
+        return evicted
+
+
+class OldestFirst(EvictionPolicy):
+    """
+    Evict the oldest pictures first.
+    """
+
+    def preferred(self, records: list[CacheRecord]) -> list[CacheRecord]:
+        return []
+
+
+class KeepEveryNth(EvictionPolicy):
+    """
+    Thin out older pictures, taken more than ``recent_seconds`` before the newest
+    picture, so a long outage is still covered end to end at a lower frame rate.
+    Pictures are kept by their id, which never changes, so thinning keeps every
+    ``n``th picture however many times it runs. Once only those are left, it
+    keeps every ``n``th of them, every ``n * n``th picture, and so on.
+    """
+
+    def __init__(self, n: int = 3, recent_seconds: float = 60 * 60):
+        if n < 2:
+            raise ValueError("Must keep every 2nd picture or fewer")
+        self.n = n
+        self.recent_seconds = recent_seconds
+
+    def _level(self, record: CacheRecord) -> int:
+        """
+        How many times over ``n`` divides the record's id, the higher the longer
+        the record is kept.
+        """
+        record_id = record.id
+        level = 0
+        while record_id and record_id % self.n == 0:
+            record_id //= self.n
+            level += 1
+        return level
+
+    def preferred(self, records: list[CacheRecord]) -> list[CacheRecord]:
+        if not records:
+            return []
+        recent_cutoff = records[-1].timestamp - self.recent_seconds
+        older = [record for record in records if record.timestamp < recent_cutoff]
+        # Sorting is stable, so each level is still evicted oldest first
+        return sorted(older, key=self._level)
+
+
+class KeepLatestPerHour(EvictionPolicy):
+    """
+    Keep only the newest picture of each hour, evicting the others oldest first.
+    """
+
+    def preferred(self, records: list[CacheRecord]) -> list[CacheRecord]:
+        latest_per_hour: dict[int, int] = {}
+        for record in records:
+            latest_per_hour[int(record.timestamp // 3600)] = record.id
+        keep = set(latest_per_hour.values())
+        return [record for record in records if record.id not in keep]
+
+
+def eviction_policy_factory(policy: str) -> EvictionPolicy:
+    if policy == EvictionPolicies.EVERY_NTH:
+        return KeepEveryNth()
+    if policy == EvictionPolicies.LATEST_PER_HOUR:
+        return KeepLatestPerHour()
+    return OldestFirst()
@@ -0,0 +1,98 @@
+import asyncio
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+from waterbowl.enums import FILE_IO_WORKERS
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def io_executor() -> ThreadPoolExecutor:
+    """
+    The threads file operations run on. There are only a few, so a large backlog
+    of moves and deletes queues up here instead of starving the default executor.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=FILE_IO_WORKERS, thread_name_prefix="file-io"
+        )
+    return _executor
+
+
+async def run_io(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run a blocking file operation on the I/O threads, so it can't stall the
+    event loop, and with it uploads and scheduled captures.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor(), function, *args)
+
+
+def _fsync(path: Path) -> None:
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def move_file(source: Path, destination: Path, durable: bool = False) -> int:
+    """
+    Move a file, returning its size. On the same filesystem it's a single atomic
+    rename. Across filesystems, like from the capture directory in memory to local
+    storage on the SD card, it's copied next to ``destination`` under a temporary
+    name and renamed into place, so ``destination`` never holds part of a picture.
+
+    A ``durable`` move is on disk once it returns: the file's contents are synced
+    before it's renamed into place, then its directory is synced, so after a power
+    cut ``destination`` is either missing or whole. This blocks, run it with
+    ``run_io``.
+    """
+    try:
+        os.replace(source, destination)
+        if durable:
+            _fsync(destination)
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        partial_file = destination.with_name(f".{destination.name}.partial")
+        try:
+            shutil.copyfile(source, partial_file)
+            if durable:
+                _fsync(partial_file)
+            os.replace(partial_file, destination)
+        except BaseException:
+            partial_file.unlink(missing_ok=True)
+            raise
+        os.unlink(source)
+    if durable:
+        _fsync(destination.parent)
+    return destination.stat().st_size
+
+
+def delete_files(files: Iterable[Path]) -> int:
+    """
+    Delete a batch of files, skipping any already gone, returning how many were
+    deleted. This blocks, run it with ``run_io``.
+    """
+    deleted = 0
+    for file in files:
+        try:
+            os.unlink(file)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+    return deleted
+
+
+def delete_matching(directory: Path, pattern: str) -> int:
+    """
+    Delete the files in ``directory`` matching a glob ``pattern``, listing and
+    deleting them in one go. This blocks, run it with ``run_io``.
+    """
+    return delete_files(directory.glob(pattern))
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from waterbowl.enums import TRANSFORM_CROP, TRANSFORM_MAX_SIZE, TRANSFORM_QUALITY
+
+
+class TransformSettings:
+    """
+    How pictures are transformed before they're uploaded or cached.
+
+    ``crop`` is a (left, upper, right, lower) box, in pixels of the original
+    picture, around the region of interest. The cropped picture is shrunk to fit
+    within ``max_size``, and re-encoded at JPEG ``quality``.
+    """
+
+    def __init__(
+        self,
+        crop: Optional[tuple[int, int, int, int]] = TRANSFORM_CROP,
+        max_size: Optional[tuple[int, int]] = TRANSFORM_MAX_SIZE,
+        quality: Optional[int] = TRANSFORM_QUALITY,
+    ):
+        self.crop = crop
+        self.max_size = max_size
+        self.quality = quality
+
+    @property
+    def enabled(self) -> bool:
+        return any(
+            setting is not None for setting in (self.crop, self.max_size, self.quality)
+        )
+
+    def as_metadata(self) -> dict[str, Any]:
+        return {
+            "crop": list(self.crop) if self.crop else None,
+            "max_size": list(self.max_size) if self.max_size else None,
+            "quality": self.quality,
+        }
+
+
+def _draft_size(
+    picture_size: tuple[int, int],
+    crop: Optional[tuple[int, int, int, int]],
+    max_size: Optional[tuple[int, int]],
+) -> tuple[int, int]:
+    """
+    The smallest size the picture can be decoded at and still be cropped and
+    shrunk to ``max_size`` without losing detail.
+    """
+    if max_size is None:
+        return picture_size
+    width, height = picture_size
+    crop_width, crop_height = width, height
+    if crop:
+        crop_width, crop_height = crop[2] - crop[0], crop[3] - crop[1]
+    scale = min(crop_width / max_size[0], crop_height / max_size[1])
+    if scale <= 1:
+        return picture_size
+    return int(width / scale), int(height / scale)
+
+
+def transform_picture(picture: Path, settings: TransformSettings) -> dict[str, Any]:
+    """
+    Crop, shrink and re-encode a picture in place, returning metadata describing
+    what was done. The new picture is written next to the original and renamed
+    over it, so the original is left intact if this fails.
+    """
+    # Imported here, in the transform's worker, so Pillow isn't loaded on the
+    # event loop before the first picture is taken, see
+    # waterbowl.run_waterbowl_watcher.NETWORK_MODULES
+    from PIL import Image
+
+    original_bytes = picture.stat().st_size
+    with Image.open(picture) as image:
+        original_size = image.size
+        # Let the JPEG decoder downscale while decoding, which is far cheaper
+        # than decoding the full picture and resizing it
+        image.draft(
+            image.mode, _draft_size(original_size, settings.crop, settings.max_size)
+        )
+        transformed = image
+        if settings.crop:
+            x_scale = image.size[0] / original_size[0]
+            y_scale = image.size[1] / original_size[1]
+            left, upper, right, lower = settings.crop
+            transformed = transformed.crop(
+                (
+                    round(left * x_scale),
+                    round(upper * y_scale),
+                    round(right * x_scale),
+                    round(lower * y_scale),
+                )
+            )
+        if settings.max_size:
+            transformed.thumbnail(settings.max_size)
+        tmp_picture = picture.with_name(f".{picture.name}.tmp")
+        transformed.save(
+            tmp_picture,
+            format="JPEG",
+            quality=settings.quality if settings.quality is not None else 95,
+        )
+        size = transformed.size
+    os.replace(tmp_picture, picture)
+    return {
+        "transform": {
+            **settings.as_metadata(),
+            "original_size": list(original_size),
+            "original_bytes": original_bytes,
+            "size": list(size),
+            "bytes": picture.stat().st_size,
+        }
+    }
+
+
+class ImageTransformer:
+    """
+    Transforms pictures off the event loop. By default a single worker thread is
+    used, Pillow releases the GIL while decoding, resizing and encoding, and one
+    worker keeps at most one full size picture in memory at a time. A process
+    pool can be passed in instead.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[TransformSettings] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self.settings = settings or TransformSettings()
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="image-transform"
+        )
+
+    async def transform(self, picture: Path) -> dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, transform_picture, picture, self.settings
+        )
+
+    def close(self) -> None:
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,61 @@
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+from waterbowl.enums import LOCAL_HTTP_HOST, LOCAL_HTTP_PORT
+
+logger = logging.getLogger(__name__)
+
+
+class LocalHttpService:
+    """
+    A small http server running on the device, for local tools like a metrics
+    scraper. Add routes to ``app`` before starting it. If no routes were added
+    there's nothing to serve, and the server isn't started.
+
+        local_http_service = LocalHttpService()
+        local_http_service.app.router.add_get("/metrics", metrics_handler)
+        async with local_http_service:
+            ...
+    """
+
+    def __init__(self, host: str = LOCAL_HTTP_HOST, port: int = LOCAL_HTTP_PORT):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def __aenter__(self) -> "LocalHttpService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    async def start(self) -> None:
+        if self.running or not len(self.app.router.routes()):
+            return
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        try:
+            await site.start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        self._runner = runner
+        # Port 0 asks for any free port, find out which one was picked
+        self.port = runner.addresses[0][1]
+        logger.info(
+            "Local http server started", extra={"host": self.host, "port": self.port}
+        )
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
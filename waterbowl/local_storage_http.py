@@ -0,0 +1,147 @@
+from datetime import datetime
+from typing import Any, Optional
+
+from aiohttp import web
+
+from waterbowl.file_io import run_io
+from waterbowl.local_storage_service import (
+    READ_PAGE_SIZE,
+    LogEntry,
+    log_entries_between,
+    newest_log_entries,
+    storage_log_hours,
+)
+from waterbowl.storage_queue import QueuePosition
+
+# Cached pictures are served by name, only ever from the local storage directory
+PICTURE_ROUTE = "local_storage_picture"
+
+
+def _time_param(request: web.Request, name: str) -> Optional[float]:
+    """
+    A time from the query string, as a Unix timestamp or an ISO 8601 date and
+    time, like 2024-05-01T02:00, in the device's time zone unless one is given.
+    """
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be a timestamp or ISO 8601 time")
+
+
+def _count_param(request: web.Request, name: str, default: int) -> int:
+    try:
+        count = int(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be a whole number")
+    if not 1 <= count <= READ_PAGE_SIZE:
+        raise web.HTTPBadRequest(text=f"{name} must be from 1 to {READ_PAGE_SIZE}")
+    return count
+
+
+def _after_param(request: web.Request) -> Optional[QueuePosition]:
+    value = request.query.get("after")
+    if value is None:
+        return None
+    try:
+        timestamp, entry_id = value.split(",")
+        return float(timestamp), int(entry_id)
+    except ValueError:
+        raise web.HTTPBadRequest(text="after must be the next value of a page")
+
+
+def _describe(request: web.Request, entry: LogEntry) -> dict[str, Any]:
+    url = request.app.router[PICTURE_ROUTE].url_for(name=entry.picture_name)
+    return {
+        "id": entry.entry_id,
+        "timestamp": entry.timestamp,
+        "picture": entry.picture_name,
+        "url": str(url),
+    }
+
+
+async def pictures_handler(request: web.Request) -> web.Response:
+    """
+    A page of the cached pictures taken from ``start`` up to ``end``, oldest
+    first. While there are more, ``next`` is given, to pass as ``after`` for the
+    next page.
+    """
+    start = _time_param(request, "start")
+    end = _time_param(request, "end")
+    limit = _count_param(request, "limit", READ_PAGE_SIZE)
+    entries = await log_entries_between(
+        start if start is not None else float("-inf"),
+        end if end is not None else float("inf"),
+        after=_after_param(request),
+        limit=limit,
+    )
+    next_page = None
+    if len(entries) == limit:
+        next_page = f"{entries[-1].timestamp!r},{entries[-1].entry_id}"
+    return web.json_response(
+        {
+            "pictures": [_describe(request, entry) for entry in entries],
+            "next": next_page,
+        }
+    )
+
+
+async def latest_pictures_handler(request: web.Request) -> web.Response:
+    """
+    The ``count`` newest cached pictures, oldest first.
+    """
+    entries = await newest_log_entries(_count_param(request, "count", 10))
+    return web.json_response(
+        {"pictures": [_describe(request, entry) for entry in entries]}
+    )
+
+
+async def picture_hours_handler(request: web.Request) -> web.Response:
+    """
+    How many cached pictures were taken in each hour from ``start`` to ``end``,
+    leaving out hours without any.
+    """
+    hours = await storage_log_hours(
+        _time_param(request, "start"), _time_param(request, "end")
+    )
+    return web.json_response(
+        {"hours": [{"hour": hour, "pictures": count} for hour, count in hours]}
+    )
+
+
+async def picture_handler(request: web.Request) -> web.FileResponse:
+    """
+    A cached picture. Range requests are supported, so a large picture can be
+    fetched in parts over a poor connection.
+    """
+    picture = LogEntry(0.0, request.match_info["name"]).picture
+    if not await run_io(picture.is_file):
+        raise web.HTTPNotFound()
+    return web.FileResponse(picture)
+
+
+def add_local_storage_routes(app: web.Application) -> None:
+    """
+    Serve the pictures cached in local storage, for looking into what happened
+    while the api was unavailable:
+
+    - ``/pictures?start=&end=&limit=&after=``, the pictures taken in a time range
+    - ``/pictures/latest?count=``, the newest pictures
+    - ``/pictures/hours?start=&end=``, the number of pictures taken each hour
+    - ``/pictures/{name}``, a picture
+    """
+    app.router.add_get("/pictures", pictures_handler)
+    app.router.add_get("/pictures/latest", latest_pictures_handler)
+    app.router.add_get("/pictures/hours", picture_hours_handler)
+    # Picture names never start with a dot, which keeps out partial copies
+    app.router.add_get(
+        r"/pictures/{name:[A-Za-z0-9_-][A-Za-z0-9_.-]*\.jpg}",
+        picture_handler,
+        name=PICTURE_ROUTE,
+    )
@@ -1,41 +1,245 @@
-import os
-import shutil
+import asyncio
+import logging
+from functools import partial
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
-import aiofiles
+from waterbowl.enums import (
+    LOCAL_STORAGE_DB,
+    LOCAL_STORAGE_DIR,
+    LOCAL_STORAGE_EVICTION,
+    LOCAL_STORAGE_LOG,
+    LOCAL_STORAGE_MAX_BYTES,
+    LOCAL_STORAGE_MAX_ENTRIES,
+)
+from waterbowl.eviction import eviction_policy_factory
+from waterbowl.file_io import delete_files, delete_matching, move_file, run_io
+from waterbowl.metrics import BACKLOG_ENTRIES, CACHE_BYTES, STORAGE_SECONDS
+from waterbowl.storage_queue import QueuePosition, QueueRecord, StorageQueue
 
-from waterbowl.enums import LOCAL_STORAGE_DIR, LOCAL_STORAGE_LOG
+logger = logging.getLogger(__name__)
+
+# Number of entries read from the queue at a time
+READ_PAGE_SIZE = 500
+
+_storage_queue: Optional[StorageQueue] = None
+_csv_log_import: Optional[asyncio.Future] = None
 
 
 class LogEntry:
-    def __init__(self, log_file_line: str):
+    """
+    A picture waiting in local storage. A week offline leaves tens of thousands
+    of these, so they only hold the picture's file name, building its path when
+    it's needed.
+    """
+
+    __slots__ = ("timestamp", "picture_name", "entry_id")
+
+    def __init__(self, timestamp: float, picture: str, entry_id: Optional[int] = None):
+        self.timestamp = timestamp
+        self.picture_name = picture
+        self.entry_id = entry_id
+
+    @property
+    def picture(self) -> Path:
+        return LOCAL_STORAGE_DIR.joinpath(self.picture_name)
+
+    @classmethod
+    def from_line(cls, log_file_line: str) -> "LogEntry":
         split_line = log_file_line.strip("\n").split(",")
-        self.timestamp = float(split_line[0])
-        self.picture = LOCAL_STORAGE_DIR.joinpath(split_line[1])
+        return cls(float(split_line[0]), split_line[1])
+
+    @classmethod
+    def from_records(cls, records: list[QueueRecord]) -> list["LogEntry"]:
+        return [
+            cls(timestamp, picture, entry_id=entry_id)
+            for entry_id, timestamp, picture in records
+        ]
 
     def __eq__(self, other: "LogEntry"):
-        return self.timestamp == other.timestamp and self.picture == other.picture
+        return (
+            self.timestamp == other.timestamp
+            and self.picture_name == other.picture_name
+        )
+
+    def __repr__(self) -> str:
+        return f"LogEntry({self.timestamp!r}, {self.picture_name!r})"
+
+
+def _import_csv_log(queue: StorageQueue) -> None:
+    if LOCAL_STORAGE_LOG.exists() and LOCAL_STORAGE_LOG.stat().st_size:
+        queue.import_csv_log(LOCAL_STORAGE_LOG, LOCAL_STORAGE_DIR)
+
+
+async def storage_queue() -> StorageQueue:
+    """
+    The queue of pictures stored locally, kept within the local storage budget.
+    A storage log left by a previous version is imported into it on the I/O
+    threads the first time it's opened, and every caller waits for the import.
+    If the import fails the queue is used without it, and the import is tried
+    again on the next call.
+    """
+    global _storage_queue, _csv_log_import
+    if _storage_queue is None or _storage_queue.database != LOCAL_STORAGE_DB:
+        if _storage_queue is not None:
+            _storage_queue.close_nowait()
+        _storage_queue = StorageQueue(
+            LOCAL_STORAGE_DB,
+            max_entries=LOCAL_STORAGE_MAX_ENTRIES,
+            max_bytes=LOCAL_STORAGE_MAX_BYTES,
+            eviction_policy=eviction_policy_factory(LOCAL_STORAGE_EVICTION),
+        )
+        _csv_log_import = None
+    if _csv_log_import is None:
+        _csv_log_import = asyncio.ensure_future(run_io(_import_csv_log, _storage_queue))
+    csv_log_import = _csv_log_import
+    try:
+        await csv_log_import
+    except Exception as ex:
+        if _csv_log_import is csv_log_import:
+            _csv_log_import = None
+            logger.error(
+                "Unable to import CSV storage log, will try again",
+                extra={"log": LOCAL_STORAGE_LOG, "error": ex},
+            )
+    return _storage_queue
+
+
+def _record_usage(queue: StorageQueue) -> None:
+    BACKLOG_ENTRIES.set(queue.entries)
+    CACHE_BYTES.set(queue.bytes)
+
+
+async def _read_page(after_id: int) -> list[QueueRecord]:
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("read").time():
+        return await queue.read(after_id=after_id, limit=READ_PAGE_SIZE)
 
 
 async def read_storage_log() -> AsyncGenerator[LogEntry, None]:
-    LOCAL_STORAGE_LOG.touch(exist_ok=True)
-    async with aiofiles.open(LOCAL_STORAGE_LOG, "r") as log_file:
-        while line := await log_file.readline():
-            yield LogEntry(line)
+    """
+    Every entry in local storage, oldest first, read a page at a time.
+    """
+    last_id = 0
+    while records := await _read_page(last_id):
+        for entry in LogEntry.from_records(records):
+            yield entry
+        last_id = records[-1][0]
+
+
+async def log_entries_between(
+    start: float,
+    end: float,
+    after: Optional[QueuePosition] = None,
+    limit: int = READ_PAGE_SIZE,
+) -> list[LogEntry]:
+    """
+    A page of the entries in local storage taken from ``start`` up to, but not
+    including, ``end``, in the order they were taken. Pass the (timestamp, id) of
+    the last entry read as ``after`` for the next page.
+    """
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("read").time():
+        return LogEntry.from_records(
+            await queue.read_between(start, end, after=after, limit=limit)
+        )
+
+
+async def read_storage_log_between(
+    start: float, end: float
+) -> AsyncGenerator[LogEntry, None]:
+    """
+    The entries in local storage taken from ``start`` up to, but not including,
+    ``end``, in the order they were taken, read a page at a time.
+    """
+    after: Optional[QueuePosition] = None
+    while entries := await log_entries_between(
+        start, end, after=after, limit=READ_PAGE_SIZE
+    ):
+        for entry in entries:
+            yield entry
+        after = (entries[-1].timestamp, entries[-1].entry_id)
+
+
+async def oldest_log_entries(count: int) -> list[LogEntry]:
+    """
+    The ``count`` oldest entries in local storage, oldest first.
+    """
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("read").time():
+        return LogEntry.from_records(await queue.read(limit=count))
+
+
+async def newest_log_entries(count: int) -> list[LogEntry]:
+    """
+    The ``count`` newest entries in local storage, oldest first.
+    """
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("read").time():
+        return LogEntry.from_records(await queue.read_newest(limit=count))
+
+
+async def storage_log_hours(
+    start: Optional[float] = None, end: Optional[float] = None
+) -> list[tuple[float, int]]:
+    """
+    The number of entries in local storage taken in each hour, as (start of the
+    hour, entries), from the hour ``start`` falls in to the hour ``end`` falls in.
+    """
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("read").time():
+        return await queue.count_by_hour(start, end)
 
 
 async def save_to_storage_log(timestamp: float, picture: Path) -> Path:
-    LOCAL_STORAGE_LOG.touch(exist_ok=True)
-    async with aiofiles.open(LOCAL_STORAGE_LOG, "a") as log_file:
-        await log_file.write(f"{timestamp},{picture.name}\n")
-    new_location = LOCAL_STORAGE_DIR.joinpath(picture.name)
-    shutil.move(picture, new_location)
+    # Move the picture first, and onto the disk, if the device dies before the
+    # entry is written the picture is left behind but the queue never points at a
+    # missing or partly written picture
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("save").time():
+        new_location = LOCAL_STORAGE_DIR.joinpath(picture.name)
+        size = await run_io(partial(move_file, durable=True), picture, new_location)
+        evicted = await queue.enqueue(timestamp, picture.name, size)
+        if evicted:
+            await run_io(
+                delete_files,
+                [
+                    LOCAL_STORAGE_DIR.joinpath(evicted_picture)
+                    for evicted_picture in evicted
+                ],
+            )
+    _record_usage(queue)
     return new_location
 
 
+async def acknowledge_log_entries(entries: list[LogEntry]) -> None:
+    """
+    Remove entries from the storage log once they have been sent, and delete their
+    cached pictures, in a single write.
+    """
+    queue = await storage_queue()
+    with STORAGE_SECONDS.labels("acknowledge").time():
+        entry_ids = []
+        for entry in entries:
+            if entry.entry_id is not None:
+                entry_ids.append(entry.entry_id)
+            else:
+                entry_ids.extend(await queue.find(entry.timestamp, entry.picture_name))
+        await queue.acknowledge(entry_ids)
+        await run_io(delete_files, [entry.picture for entry in entries])
+    _record_usage(queue)
+
+
+async def acknowledge_log_entry(entry: LogEntry) -> None:
+    """
+    Remove a single entry from the storage log once it has been sent, and delete
+    its cached picture.
+    """
+    await acknowledge_log_entries([entry])
+
+
 async def clear_local_storage() -> None:
-    async with aiofiles.open(LOCAL_STORAGE_LOG, "w") as log_file:
-        await log_file.truncate(0)
-    for file in LOCAL_STORAGE_DIR.glob("*.jpg"):
-        os.unlink(file)
+    queue = await storage_queue()
+    await queue.clear()
+    await run_io(delete_matching, LOCAL_STORAGE_DIR, "*.jpg")
+    _record_usage(queue)
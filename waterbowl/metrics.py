@@ -0,0 +1,383 @@
+import time
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Iterator, Optional, Sequence
+
+from waterbowl.enums import METRICS_ENABLED, BreakerStates
+
+# Upper bounds, in seconds, of the latency histogram buckets. Camera captures
+# and uploads over Wi-Fi can take tens of seconds.
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+
+class Registry:
+    """
+    Holds every metric, and renders them in the Prometheus text format.
+
+    Metrics are kept in memory and only cost anything when they're read. While
+    the registry is disabled every metric is a ``DisabledValue`` that ignores
+    updates, and timers don't read the clock, so instrumented code runs at
+    practically full speed.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self._metrics: dict[str, "Metric"] = {}
+
+    def _register(self, metric: "Metric") -> "Metric":
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> "Counter":
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> "Gauge":
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> "Histogram":
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def reset(self) -> None:
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+    ):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], object] = {}
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *values: object):
+        """
+        The metric for one combination of label values, in the order of the label
+        names.
+        """
+        if not self.registry.enabled:
+            return _DISABLED
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(
+                    f"Metric {self.name} has labels {self.labelnames}, got {key}"
+                )
+            child = self._children[key] = self._new_child()
+        return child
+
+    def reset(self) -> None:
+        self._children.clear()
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for key, child in self._children.items():
+            labels = dict(zip(self.labelnames, key))
+            for suffix, extra_labels, value in child.samples():
+                yield self.name + suffix, {**labels, **extra_labels}, value
+
+
+class DisabledValue:
+    """
+    Stands in for every metric while the registry is disabled, doing nothing.
+    """
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def time(self) -> "DisabledValue":
+        return self
+
+    def __enter__(self) -> "DisabledValue":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+_DISABLED = DisabledValue()
+
+
+class CounterValue:
+    __slots__ = ("registry", "value")
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        if self.registry.enabled:
+            self.value += amount
+
+    def samples(self):
+        yield "_total", {}, self.value
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, like pictures uploaded.
+    """
+
+    kind = "counter"
+
+    def _new_child(self) -> CounterValue:
+        return CounterValue(self.registry)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class GaugeValue:
+    __slots__ = ("registry", "value")
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        if self.registry.enabled:
+            self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        if self.registry.enabled:
+            self.value += amount
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, like the number of cached pictures.
+    """
+
+    kind = "gauge"
+
+    def _new_child(self) -> GaugeValue:
+        return GaugeValue(self.registry)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Timer:
+    """
+    Times a block of code into a histogram.
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "HistogramValue"):
+        self.histogram = histogram
+        self.start: Optional[float] = None
+
+    def __enter__(self) -> "Timer":
+        if self.histogram.registry.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start)
+
+
+class HistogramValue:
+    __slots__ = ("registry", "buckets", "counts", "sum", "count")
+
+    def __init__(self, registry: Registry, buckets: tuple[float, ...]):
+        self.registry = registry
+        self.buckets = buckets
+        # One count per bucket, plus one for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        if self.registry.enabled:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "_bucket", {"le": _format_value(upper_bound)}, cumulative
+        yield "_bucket", {"le": "+Inf"}, self.count
+        yield "_sum", {}, self.sum
+        yield "_count", {}, self.count
+
+
+class Histogram(Metric):
+    """
+    Counts values, like latencies, in buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.registry, self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+REGISTRY = Registry()
+
+CAPTURE_SECONDS = REGISTRY.histogram(
+    "waterbowl_capture_seconds", "Time taken by the camera to take a picture"
+)
+CAPTURE_FAILURES = REGISTRY.counter(
+    "waterbowl_capture_failures", "Pictures the camera failed to take"
+)
+API_REQUEST_SECONDS = REGISTRY.histogram(
+    "waterbowl_api_request_seconds",
+    "Time taken by requests to the api",
+    ["operation"],
+)
+API_REQUEST_FAILURES = REGISTRY.counter(
+    "waterbowl_api_request_failures",
+    "Requests to the api that failed",
+    ["operation"],
+)
+UPLOADED_PICTURES = REGISTRY.counter(
+    "waterbowl_uploaded_pictures", "Pictures sent to the api"
+)
+UPLOADED_BYTES = REGISTRY.counter(
+    "waterbowl_uploaded_bytes", "Bytes of pictures sent to the api"
+)
+SKIPPED_PICTURES = REGISTRY.counter(
+    "waterbowl_skipped_pictures",
+    "Pictures not uploaded, because they hadn't changed or the water was fine",
+    ["reason"],
+)
+CACHED_PICTURES = REGISTRY.counter(
+    "waterbowl_cached_pictures", "Pictures cached locally to be sent later"
+)
+WATER_LEVEL = REGISTRY.gauge(
+    "waterbowl_water_level",
+    "Water level estimated from the latest picture, 0-1",
+    ["camera_id"],
+)
+WATER_LEVEL_SECONDS = REGISTRY.histogram(
+    "waterbowl_water_level_seconds", "Time taken to estimate the water level"
+)
+STORAGE_SECONDS = REGISTRY.histogram(
+    "waterbowl_storage_seconds",
+    "Time taken by local storage operations",
+    ["operation"],
+)
+BACKLOG_ENTRIES = REGISTRY.gauge(
+    "waterbowl_backlog_entries", "Cached pictures waiting to be sent"
+)
+CACHE_BYTES = REGISTRY.gauge(
+    "waterbowl_cache_bytes", "Bytes of cached pictures waiting to be sent"
+)
+PIPELINE_QUEUE_DEPTH = REGISTRY.gauge(
+    "waterbowl_pipeline_queue_depth",
+    "Pictures taken and waiting to be uploaded",
+    ["camera_id"],
+)
+UPLOAD_WAIT_SECONDS = REGISTRY.histogram(
+    "waterbowl_upload_wait_seconds",
+    "Time pictures waited for an upload slot",
+    ["camera_id"],
+)
+BREAKER_STATE = REGISTRY.gauge(
+    "waterbowl_breaker_state",
+    "Whether the api circuit breaker is in each state",
+    ["state"],
+)
+
+
+def record_breaker_state(state: BreakerStates) -> None:
+    for breaker_state in BreakerStates:
+        BREAKER_STATE.labels(breaker_state.value).set(int(breaker_state == state))
+
+
+async def metrics_handler(_: "web.Request") -> "web.Response":
+    # Imported here so that recording metrics doesn't load aiohttp, see
+    # waterbowl.run_waterbowl_watcher.NETWORK_MODULES
+    from aiohttp import web
+
+    return web.Response(
+        body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE}
+    )
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Awaitable, Callable, Optional
+
+from waterbowl.enums import (
+    CAPTURE_DIR,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_SHUTDOWN_GRACE,
+    PIPELINE_UPLOADERS,
+)
+from waterbowl.metrics import PIPELINE_QUEUE_DEPTH
+from waterbowl.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class Frame:
+    """
+    A picture that has been taken and is waiting to be uploaded.
+    """
+
+    def __init__(
+        self,
+        timestamp: float,
+        picture: Path,
+        metadata: Optional[dict[str, Any]] = None,
+    ):
+        self.timestamp = timestamp
+        self.picture = picture
+        self.metadata = metadata or {}
+
+
+class CapturePipeline:
+    """
+    Takes pictures on a fixed cadence and uploads them independently.
+
+    A capture loop calls ``capture`` when the scheduler says a picture is due,
+    and puts each frame on a bounded queue that ``uploaders`` workers take frames
+    from and ``upload``. However slow uploads are, captures stay on schedule:
+    when the queue is full the new frame is handed to ``spill`` (to cache it
+    locally) instead of waiting.
+
+    A frame taken before the pipeline was ready, like the first picture taken
+    while the watcher starts up, can be passed to ``run`` to be uploaded as the
+    first capture. The scheduler is only started if it hasn't been already.
+
+    Frames are taken into a spool directory under ``capture_dir``, which by
+    default is in memory, see ``waterbowl.enums.CAPTURE_DIR``.
+
+    ``stop`` (for example from a SIGTERM handler) ends the capture loop. Queued
+    frames are uploaded for up to ``shutdown_grace`` seconds, then any frame not
+    yet uploaded is spilled.
+
+    The queue depth is reported under ``camera_id``, so each camera's pipeline
+    can be told apart.
+    """
+
+    def __init__(
+        self,
+        capture: Callable[[Path], Awaitable[Optional[Frame]]],
+        upload: Callable[[Frame], Awaitable[Any]],
+        spill: Callable[[Frame], Awaitable[Any]],
+        scheduler: Scheduler,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        uploaders: int = PIPELINE_UPLOADERS,
+        shutdown_grace: float = PIPELINE_SHUTDOWN_GRACE,
+        capture_dir: Optional[Path] = CAPTURE_DIR,
+        camera_id: str = "",
+    ):
+        self.capture = capture
+        self.upload = upload
+        self.spill = spill
+        self.scheduler = scheduler
+        self.queue_size = queue_size
+        self.uploaders = uploaders
+        self.shutdown_grace = shutdown_grace
+        self.capture_dir = capture_dir
+        self.camera_id = camera_id
+        self._stopping: Optional[asyncio.Event] = None
+        self._queue: Optional[asyncio.Queue] = None
+
+    def stop(self) -> None:
+        if self._stopping is not None:
+            self._stopping.set()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def run(self, first_frame: Optional[Frame] = None) -> None:
+        self._stopping = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        with TemporaryDirectory(dir=self.capture_dir) as spool_dir:
+            workers = [
+                asyncio.create_task(self._uploader()) for _ in range(self.uploaders)
+            ]
+            try:
+                await self._capture_loop(Path(spool_dir), first_frame)
+            finally:
+                await self._shutdown(workers)
+
+    async def _capture_loop(
+        self, spool_dir: Path, first_frame: Optional[Frame] = None
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        if not self.scheduler.started:
+            self.scheduler.start(loop.time())
+        while not self._stopping.is_set():
+            if first_frame is not None:
+                frame, first_frame = first_frame, None
+            else:
+                frame = await self.capture(spool_dir)
+            if frame is not None:
+                await self._enqueue(frame)
+            next_capture = self.scheduler.next_deadline(loop.time())
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(), timeout=next_capture - loop.time()
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _enqueue(self, frame: Frame) -> None:
+        try:
+            self._queue.put_nowait(frame)
+            PIPELINE_QUEUE_DEPTH.labels(self.camera_id).set(self._queue.qsize())
+        except asyncio.QueueFull:
+            logger.warning(
+                "Upload queue full, spilling frame to local storage",
+                extra={"timestamp": frame.timestamp},
+            )
+            await self.spill(frame)
+
+    async def _uploader(self) -> None:
+        while True:
+            frame = await self._queue.get()
+            PIPELINE_QUEUE_DEPTH.labels(self.camera_id).set(self._queue.qsize())
+            try:
+                await self.upload(frame)
+            except asyncio.CancelledError:
+                await self.spill(frame)
+                raise
+            except Exception as ex:
+                logger.error(
+                    "Unexpected error uploading frame",
+                    extra={"timestamp": frame.timestamp, "error": ex},
+                )
+            finally:
+                self._queue.task_done()
+
+    async def _shutdown(self, workers: list[asyncio.Task]) -> None:
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.shutdown_grace)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Uploads didn't finish before shutdown, spilling remaining frames",
+                extra={"remaining": self._queue.qsize()},
+            )
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        while not self._queue.empty():
+            await self.spill(self._queue.get_nowait())
@@ -1,93 +1,441 @@
 import asyncio
+import importlib
 import logging
+import signal
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import AsyncExitStack
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Optional
 
-from waterbowl.api_service import ApiException, ApiService
-from waterbowl.camera_service import AbstractCameraService, camera_service_factory
-from waterbowl.enums import LOCAL_STORAGE_DIR, WAIT_TIME
-from waterbowl.local_storage_service import (
-    clear_local_storage,
-    read_storage_log,
-    save_to_storage_log,
+from waterbowl.burst import BurstCapture
+from waterbowl.camera_registry import CameraConfig, CameraRegistry, camera_registry
+from waterbowl.camera_service import AbstractCameraService
+from waterbowl.enums import (
+    BURST_FRAMES,
+    BURST_WORKERS,
+    CAPTURE_DIR,
+    CHANGE_THRESHOLD,
+    LOCAL_STORAGE_DIR,
+    LOCAL_STORAGE_HTTP_ENABLED,
+    METRICS_ENABLED,
 )
+from waterbowl.image_transform import ImageTransformer
+from waterbowl.local_storage_service import save_to_storage_log
+from waterbowl.metrics import (
+    CACHED_PICTURES,
+    CAPTURE_FAILURES,
+    CAPTURE_SECONDS,
+    SKIPPED_PICTURES,
+    WATER_LEVEL,
+    metrics_handler,
+)
+from waterbowl.pipeline import CapturePipeline, Frame
+from waterbowl.scheduler import Scheduler, scheduler_factory
+from waterbowl.upload_slots import UploadSlots
+from waterbowl.water_level import WaterLevelEstimator
+
+if TYPE_CHECKING:
+    from waterbowl.api_service import ApiService
+    from waterbowl.backlog_service import BacklogDrainer
+    from waterbowl.change_detection import ChangeDetector
 
 logger = logging.getLogger(__name__)
 
+# Modules that are only needed once the first picture has been taken. Importing
+# them, aiohttp above all, takes seconds on a Pi Zero, so they're imported in the
+# background while the first picture is taken.
+NETWORK_MODULES = (
+    "waterbowl.api_service",
+    "waterbowl.backlog_service",
+    "waterbowl.change_detection",
+    "waterbowl.local_http_service",
+    "waterbowl.local_storage_http",
+)
 
 UPDATE_PICTURE_METADATA = True
 DEFAULT_PICTURE_METADATA = {}
 
 
-async def image_water_bowl(cam: AbstractCameraService, api_service: ApiService) -> bool:
+async def capture_frame(
+    cam: AbstractCameraService,
+    directory: Path,
+    image_transformer: Optional[ImageTransformer] = None,
+    water_level_estimator: Optional[WaterLevelEstimator] = None,
+    burst_capture: Optional[BurstCapture] = None,
+    camera_id: Optional[str] = None,
+    tag_camera: bool = True,
+) -> Optional[Frame]:
+    """
+    Take a picture into ``directory``, or the best of a burst of pictures when a
+    burst capture is given. When a water level estimator is given, the estimated
+    level is added to the picture's metadata, and when an image transformer is
+    given the picture is then transformed. A camera id is added to the picture's
+    name so cameras' pictures never clash, and with ``tag_camera`` to its
+    metadata. Returns None, having logged the error, if no picture was taken.
+    """
     now_timestamp = datetime.now().timestamp()
-    with TemporaryDirectory() as tmp_dir:
-        try:
-            new_file: Path = await cam.take_picture(
-                Path(tmp_dir).joinpath(f"{now_timestamp}.jpg")
-            )
-            # First, check that the api is active and ready for use
-            if not await api_service.api_healthy():
-                cached_file = await save_to_storage_log(
-                    timestamp=now_timestamp, picture=new_file
-                )
-                logger.error(
-                    "API service not healthy, caching file for later",
-                    extra={"timestamp": now_timestamp, "picture": cached_file},
-                )
-                return False
+    metadata = dict(DEFAULT_PICTURE_METADATA)
+    if camera_id is None:
+        new_file = directory.joinpath(f"{now_timestamp}.jpg")
+    else:
+        new_file = directory.joinpath(f"{camera_id}_{now_timestamp}.jpg")
+        if tag_camera:
+            metadata["camera_id"] = camera_id
+    try:
+        with CAPTURE_SECONDS.time():
+            if burst_capture is None:
+                await cam.take_picture(new_file)
             else:
-                # If the API is ready, check for any previously cached requests to send first
-                async for log_entry in read_storage_log():
-                    logger.debug(
-                        "Log entry found, attempting to send",
-                        extra={
-                            "timestamp": log_entry.timestamp,
-                            "picture": log_entry.picture,
-                        },
-                    )
-                    await api_service.send_picture(
-                        timestamp=log_entry.timestamp, picture=log_entry.picture
-                    )
-                # Clear the local storage just in case we had some entries to send
-                await clear_local_storage()
-                # Then, send the new picture
-                new_picture_id = await api_service.send_picture(
-                    timestamp=now_timestamp, picture=new_file
-                )
-                if DEFAULT_PICTURE_METADATA:
-                    await api_service.update_picture(
-                        picture_id=new_picture_id, picture_data=DEFAULT_PICTURE_METADATA
-                    )
-                return True
-        except ApiException as ex:
-            cached_file = await save_to_storage_log(
-                timestamp=now_timestamp, picture=new_file
-            )
+                metadata.update(await burst_capture.take_picture(cam, new_file))
+    except Exception as ex:
+        CAPTURE_FAILURES.inc()
+        logger.error(
+            "Unable to take a picture",
+            extra={"timestamp": now_timestamp, "camera_id": camera_id, "error": ex},
+        )
+        new_file.unlink(missing_ok=True)
+        return None
+    frame = Frame(now_timestamp, new_file, metadata)
+    # The level is estimated from the picture as taken, the region of interest is
+    # in its pixels
+    if water_level_estimator is not None:
+        try:
+            water_level = await water_level_estimator.estimate(new_file)
+            frame.metadata["water_level"] = water_level
+            WATER_LEVEL.labels(camera_id or "").set(water_level)
+        except Exception as ex:
             logger.error(
-                "API exception received, caching file for later",
-                extra={"timestamp": now_timestamp, "picture": cached_file, "error": ex},
+                "Unable to estimate the water level",
+                extra={"timestamp": now_timestamp, "error": ex},
             )
-            return False
+    if image_transformer is not None:
+        try:
+            frame.metadata.update(await image_transformer.transform(new_file))
         except Exception as ex:
-            cached_file = await save_to_storage_log(
-                timestamp=now_timestamp, picture=new_file
+            logger.error(
+                "Unable to transform picture, using it as taken",
+                extra={"timestamp": now_timestamp, "error": ex},
             )
+    return frame
+
+
+async def cache_frame(frame: Frame) -> None:
+    """
+    Move a frame into local storage, to be sent when the api is available. With
+    the capture directory in memory, this is the only time a picture is written
+    to the SD card.
+    """
+    try:
+        await save_to_storage_log(timestamp=frame.timestamp, picture=frame.picture)
+        CACHED_PICTURES.inc()
+    except Exception as ex:
+        logger.error(
+            "Unable to cache picture, it has been lost",
+            extra={"timestamp": frame.timestamp, "error": ex},
+        )
+    finally:
+        frame.picture.unlink(missing_ok=True)
+
+
+def import_network_modules() -> None:
+    for module in NETWORK_MODULES:
+        importlib.import_module(module)
+
+
+async def upload_frame(
+    frame: Frame,
+    api_service: "ApiService",
+    backlog_drainer: Optional["BacklogDrainer"] = None,
+    change_detector: Optional["ChangeDetector"] = None,
+    scheduler: Optional[Scheduler] = None,
+    water_level_estimator: Optional[WaterLevelEstimator] = None,
+) -> bool:
+    """
+    Send a frame to the api, caching it locally if that fails.
+
+    When a backlog drainer is given, any previously cached pictures are sent in
+    the background, otherwise the backlog is drained before returning. When a
+    change detector is given, a picture that looks the same as the last uploaded
+    picture isn't uploaded, instead the last picture is marked as still current.
+    Likewise when a water level estimator is given, some pictures with the water
+    clearly fine aren't uploaded, their level is recorded against the last
+    uploaded picture. When a scheduler is given, it's told whether the picture
+    changed and the water level, estimated or reported by the api. If the upload
+    is cancelled the frame is left in place for the caller.
+    """
+    from waterbowl.api_service import ApiException
+    from waterbowl.backlog_service import BacklogDrainer
+
+    water_level = frame.metadata.get("water_level")
+    if scheduler is not None and water_level is not None:
+        scheduler.observe(water_level=water_level)
+    try:
+        # First, check that the api is active and ready for use. This only costs
+        # a request while the api is recovering from failures.
+        if not await api_service.available():
             logger.error(
-                "Unexpected error occurred, caching file for later",
-                extra={"timestamp": now_timestamp, "picture": cached_file, "error": ex},
+                "API service not available, caching file for later",
+                extra={
+                    "timestamp": frame.timestamp,
+                    "breaker_state": api_service.breaker_state,
+                },
             )
+            await cache_frame(frame)
             return False
-        finally:
-            new_file.unlink(missing_ok=True)
+        # If the API is ready, send any previously cached pictures
+        if backlog_drainer is None:
+            await BacklogDrainer(api_service).drain()
+        else:
+            backlog_drainer.start()
+        # Then, send the new picture if it has changed
+        thumbnail = None
+        if change_detector is not None:
+            thumbnail = await change_detector.thumbnail(frame.picture)
+            unchanged = change_detector.unchanged(thumbnail)
+            if scheduler is not None:
+                scheduler.observe(changed=not unchanged)
+            if unchanged:
+                await api_service.queue_update(
+                    picture_id=change_detector.last_picture_id,
+                    picture_data={"unchanged_at": frame.timestamp},
+                )
+                change_detector.skip()
+                SKIPPED_PICTURES.labels("unchanged").inc()
+                frame.picture.unlink(missing_ok=True)
+                return True
+        if (
+            water_level_estimator is not None
+            and water_level is not None
+            and water_level_estimator.skippable(water_level)
+        ):
+            await api_service.queue_update(
+                picture_id=water_level_estimator.last_picture_id,
+                picture_data={
+                    "water_level": water_level,
+                    "water_level_at": frame.timestamp,
+                },
+            )
+            water_level_estimator.skip()
+            SKIPPED_PICTURES.labels("water_fine").inc()
+            frame.picture.unlink(missing_ok=True)
+            return True
+        sent = await api_service.send_picture(
+            timestamp=frame.timestamp,
+            picture=frame.picture,
+            metadata=frame.metadata or None,
+        )
+        if change_detector is not None:
+            change_detector.remember(thumbnail, sent.picture_id)
+        if water_level_estimator is not None:
+            water_level_estimator.remember(sent.picture_id)
+        if scheduler is not None and sent.water_level is not None:
+            scheduler.observe(water_level=sent.water_level)
+        frame.picture.unlink(missing_ok=True)
+        return True
+    except ApiException as ex:
+        logger.error(
+            "API exception received, caching file for later",
+            extra={"timestamp": frame.timestamp, "error": ex},
+        )
+        await cache_frame(frame)
+        return False
+    except Exception as ex:
+        logger.error(
+            "Unexpected error occurred, caching file for later",
+            extra={"timestamp": frame.timestamp, "error": ex},
+        )
+        await cache_frame(frame)
+        return False
+
+
+async def image_water_bowl(
+    cam: AbstractCameraService,
+    api_service: "ApiService",
+    backlog_drainer: Optional["BacklogDrainer"] = None,
+    change_detector: Optional["ChangeDetector"] = None,
+    image_transformer: Optional[ImageTransformer] = None,
+    scheduler: Optional[Scheduler] = None,
+    water_level_estimator: Optional[WaterLevelEstimator] = None,
+    burst_capture: Optional[BurstCapture] = None,
+) -> bool:
+    """
+    Take a picture and send it to the api, caching it locally if that fails.
+    This is one capture and upload done in sequence, see ``capture_frame`` and
+    ``upload_frame`` for how the other services are used.
+    """
+    with TemporaryDirectory(dir=CAPTURE_DIR) as tmp_dir:
+        frame = await capture_frame(
+            cam, Path(tmp_dir), image_transformer, water_level_estimator, burst_capture
+        )
+        if frame is None:
+            return False
+        return await upload_frame(
+            frame,
+            api_service,
+            backlog_drainer,
+            change_detector,
+            scheduler,
+            water_level_estimator,
+        )
+
+
+class WatchedCamera:
+    """
+    A camera being watched: its camera service, its own schedule, and the
+    services that take and look at its pictures. Transforms and burst scoring
+    run on executors shared between cameras, so memory and CPU use don't grow
+    with the number of cameras.
+
+    With ``tag_camera`` its pictures' metadata says which camera took them. With
+    a single camera that's left out, as it can cost an extra update request for
+    each picture.
+    """
+
+    def __init__(
+        self,
+        config: CameraConfig,
+        transform_executor: Optional[Executor] = None,
+        burst_executor: Optional[Executor] = None,
+        tag_camera: bool = True,
+    ):
+        self.camera_id = config.camera_id
+        self.camera_service = config.camera_service()
+        self.image_transformer = (
+            ImageTransformer(config.transform, executor=transform_executor)
+            if config.transform.enabled
+            else None
+        )
+        self.water_level_estimator = (
+            WaterLevelEstimator() if config.water_level else None
+        )
+        self.burst_capture = (
+            BurstCapture(
+                reference_picture=config.burst_reference_picture,
+                executor=burst_executor,
+            )
+            if BURST_FRAMES > 1
+            else None
+        )
+        self.scheduler = scheduler_factory()(interval=config.interval)
+        self.capture = partial(
+            capture_frame,
+            self.camera_service,
+            image_transformer=self.image_transformer,
+            water_level_estimator=self.water_level_estimator,
+            burst_capture=self.burst_capture,
+            camera_id=self.camera_id,
+            tag_camera=tag_camera,
+        )
+
+    def close(self) -> None:
+        if self.image_transformer is not None:
+            self.image_transformer.close()
+        if self.burst_capture is not None:
+            self.burst_capture.close()
 
 
-async def watch_water_bowl():
-    camera_service: AbstractCameraService = camera_service_factory()()
-    api_service = ApiService()
+async def watch_water_bowl(registry: Optional[CameraRegistry] = None):
     LOCAL_STORAGE_DIR.mkdir(exist_ok=True)
-    while True:
-        await image_water_bowl(camera_service, api_service)
-        await asyncio.sleep(WAIT_TIME)
-    pass
+    loop = asyncio.get_running_loop()
+    # The cameras start up and take their first pictures while the network stack
+    # is imported in the background
+    network_modules = loop.run_in_executor(None, import_network_modules)
+    # The cameras stay warm, and one api service (and connection pool) is shared,
+    # across every cycle and every camera
+    registry = registry or camera_registry()
+    # One full size picture is transformed at a time, whichever camera took it
+    transform_executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="image-transform"
+    )
+    burst_executor = ThreadPoolExecutor(
+        max_workers=BURST_WORKERS, thread_name_prefix="burst-score"
+    )
+    tag_camera = len(registry.camera_ids) > 1
+    cameras = [
+        WatchedCamera(config, transform_executor, burst_executor, tag_camera)
+        for config in registry
+    ]
+    try:
+        with TemporaryDirectory(dir=CAPTURE_DIR) as first_frame_dir:
+            async with AsyncExitStack() as stack:
+                for camera in cameras:
+                    await stack.enter_async_context(camera.camera_service)
+                    camera.scheduler.start(loop.time())
+                first_frames = await asyncio.gather(
+                    *(camera.capture(Path(first_frame_dir)) for camera in cameras)
+                )
+                await network_modules
+                await _watch(cameras, first_frames)
+    finally:
+        for camera in cameras:
+            camera.close()
+        transform_executor.shutdown()
+        burst_executor.shutdown()
+
+
+async def _watch(
+    cameras: list[WatchedCamera], first_frames: list[Optional[Frame]]
+) -> None:
+    from waterbowl.api_service import ApiService
+    from waterbowl.backlog_service import BacklogDrainer
+    from waterbowl.change_detection import ChangeDetector
+    from waterbowl.local_http_service import LocalHttpService
+    from waterbowl.local_storage_http import add_local_storage_routes
+
+    local_http_service = LocalHttpService()
+    if METRICS_ENABLED:
+        local_http_service.app.router.add_get("/metrics", metrics_handler)
+    if LOCAL_STORAGE_HTTP_ENABLED:
+        add_local_storage_routes(local_http_service.app)
+    async with ApiService() as api_service, local_http_service:
+        backlog_drainer = BacklogDrainer(api_service)
+        upload_slots = UploadSlots([camera.camera_id for camera in cameras])
+        # Each camera takes pictures on its own cadence, and they're uploaded as
+        # they come in, so a slow api doesn't delay the next picture. Cameras
+        # share the upload slots fairly.
+        pipelines = [
+            CapturePipeline(
+                capture=camera.capture,
+                upload=upload_slots.limit(
+                    camera.camera_id,
+                    partial(
+                        upload_frame,
+                        api_service=api_service,
+                        backlog_drainer=backlog_drainer,
+                        change_detector=(
+                            ChangeDetector() if CHANGE_THRESHOLD >= 0 else None
+                        ),
+                        scheduler=camera.scheduler,
+                        water_level_estimator=camera.water_level_estimator,
+                    ),
+                ),
+                spill=cache_frame,
+                scheduler=camera.scheduler,
+                camera_id=camera.camera_id,
+            )
+            for camera in cameras
+        ]
+
+        def stop() -> None:
+            for pipeline in pipelines:
+                pipeline.stop()
+
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(stop_signal, stop)
+        runs = [
+            asyncio.ensure_future(pipeline.run(first_frame))
+            for pipeline, first_frame in zip(pipelines, first_frames)
+        ]
+        try:
+            await asyncio.gather(*runs)
+        finally:
+            # If one camera's pipeline failed, stop the others too
+            stop()
+            await asyncio.gather(*runs, return_exceptions=True)
+            for stop_signal in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(stop_signal)
+            await backlog_drainer.close()
@@ -0,0 +1,201 @@
+import logging
+import random
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+from waterbowl.enums import (
+    POWER_SUPPLY_DIR,
+    SCHEDULE_LOW_WATER,
+    SCHEDULE_MAX_INTERVAL,
+    SCHEDULE_MIN_INTERVAL,
+    SCHEDULE_MODE,
+    SCHEDULE_NIGHT_HOURS,
+    WAIT_JITTER,
+    WAIT_TIME,
+    ScheduleModes,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Decides when to take each picture.
+
+    Pictures are due on a grid of deadlines ``interval`` seconds apart, on the
+    event loop's monotonic clock, so the time spent taking and uploading a
+    picture doesn't push back the next one. If a picture overruns its slot the
+    missed deadlines are skipped rather than taken in a burst. Each deadline is
+    moved by up to ``jitter`` seconds either way, without moving the grid.
+    """
+
+    def __init__(
+        self,
+        interval: float = WAIT_TIME,
+        jitter: float = WAIT_JITTER,
+        uniform: Callable[[float, float], float] = random.uniform,
+    ):
+        if interval <= 0:
+            raise ValueError(f"Capture interval must be positive, got {interval}")
+        if not 0 <= jitter < interval / 2:
+            raise ValueError(
+                f"Jitter must be at least 0 and under half the interval, got {jitter}"
+            )
+        self.interval = interval
+        self.jitter = jitter
+        self.uniform = uniform
+        self._deadline: Optional[float] = None
+
+    def current_interval(self) -> float:
+        return self.interval
+
+    def observe(
+        self, changed: Optional[bool] = None, water_level: Optional[float] = None
+    ) -> None:
+        """
+        Record what the latest picture showed, used by adaptive schedules.
+        """
+
+    @property
+    def started(self) -> bool:
+        return self._deadline is not None
+
+    def start(self, now: float) -> float:
+        """
+        Start the schedule, returning when to take the first picture.
+        """
+        self._deadline = now
+        return now
+
+    def next_deadline(self, now: float) -> float:
+        """
+        Returns when to take the next picture, as a time on the same clock as
+        ``now``.
+        """
+        if self._deadline is None:
+            return self.start(now)
+        interval = self.current_interval()
+        self._deadline += interval
+        if self._deadline <= now:
+            skipped = int((now - self._deadline) // interval) + 1
+            logger.warning(
+                "Capture overran its interval, skipping captures",
+                extra={"skipped": skipped, "interval": interval},
+            )
+            self._deadline += skipped * interval
+        if self.jitter:
+            return max(now, self._deadline + self.uniform(-self.jitter, self.jitter))
+        return self._deadline
+
+
+class AdaptiveScheduler(Scheduler):
+    """
+    A schedule that spends pictures where they matter. While recent pictures
+    have changed, or the water is low, pictures are taken every ``min_interval``.
+    At night, or while running on battery power, they're taken every
+    ``max_interval``. Otherwise they're taken every ``interval``. Without a
+    ``min_interval`` or ``max_interval``, they're a quarter of and four times
+    ``interval``.
+
+    Battery power wins over everything else, to make the battery last, and
+    activity wins over night time so a visit at night is still seen.
+    """
+
+    def __init__(
+        self,
+        interval: float = WAIT_TIME,
+        jitter: float = WAIT_JITTER,
+        min_interval: Optional[float] = SCHEDULE_MIN_INTERVAL,
+        max_interval: Optional[float] = SCHEDULE_MAX_INTERVAL,
+        low_water: float = SCHEDULE_LOW_WATER,
+        night_hours: Optional[tuple[int, int]] = SCHEDULE_NIGHT_HOURS,
+        recent_pictures: int = 3,
+        power_supply_dir: Path = POWER_SUPPLY_DIR,
+        uniform: Callable[[float, float], float] = random.uniform,
+        clock: Callable[[], datetime] = datetime.now,
+    ):
+        super().__init__(interval=interval, jitter=jitter, uniform=uniform)
+        if min_interval is None:
+            min_interval = interval / 4
+        if max_interval is None:
+            max_interval = interval * 4
+        if not 0 < min_interval <= interval <= max_interval:
+            raise ValueError(
+                "Capture intervals must be positive with min <= interval <= max, got "
+                f"{min_interval}, {interval} and {max_interval}"
+            )
+        if jitter >= min_interval / 2:
+            raise ValueError(
+                f"Jitter must be under half the minimum interval, got {jitter}"
+            )
+        if night_hours is not None and (
+            len(night_hours) != 2 or not all(0 <= hour < 24 for hour in night_hours)
+        ):
+            raise ValueError(f"Night hours must be START-END hours, got {night_hours}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.low_water = low_water
+        self.night_hours = night_hours
+        self.power_supply_dir = power_supply_dir
+        self.clock = clock
+        self.recent_changes: deque[bool] = deque(maxlen=recent_pictures)
+        self.water_level: Optional[float] = None
+
+    def observe(
+        self, changed: Optional[bool] = None, water_level: Optional[float] = None
+    ) -> None:
+        if changed is not None:
+            self.recent_changes.append(changed)
+        if water_level is not None:
+            self.water_level = water_level
+
+    @property
+    def active(self) -> bool:
+        low_water = self.water_level is not None and self.water_level < self.low_water
+        return low_water or any(self.recent_changes)
+
+    def night(self) -> bool:
+        if self.night_hours is None:
+            return False
+        start, end = self.night_hours
+        hour = self.clock().hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def current_interval(self) -> float:
+        if on_battery_power(self.power_supply_dir):
+            return self.max_interval
+        if self.active:
+            return self.min_interval
+        if self.night():
+            return self.max_interval
+        return self.interval
+
+
+def on_battery_power(power_supply_dir: Path = POWER_SUPPLY_DIR) -> bool:
+    """
+    Whether a battery, like a UPS hat's, is discharging. Devices without a
+    battery, or without the power supply class, are on mains power.
+    """
+    try:
+        supplies = list(power_supply_dir.iterdir())
+    except OSError:
+        return False
+    for supply in supplies:
+        try:
+            supply_type = supply.joinpath("type").read_text().strip()
+            status = supply.joinpath("status").read_text().strip()
+        except OSError:
+            continue
+        if supply_type == "Battery" and status == "Discharging":
+            return True
+    return False
+
+
+def scheduler_factory() -> type[Scheduler]:
+    if SCHEDULE_MODE == ScheduleModes.ADAPTIVE:
+        return AdaptiveScheduler
+    return Scheduler
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+from waterbowl.eviction import CacheRecord, EvictionPolicy, OldestFirst
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    picture TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE TABLE IF NOT EXISTS entries_by_hour (
+    hour INTEGER PRIMARY KEY,
+    entries INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entries_by_hour_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_by_hour (hour, entries)
+    VALUES (CAST(NEW.timestamp / 3600 AS INTEGER), 1)
+    ON CONFLICT (hour) DO UPDATE SET entries = entries + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_by_hour_delete AFTER DELETE ON entries BEGIN
+    UPDATE entries_by_hour SET entries = entries - 1
+    WHERE hour = CAST(OLD.timestamp / 3600 AS INTEGER);
+    DELETE FROM entries_by_hour
+    WHERE hour = CAST(OLD.timestamp / 3600 AS INTEGER) AND entries <= 0;
+END;
+"""
+
+HOUR = 3600
+
+# A queued picture: (id, timestamp, picture file name)
+QueueRecord = tuple[int, float, str]
+# A picture to queue: (timestamp, picture file name, picture size in bytes)
+NewRecord = tuple[float, str, int]
+# Where a page of entries read in timestamp order ended: (timestamp, id)
+QueuePosition = tuple[float, int]
+
+
+class StorageQueue:
+    """
+    Durable queue of pictures waiting to be sent, stored in SQLite.
+
+    The database uses write-ahead logging with full synchronous commits, so a
+    commit is on disk once it returns and a power cut mid-write can only lose the
+    transaction in progress, never corrupt the queue. Each commit costs one fsync,
+    so callers should acknowledge entries in batches where they can.
+
+    The queue can be given a budget of entries and bytes. The number of entries
+    and bytes queued are kept up to date as entries are added and removed, and
+    when adding entries takes the queue over budget the eviction policy picks
+    entries to drop. Picking them reads every entry, so eviction frees
+    ``eviction_headroom`` of the budget on top, and the queue fills back up over
+    many enqueues before the next read. Triggers keep a count of the entries taken in each hour, so
+    summarising a large queue by hour doesn't read every entry.
+
+    SQLite calls block, so they all run on a single dedicated thread, which also
+    serialises access to the connection.
+    """
+
+    def __init__(
+        self,
+        database: Path,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        eviction_policy: Optional[EvictionPolicy] = None,
+        eviction_headroom: float = 0.05,
+    ):
+        self.database = database
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy or OldestFirst()
+        self.eviction_headroom = eviction_headroom
+        self.entries = 0
+        self.bytes = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="storage-queue"
+        )
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.database, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.executescript(SCHEMA)
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(entries)")
+            ]
+            if "size" not in columns:
+                connection.execute(
+                    "ALTER TABLE entries ADD COLUMN size INTEGER NOT NULL DEFAULT 0"
+                )
+            self.entries, self.bytes = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            hours = connection.execute(
+                "SELECT COUNT(*) FROM entries_by_hour"
+            ).fetchone()[0]
+            if self.entries and not hours:
+                # Entries queued before the hourly counts were kept
+                connection.execute(
+                    "INSERT INTO entries_by_hour (hour, entries)"
+                    " SELECT CAST(timestamp / 3600 AS INTEGER), COUNT(*) FROM entries"
+                    " GROUP BY 1"
+                )
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _enqueue(self, records: list[NewRecord]) -> list[str]:
+        connection = self._connect()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT INTO entries (timestamp, picture, size) VALUES (?, ?, ?)",
+                records,
+            )
+            self.entries += len(records)
+            self.bytes += sum(size for _, _, size in records)
+            return self._evict(connection)
+
+    def _excess(self, used: int, budget: Optional[int]) -> int:
+        if budget is None or used <= budget:
+            return 0
+        # Small budgets have no headroom, and are kept exactly within budget
+        return used - budget + int(budget * self.eviction_headroom)
+
+    def _evict(self, connection: sqlite3.Connection) -> list[str]:
+        excess_entries = self._excess(self.entries, self.max_entries)
+        excess_bytes = self._excess(self.bytes, self.max_bytes)
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return []
+        records = [
+            CacheRecord(*row)
+            for row in connection.execute(
+                "SELECT id, timestamp, size FROM entries ORDER BY timestamp, id"
+            )
+        ]
+        evicted_ids = self.eviction_policy.select(records, excess_entries, excess_bytes)
+        evicted_pictures = self._delete(connection, evicted_ids)
+        logger.warning(
+            "Local storage over budget, evicted cached pictures",
+            extra={"evicted": len(evicted_ids), "pictures": evicted_pictures},
+        )
+        return evicted_pictures
+
+    def _delete(
+        self, connection: sqlite3.Connection, entry_ids: list[int]
+    ) -> list[str]:
+        pictures = []
+        for entry_id in entry_ids:
+            row = connection.execute(
+                "SELECT picture, size FROM entries WHERE id = ?", (entry_id,)
+            ).fetchone()
+            if row is None:
+                continue
+            connection.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+            pictures.append(row[0])
+            self.entries -= 1
+            self.bytes -= row[1]
+        return pictures
+
+    def _read(self, after_id: int, limit: int) -> list[QueueRecord]:
+        return (
+            self._connect()
+            .execute(
+                "SELECT id, timestamp, picture FROM entries WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit),
+            )
+            .fetchall()
+        )
+
+    def _read_newest(self, limit: int) -> list[QueueRecord]:
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT id, timestamp, picture FROM entries ORDER BY id DESC LIMIT ?",
+                (limit,),
+            )
+            .fetchall()
+        )
+        rows.reverse()
+        return rows
+
+    def _read_between(
+        self, start: float, end: float, after: Optional[QueuePosition], limit: int
+    ) -> list[QueueRecord]:
+        # Pages start from the last (timestamp, id) read, so each page is a seek
+        # on the timestamp index however far into the range it is
+        after_timestamp, after_id = after if after is not None else (start, 0)
+        return (
+            self._connect()
+            .execute(
+                "SELECT id, timestamp, picture FROM entries"
+                " WHERE timestamp >= ? AND timestamp < ? AND (timestamp > ? OR id > ?)"
+                " ORDER BY timestamp, id LIMIT ?",
+                (max(start, after_timestamp), end, after_timestamp, after_id, limit),
+            )
+            .fetchall()
+        )
+
+    def _count_by_hour(
+        self, start: Optional[float], end: Optional[float]
+    ) -> list[tuple[float, int]]:
+        first_hour = int(start // HOUR) if start is not None else -(2**62)
+        last_hour = int(end // HOUR) if end is not None else 2**62
+        rows = self._connect().execute(
+            "SELECT hour, entries FROM entries_by_hour"
+            " WHERE hour BETWEEN ? AND ? ORDER BY hour",
+            (first_hour, last_hour),
+        )
+        return [(float(hour * HOUR), entries) for hour, entries in rows]
+
+    def _acknowledge(self, entry_ids: list[int]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.execute("BEGIN")
+            self._delete(connection, entry_ids)
+
+    def _find(self, timestamp: float, picture: str) -> list[int]:
+        rows = self._connect().execute(
+            "SELECT id FROM entries WHERE timestamp = ? AND picture = ?",
+            (timestamp, picture),
+        )
+        return [row[0] for row in rows]
+
+    def _count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _clear(self) -> None:
+        self._connect().execute("DELETE FROM entries")
+        self.entries = self.bytes = 0
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def enqueue(self, timestamp: float, picture: str, size: int = 0) -> list[str]:
+        """
+        Add a picture to the queue, returning the pictures evicted to keep the
+        queue within its budget.
+        """
+        return await self._run(self._enqueue, [(timestamp, picture, size)])
+
+    async def enqueue_many(self, records: list[NewRecord]) -> list[str]:
+        """
+        Add many pictures to the queue in a single transaction, returning the
+        pictures evicted to keep the queue within its budget.
+        """
+        return await self._run(self._enqueue, records)
+
+    async def read(self, after_id: int = 0, limit: int = 500) -> list[QueueRecord]:
+        """
+        Up to ``limit`` of the oldest entries with an id greater than ``after_id``.
+        Pass the last id read as ``after_id`` to read the next page.
+        """
+        return await self._run(self._read, after_id, limit)
+
+    async def read_newest(self, limit: int = 500) -> list[QueueRecord]:
+        """
+        The ``limit`` newest entries, oldest first.
+        """
+        return await self._run(self._read_newest, limit)
+
+    async def read_between(
+        self,
+        start: float,
+        end: float,
+        after: Optional[QueuePosition] = None,
+        limit: int = 500,
+    ) -> list[QueueRecord]:
+        """
+        Up to ``limit`` entries with a timestamp from ``start`` up to, but not
+        including, ``end``, in timestamp order. Pass the (timestamp, id) of the
+        last entry read as ``after`` to read the next page.
+        """
+        return await self._run(self._read_between, start, end, after, limit)
+
+    async def count_by_hour(
+        self, start: Optional[float] = None, end: Optional[float] = None
+    ) -> list[tuple[float, int]]:
+        """
+        The number of entries taken in each hour, as (start of the hour, entries),
+        from the hour ``start`` falls in to the hour ``end`` falls in. Hours
+        without entries are left out.
+        """
+        return await self._run(self._count_by_hour, start, end)
+
+    async def acknowledge(self, entry_ids: Iterable[int]) -> None:
+        """
+        Remove sent entries from the queue in a single transaction.
+        """
+        await self._run(self._acknowledge, list(entry_ids))
+
+    async def find(self, timestamp: float, picture: str) -> list[int]:
+        return await self._run(self._find, timestamp, picture)
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+    async def usage(self) -> tuple[int, int]:
+        """
+        The number of entries, and bytes of pictures, in the queue.
+        """
+        await self._run(self._connect)
+        return self.entries, self.bytes
+
+    async def clear(self) -> None:
+        await self._run(self._clear)
+
+    async def close(self) -> None:
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def close_nowait(self) -> None:
+        """
+        Close the queue once any queued calls have finished, without waiting.
+        """
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    def import_csv_log(self, csv_log: Path, storage_dir: Path) -> int:
+        """
+        Import the entries of a storage log written by previous versions, which
+        kept the queue in a CSV file, and rename the CSV so it isn't imported again.
+        Lines that can't be read, like one cut short by a power cut, are skipped.
+        This blocks, run it with ``run_io`` once before the queue is used.
+        """
+        records = []
+        with open(csv_log) as log_file:
+            for line_number, line in enumerate(log_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    timestamp, picture = line.strip("\n").split(",", 1)
+                    record_timestamp = float(timestamp)
+                except ValueError:
+                    picture = ""
+                if not picture:
+                    logger.warning(
+                        "Skipping unreadable line in CSV storage log",
+                        extra={"log": csv_log, "line": line_number},
+                    )
+                    continue
+                picture_file = storage_dir.joinpath(picture)
+                size = picture_file.stat().st_size if picture_file.exists() else 0
+                records.append((record_timestamp, picture, size))
+        self._executor.submit(self._enqueue, records).result()
+        os.replace(csv_log, csv_log.with_name(f"{csv_log.name}.imported"))
+        logger.info(
+            "Imported CSV storage log", extra={"log": csv_log, "entries": len(records)}
+        )
+        return len(records)
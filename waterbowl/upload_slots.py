@@ -0,0 +1,119 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Sequence
+
+from waterbowl.enums import PIPELINE_UPLOADERS, UPLOAD_BURST, UPLOAD_RATE
+from waterbowl.metrics import UPLOAD_WAIT_SECONDS
+
+
+class TokenBucket:
+    """
+    Holds up to ``capacity`` tokens, refilled at ``rate`` tokens a second. It
+    starts full, so a burst of up to ``capacity`` can go straight away.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if rate <= 0:
+            raise ValueError(f"Token rate must be positive, got {rate}")
+        if capacity < 1:
+            raise ValueError(f"Token capacity must be at least 1, got {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token if there is one.
+        """
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    @property
+    def wait_time(self) -> float:
+        """
+        Seconds until there's a token.
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self) -> None:
+        """
+        Wait for a token, and take it.
+        """
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time)
+
+
+class UploadSlots:
+    """
+    Shares uploads fairly between cameras. At most ``slots`` uploads run at once,
+    given out first come first served, and each camera's uploads are started
+    through its own token bucket, refilled at an equal share of ``rate``. A
+    camera taking pictures quickly then waits for its own tokens, while the
+    others' uploads go ahead.
+    """
+
+    def __init__(
+        self,
+        camera_ids: Sequence[str],
+        slots: int = PIPELINE_UPLOADERS,
+        rate: float = UPLOAD_RATE,
+        burst: int = UPLOAD_BURST,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not camera_ids:
+            raise ValueError("Upload slots need at least one camera")
+        if slots < 1:
+            raise ValueError(f"Upload slots must be at least 1, got {slots}")
+        self.slots = slots
+        self.buckets = {
+            camera_id: TokenBucket(rate / len(camera_ids), burst, clock)
+            for camera_id in camera_ids
+        }
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def slot(self, camera_id: str) -> AsyncIterator[None]:
+        """
+        Hold one of the upload slots, once the camera has a token for it.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.slots)
+        with UPLOAD_WAIT_SECONDS.labels(camera_id).time():
+            await self.buckets[camera_id].acquire()
+            await self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def limit(
+        self, camera_id: str, upload: Callable[..., Awaitable[Any]]
+    ) -> Callable[..., Awaitable[Any]]:
+        """
+        Wrap a camera's upload function so every upload holds a slot.
+        """
+
+        async def limited_upload(*args: Any, **kwargs: Any) -> Any:
+            async with self.slot(camera_id):
+                return await upload(*args, **kwargs)
+
+        return limited_upload
@@ -0,0 +1,149 @@
+import asyncio
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from waterbowl.enums import (
+    WATER_LEVEL_EMPTY_PICTURE,
+    WATER_LEVEL_FINE,
+    WATER_LEVEL_FULL_PICTURE,
+    WATER_LEVEL_MAX_SKIPPED,
+    WATER_LEVEL_ROI,
+)
+from waterbowl.image_transform import _draft_size
+from waterbowl.metrics import WATER_LEVEL_SECONDS
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# The region of interest is shrunk to this many rows, and columns, before it's
+# compared with the reference pictures
+PROFILE_ROWS = 32
+PROFILE_COLUMNS = 16
+
+
+def roi_profile(
+    picture: Path,
+    roi: tuple[int, int, int, int],
+    rows: int = PROFILE_ROWS,
+    columns: int = PROFILE_COLUMNS,
+) -> "np.ndarray":
+    """
+    The colour and texture of each row of a picture's region of interest, top to
+    bottom: the mean red, green and blue, and how much the brightness varies
+    across the row, all 0-255.
+    """
+    # Imported here, in the estimator's worker, so NumPy and Pillow aren't loaded
+    # on the event loop before the first picture is taken, see
+    # waterbowl.run_waterbowl_watcher.NETWORK_MODULES
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(picture) as image:
+        original_size = image.size
+        # Let the JPEG decoder downscale while decoding, the region only needs to
+        # come out at rows x columns
+        image.draft("RGB", _draft_size(original_size, roi, (columns, rows)))
+        x_scale = image.size[0] / original_size[0]
+        y_scale = image.size[1] / original_size[1]
+        left, upper, right, lower = roi
+        region = (
+            image.convert("RGB")
+            .crop(
+                (
+                    round(left * x_scale),
+                    round(upper * y_scale),
+                    round(right * x_scale),
+                    round(lower * y_scale),
+                )
+            )
+            .resize((columns, rows), Image.Resampling.BOX)
+        )
+    pixels = np.asarray(region, dtype=np.float32)
+    return np.column_stack((pixels.mean(axis=1), pixels.mean(axis=2).std(axis=1)))
+
+
+def water_level(
+    profile: "np.ndarray", empty: "np.ndarray", full: "np.ndarray"
+) -> float:
+    """
+    How far up the region of interest the water comes, from 0 to 1, given the
+    profiles of the picture and of the reference pictures. Water fills from the
+    bottom, so every water line is tried, and the one that best explains the
+    rows below it as water and the rows above it as an empty reservoir wins.
+    """
+    import numpy as np
+
+    to_full = np.linalg.norm(profile - full, axis=1)
+    to_empty = np.linalg.norm(profile - empty, axis=1)
+    # The cost of each water line, from none of the rows under water to all of
+    # them. Ties go to the lowest water line.
+    under_water = np.concatenate(([0.0], np.cumsum(to_full[::-1])))
+    above_water = np.concatenate(([0.0], np.cumsum(to_empty)))[::-1]
+    return float(np.argmin(under_water + above_water)) / len(profile)
+
+
+class WaterLevelEstimator:
+    """
+    Estimates the water level from the colour of the reservoir, within a region
+    of interest from its empty mark up to its full mark, by comparing each row of
+    the region with pictures of the reservoir empty and full. A picture takes a
+    few milliseconds, it's decoded at a fraction of its size.
+
+    Pictures with the water at ``fine`` or above are clearly fine, and don't all
+    need to be uploaded. At most ``max_skipped`` of them in a row are skipped,
+    instead the level is recorded against the last uploaded picture.
+    """
+
+    def __init__(
+        self,
+        roi: Optional[tuple[int, int, int, int]] = WATER_LEVEL_ROI,
+        empty_picture: Optional[Path] = WATER_LEVEL_EMPTY_PICTURE,
+        full_picture: Optional[Path] = WATER_LEVEL_FULL_PICTURE,
+        fine: float = WATER_LEVEL_FINE,
+        max_skipped: int = WATER_LEVEL_MAX_SKIPPED,
+    ):
+        if roi is None or len(roi) != 4:
+            raise ValueError(f"Region of interest must be a 4 edge box, got {roi}")
+        if empty_picture is None or full_picture is None:
+            raise ValueError("Pictures of the reservoir empty and full are needed")
+        self.roi = roi
+        self.empty_picture = empty_picture
+        self.full_picture = full_picture
+        self.fine = fine
+        self.max_skipped = max_skipped
+        self.last_picture_id: Optional[str] = None
+        self.skipped = 0
+        self._references: Optional[tuple["np.ndarray", "np.ndarray"]] = None
+
+    def _estimate(self, picture: Path) -> float:
+        if self._references is None:
+            self._references = (
+                roi_profile(self.empty_picture, self.roi),
+                roi_profile(self.full_picture, self.roi),
+            )
+        return water_level(roi_profile(picture, self.roi), *self._references)
+
+    async def estimate(self, picture: Path) -> float:
+        loop = asyncio.get_running_loop()
+        with WATER_LEVEL_SECONDS.time():
+            return await loop.run_in_executor(None, self._estimate, picture)
+
+    def skippable(self, level: float) -> bool:
+        return (
+            self.last_picture_id is not None
+            and level >= self.fine
+            and self.skipped < self.max_skipped
+        )
+
+    def skip(self) -> None:
+        """
+        Record that a picture with the water clearly fine wasn't uploaded.
+        """
+        self.skipped += 1
+
+    def remember(self, picture_id: str) -> None:
+        """
+        Record the picture that was uploaded, skipped pictures' levels go to it.
+        """
+        self.last_picture_id = picture_id
+        self.skipped = 0